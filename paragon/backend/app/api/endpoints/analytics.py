@@ -0,0 +1,93 @@
+import asyncio
+from typing import Literal, Optional
+
+from fastapi import APIRouter, HTTPException, Query
+
+from app.models.analytics import AnalyticsResponse
+from app.services.analytics import analytics_store
+from app.utils.parser import normalize_receipt_date
+
+router = APIRouter()
+
+
+async def run_analytics_query(dataset: str, group_by: str, **filters) -> AnalyticsResponse:
+    """Wykonuje zapytanie analityczne poza pętlą zdarzeń i zamienia błędy parametrów na odpowiedź 400"""
+    dimensions = [name.strip() for name in group_by.split(",") if name.strip()]
+    filters["date_from"] = normalize_receipt_date(filters.get("date_from"), "date_from")
+    filters["date_to"] = normalize_receipt_date(filters.get("date_to"), "date_to")
+
+    try:
+        result = await asyncio.to_thread(analytics_store.query, dataset, dimensions, **filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return AnalyticsResponse(group_by=dimensions, **result)
+
+
+@router.get("/analytics/spend", response_model=AnalyticsResponse, response_model_exclude_none=True)
+async def get_spend_analytics(
+        group_by: str = Query("month", description="Wymiary grupowania oddzielone przecinkami: day, month, year, company, product, vat_class"),
+        date_from: Optional[str] = Query(None, description="Data paragonu od (YYYYMMDD, włącznie)"),
+        date_to: Optional[str] = Query(None, description="Data paragonu do (YYYYMMDD, włącznie)"),
+        company: Optional[str] = Query(None, description="Fragment nazwy sprzedawcy"),
+        product: Optional[str] = Query(None, description="Fragment nazwy produktu"),
+        vat_class: Optional[str] = Query(None, description="Litera stawki VAT"),
+        order_by: Literal["key", "amount"] = Query("key", description="Kolejność grup"),
+        limit: int = Query(100, ge=1, le=10000, description="Maksymalna liczba grup"),
+):
+    """
+    Pobiera wydatki pogrupowane według okresu, sprzedawcy, produktu lub stawki VAT.
+
+    Bez wymiarów `product` i `vat_class` (i filtrów po nich) sumowane są kwoty paragonów,
+    w przeciwnym razie kwoty pozycji zakupów (linie P i PC).
+
+    - **group_by**: Wymiary grupowania (np. `month,company`)
+    - **date_from**, **date_to**: Zakres dat paragonu
+    - **company**, **product**: Fragmenty nazw (bez rozróżniania wielkości liter)
+    - **vat_class**: Litera stawki VAT (np. `A`)
+    - **order_by**: `key` - według kluczy grup, `amount` - od największej kwoty
+    - **limit**: Maksymalna liczba grup
+    """
+    return await run_analytics_query(
+        "spend",
+        group_by,
+        date_from=date_from,
+        date_to=date_to,
+        company=company,
+        product=product,
+        vat_class=vat_class,
+        order_by=order_by,
+        limit=limit,
+    )
+
+
+@router.get("/analytics/vat", response_model=AnalyticsResponse, response_model_exclude_none=True)
+async def get_vat_analytics(
+        group_by: str = Query("month,vat_class", description="Wymiary grupowania oddzielone przecinkami: day, month, year, company, vat_class"),
+        date_from: Optional[str] = Query(None, description="Data paragonu od (YYYYMMDD, włącznie)"),
+        date_to: Optional[str] = Query(None, description="Data paragonu do (YYYYMMDD, włącznie)"),
+        company: Optional[str] = Query(None, description="Fragment nazwy sprzedawcy"),
+        vat_class: Optional[str] = Query(None, description="Litera stawki VAT"),
+        order_by: Literal["key", "amount"] = Query("key", description="Kolejność grup"),
+        limit: int = Query(100, ge=1, le=10000, description="Maksymalna liczba grup"),
+):
+    """
+    Pobiera sprzedaż opodatkowaną i podatek PTU według stawek VAT (z podsumowania paragonu, linie S).
+
+    - **group_by**: Wymiary grupowania (np. `month,vat_class`)
+    - **date_from**, **date_to**: Zakres dat paragonu
+    - **company**: Fragment nazwy sprzedawcy
+    - **vat_class**: Litera stawki VAT (np. `A`)
+    - **order_by**: `key` - według kluczy grup, `amount` - od największej sprzedaży
+    - **limit**: Maksymalna liczba grup
+    """
+    return await run_analytics_query(
+        "vat",
+        group_by,
+        date_from=date_from,
+        date_to=date_to,
+        company=company,
+        vat_class=vat_class,
+        order_by=order_by,
+        limit=limit,
+    )
@@ -0,0 +1,41 @@
+import asyncio
+from fastapi import APIRouter, Path, HTTPException
+
+from app.services.jobs import job_queue
+from app.models.job import JobResponse
+
+router = APIRouter()
+
+
+def job_to_response(job: dict) -> JobResponse:
+    """Konwertuje dane zadania z kolejki na model odpowiedzi"""
+    return JobResponse(
+        job_id=job['id'],
+        status=job['status'],
+        filename=job['filename'],
+        file_hash=job['file_hash'],
+        created_at=job['created_at'],
+        updated_at=job['updated_at'],
+        result=job['result'],
+        error=job['error']
+    )
+
+
+@router.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job_status(
+        job_id: str = Path(..., description="Identyfikator zadania OCR")
+):
+    """
+    Pobiera status zadania OCR i jego wynik po zakończeniu.
+
+    - **job_id**: Identyfikator zadania zwrócony przez `/ocr-receipt` z `background=true`
+    """
+    job = await asyncio.to_thread(job_queue.get, job_id)
+
+    if not job:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Zadanie {job_id} nie zostało znalezione"
+        )
+
+    return job_to_response(job)
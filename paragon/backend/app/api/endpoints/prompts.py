@@ -0,0 +1,35 @@
+from fastapi import APIRouter
+
+from app.core.config import settings
+from app.services.prompts import prompt_registry
+from app.models.prompt import PromptListResponse, PromptReloadResponse
+
+router = APIRouter()
+
+
+@router.get("/prompts", response_model=PromptListResponse)
+async def list_prompts():
+    """
+    Pobiera listę wersji promptów OCR wczytanych do pamięci wraz z odciskami treści.
+    """
+    return PromptListResponse(
+        default_version=settings.DEFAULT_PROMPT_VERSION,
+        prompts=prompt_registry.describe()
+    )
+
+
+@router.post("/prompts/reload", response_model=PromptReloadResponse)
+async def reload_prompts():
+    """
+    Wymusza ponowne wczytanie promptów OCR z dysku bez restartu aplikacji.
+
+    Zmiana treści promptu zmienia jego odcisk, więc wcześniejsze wyniki OCR
+    dla tej wersji nie będą zwracane z cache.
+    """
+    stats = prompt_registry.reload()
+
+    return PromptReloadResponse(
+        loaded=stats['loaded'],
+        removed=stats['removed'],
+        prompts=prompt_registry.describe()
+    )
@@ -1,39 +1,106 @@
-from fastapi import APIRouter, File, UploadFile, Form, Query, Path, HTTPException, Depends
-from fastapi.responses import FileResponse
-from typing import List, Optional
+from fastapi import APIRouter, File, UploadFile, Form, Query, Path, HTTPException, Depends, Request, Response
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from starlette.background import BackgroundTask
+from typing import AsyncIterator, List, Literal, Optional
 import os
+import json
+import logging
 
-from app.services.ocr import process_receipt_image
-from app.services.storage import get_receipt_history, get_receipt_by_hash
-from app.models.receipt import OCRResponse
+from app.services.ocr import (
+    process_receipt_image,
+    process_receipt_batch,
+    get_parsed_receipt,
+    resolve_prompt,
+    stream_receipt_data,
+)
+from app.services.jobs import enqueue_receipt_job
+from app.api.endpoints.jobs import job_to_response
+from app.models.job import JobResponse
+from app.services.storage import (
+    get_receipt_history,
+    get_receipt_by_hash,
+    search_receipts,
+    get_image_variant,
+    get_file_etag,
+    path_exists,
+)
+from app.models.receipt import OCRResponse, OCRResult, BatchOCRResponse, SearchResponse
 from app.core.config import settings
+from app.utils.image import validate_image_filename
+from app.utils.upload import ingest_upload
+from app.utils.parser import normalize_receipt_date
 
 router = APIRouter()
 
+logger = logging.getLogger(__name__)
 
-@router.post("/ocr-receipt", response_model=OCRResponse)
+
+def format_sse_event(event: str, data: dict) -> str:
+    """Formatuje zdarzenie Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@router.post("/ocr-receipt", response_model=OCRResponse, responses={202: {"model": JobResponse}})
 async def upload_and_ocr_receipt(
         file: UploadFile = File(...),
         prompt_version: Optional[str] = Form(None),
+        use_cache: bool = Form(True),
+        refresh_cache: bool = Form(False),
+        skip_osd: bool = Form(False),
+        background: bool = Form(False),
 ):
     """
     Przetwarza przesłany obraz paragonu za pomocą OCR i zwraca wyniki.
 
     - **file**: Plik obrazu paragonu do przetworzenia
     - **prompt_version**: Opcjonalna wersja promptu OCR (domyślnie używana jest wersja z konfiguracji)
+    - **use_cache**: Czy zwrócić zapisany wynik, jeśli ten sam obraz był już przetworzony (domyślnie tak)
+    - **refresh_cache**: Czy wymusić ponowny OCR i odświeżyć zapisany wynik (domyślnie nie)
+    - **skip_osd**: Czy pominąć wykrywanie orientacji przez Tesseract OSD (wystarczy EXIF i proporcje obrazu)
+    - **background**: Czy dodać paragon do kolejki i od razu zwrócić identyfikator zadania
+      (status i wynik dostępne pod `/jobs/{job_id}`)
     """
     # Sprawdź rozszerzenie pliku
-    filename = file.filename.lower()
-    valid_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.pdf']
+    is_valid, error_message = validate_image_filename(file.filename)
 
-    if not any(filename.endswith(ext) for ext in valid_extensions):
+    if not is_valid:
         raise HTTPException(
             status_code=400,
-            detail=f"Nieprawidłowy format pliku. Dozwolone formaty: {', '.join(valid_extensions)}"
+            detail=error_message
+        )
+
+    # Dodaj paragon do kolejki zadań
+    if background:
+        if not settings.jobs.ENABLED:
+            raise HTTPException(
+                status_code=400,
+                detail="Kolejka zadań OCR jest wyłączona"
+            )
+
+        with await ingest_upload(file) as upload:
+            job = await enqueue_receipt_job(
+                upload.source,
+                upload.file_hash,
+                filename=file.filename,
+                prompt_version=prompt_version,
+                use_cache=use_cache,
+                refresh_cache=refresh_cache,
+                options={'use_osd': not skip_osd},
+            )
+        return JSONResponse(
+            status_code=202,
+            content=jsonable_encoder(job_to_response(job))
         )
 
     # Wykonaj OCR
-    result = await process_receipt_image(file, prompt_version=prompt_version)
+    result = await process_receipt_image(
+        file,
+        prompt_version=prompt_version,
+        use_cache=use_cache,
+        refresh_cache=refresh_cache,
+        use_osd=not skip_osd,
+    )
 
     # Zwróć wynik w formacie OCRResponse
     return OCRResponse(
@@ -44,22 +111,191 @@ async def upload_and_ocr_receipt(
         llm_model=result['llm_model'],
         tokens_in=result['tokens_in'],
         tokens_out=result['tokens_out'],
-        ocr_prompt_version=result['ocr_prompt_version']
+        ocr_prompt_version=result['ocr_prompt_version'],
+        cached=result['cached'],
+        near_duplicate=result.get('near_duplicate'),
+    )
+
+
+@router.post("/ocr-receipt/stream")
+async def upload_and_stream_ocr_receipt(
+        file: UploadFile = File(...),
+        prompt_version: Optional[str] = Form(None),
+        use_cache: bool = Form(True),
+        refresh_cache: bool = Form(False),
+        skip_osd: bool = Form(False),
+):
+    """
+    Przetwarza przesłany obraz paragonu i zwraca wynik strumieniowo (Server-Sent Events).
+
+    Zdarzenia:
+    - **line**: kolejna linia paragonu (OCRLine), wysyłana zaraz po odczytaniu jej z odpowiedzi LLM
+    - **reset**: odpowiedź tańszego modelu nie przeszła walidacji - dotychczasowe linie należy
+      odrzucić, kolejne pochodzą z odpowiedzi silniejszego modelu
+    - **result**: dane kontrolne, tokeny i hash (OCRResponse) po zapisaniu plików
+    - **error**: komunikat błędu, jeśli przetwarzanie nie powiodło się w trakcie strumienia
+
+    Parametry jak w `/ocr-receipt` (bez `background`).
+    """
+    is_valid, error_message = validate_image_filename(file.filename)
+
+    if not is_valid:
+        raise HTTPException(
+            status_code=400,
+            detail=error_message
+        )
+
+    # Błędy wykryte przed rozpoczęciem strumienia zwracamy jako zwykłą odpowiedź HTTP
+    prompt = resolve_prompt(prompt_version)
+    upload = await ingest_upload(file)
+
+    async def event_stream() -> AsyncIterator[str]:
+        try:
+            async for event, data in stream_receipt_data(
+                    upload.source,
+                    upload.file_hash,
+                    prompt_version=prompt['version'],
+                    use_cache=use_cache,
+                    refresh_cache=refresh_cache,
+                    use_osd=not skip_osd,
+            ):
+                yield format_sse_event(event, data)
+        except HTTPException as e:
+            yield format_sse_event("error", {"detail": e.detail})
+        except Exception as e:
+            logger.error(f"Błąd strumieniowego przetwarzania paragonu {upload.file_hash}: {str(e)}", exc_info=True)
+            yield format_sse_event("error", {"detail": "Wystąpił nieoczekiwany błąd serwera", "type": type(e).__name__})
+
+    # Plik tymczasowy jest usuwany po zakończeniu odpowiedzi - także wtedy, gdy klient
+    # rozłączył się, zanim strumień zaczął być odczytywany
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(upload.close),
+    )
+
+
+@router.post("/ocr-receipts", response_model=BatchOCRResponse)
+async def upload_and_ocr_receipts(
+        files: List[UploadFile] = File(...),
+        prompt_version: Optional[str] = Form(None),
+        use_cache: bool = Form(True),
+        refresh_cache: bool = Form(False),
+        skip_osd: bool = Form(False),
+):
+    """
+    Przetwarza wiele obrazów paragonów w jednym żądaniu.
+
+    Identyczne pliki są przetwarzane tylko raz, a pozostałe równolegle (do limitu
+    z konfiguracji). Błąd pojedynczego pliku jest zwracany w jego pozycji wyniku.
+
+    - **files**: Pliki obrazów paragonów do przetworzenia
+    - **prompt_version**: Opcjonalna wersja promptu OCR (domyślnie używana jest wersja z konfiguracji)
+    - **use_cache**: Czy zwracać zapisane wyniki dla już przetworzonych obrazów (domyślnie tak)
+    - **refresh_cache**: Czy wymusić ponowny OCR i odświeżyć zapisane wyniki (domyślnie nie)
+    - **skip_osd**: Czy pominąć wykrywanie orientacji przez Tesseract OSD
+    """
+    if len(files) > settings.app.BATCH_MAX_FILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Zbyt wiele plików. Maksymalna liczba plików w jednym żądaniu: {settings.app.BATCH_MAX_FILES}"
+        )
+
+    items = await process_receipt_batch(
+        files,
+        prompt_version=prompt_version,
+        use_cache=use_cache,
+        refresh_cache=refresh_cache,
+        use_osd=not skip_osd,
+    )
+    failed = sum(1 for item in items if item['error'] is not None)
+
+    return BatchOCRResponse(
+        items=items,
+        processed=len(items) - failed,
+        failed=failed
     )
 
 
 @router.get("/receipts", response_model=List[dict])
 async def get_receipts_history(
+        response: Response,
         limit: int = Query(10, ge=1, le=100, description="Maksymalna liczba wyników"),
-        offset: int = Query(0, ge=0, description="Przesunięcie do paginacji")
+        offset: int = Query(0, ge=0, description="Przesunięcie do paginacji (zamiast kursora)"),
+        cursor: Optional[str] = Query(None, description="Kursor kolejnej strony (nagłówek X-Next-Cursor)"),
+        sort: Literal["created_at", "receipt_date"] = Query("created_at", description="Klucz sortowania"),
+        order: Literal["desc", "asc"] = Query("desc", description="Kierunek sortowania"),
+        date_from: Optional[str] = Query(None, description="Data paragonu od (YYYYMMDD, włącznie)"),
+        date_to: Optional[str] = Query(None, description="Data paragonu do (YYYYMMDD, włącznie)"),
+        company: Optional[str] = Query(None, description="Początek nazwy sprzedawcy"),
+        total_min: Optional[float] = Query(None, description="Minimalna kwota paragonu"),
+        total_max: Optional[float] = Query(None, description="Maksymalna kwota paragonu"),
+        prompt_version: Optional[str] = Query(None, description="Wersja promptu OCR"),
 ):
     """
     Pobiera historię przetworzonych paragonów.
 
+    Kolejne strony pobiera się, przekazując w parametrze `cursor` wartość nagłówka
+    `X-Next-Cursor` z poprzedniej odpowiedzi (brak nagłówka oznacza ostatnią stronę).
+
+    - **limit**: Maksymalna liczba wyników (1-100)
+    - **offset**: Przesunięcie do paginacji (ignorowane, gdy podano kursor)
+    - **cursor**: Kursor kolejnej strony
+    - **sort**: Klucz sortowania (`created_at` lub `receipt_date`)
+    - **order**: Kierunek sortowania (`desc` lub `asc`)
+    - **date_from**, **date_to**: Zakres dat paragonu
+    - **company**: Początek nazwy sprzedawcy (bez rozróżniania wielkości liter)
+    - **total_min**, **total_max**: Zakres kwoty paragonu
+    - **prompt_version**: Wersja promptu OCR
+    """
+    try:
+        receipts, next_cursor = await get_receipt_history(
+            limit=limit,
+            offset=offset,
+            cursor=cursor,
+            sort=sort,
+            descending=order == "desc",
+            date_from=normalize_receipt_date(date_from, "date_from"),
+            date_to=normalize_receipt_date(date_to, "date_to"),
+            company=company,
+            total_min=total_min,
+            total_max=total_max,
+            prompt_version=prompt_version,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+    return receipts
+
+
+# Ścieżka musi być zadeklarowana przed /receipts/{file_hash}
+@router.get("/receipts/search", response_model=SearchResponse)
+async def search_receipts_content(
+        q: str = Query(..., min_length=1, description="Szukany tekst (np. nazwa produktu)"),
+        limit: int = Query(10, ge=1, le=100, description="Maksymalna liczba wyników"),
+        offset: int = Query(0, ge=0, description="Przesunięcie do paginacji")
+):
+    """
+    Wyszukuje paragony po treści linii OCR.
+
+    Wielkość liter i polskie znaki diakrytyczne nie mają znaczenia, a słowa są
+    dopasowywane jako prefiksy (np. `ser gou` znajdzie "Ser Gouda w pl.").
+    Wyniki są uszeregowane według trafności (bm25) i zawierają pasujące linie.
+
+    - **q**: Szukany tekst
     - **limit**: Maksymalna liczba wyników (1-100)
     - **offset**: Przesunięcie do paginacji
     """
-    return await get_receipt_history(limit=limit, offset=offset)
+    try:
+        items, total = await search_receipts(q, limit=limit, offset=offset)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return SearchResponse(query=q, total=total, items=items)
 
 
 @router.get("/receipts/{file_hash}", response_model=dict)
@@ -82,16 +318,39 @@ async def get_receipt_details(
     return receipt
 
 
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Sprawdza, czy nagłówek If-None-Match obejmuje podany ETag"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Porównanie słabe (RFC 9110) - prefiks W/ nie ma znaczenia dla If-None-Match
+    candidates = [value.strip().removeprefix("W/") for value in if_none_match.split(",")]
+    return etag in candidates
+
+
 @router.get("/receipts/{file_hash}/image")
 async def get_receipt_image(
+        request: Request,
         file_hash: str = Path(..., description="Hash pliku obrazu"),
-        fixed: bool = Query(True, description="Czy zwrócić poprawiony obraz (True) czy oryginalny (False)")
+        fixed: bool = Query(True, description="Czy zwrócić poprawiony obraz (True) czy oryginalny (False)"),
+        variant: Literal["full", "preview", "thumbnail"] = Query(
+            "full", description="Rozmiar obrazu: pełny, podgląd lub miniatura"
+        )
 ):
     """
     Pobiera obraz paragonu na podstawie hasza.
 
+    Podgląd i miniatura są tworzone przy pierwszym żądaniu i zapisywane na dysku.
+    Odpowiedź zawiera silny ETag (skrót treści), a żądanie z pasującym `If-None-Match`
+    kończy się odpowiedzią 304. Tylko oryginał (adresowany haszem treści) ma nagłówek
+    `Cache-Control: immutable` - obraz poprawiony i pomniejszone wersje mogą się zmienić
+    pod tym samym adresem (ponowne przetworzenie paragonu, zmiana rozmiarów), więc
+    są zwracane z `no-cache` i wymagają walidacji ETagiem.
+
     - **file_hash**: Hash pliku obrazu
     - **fixed**: Czy zwrócić poprawiony obraz (True) czy oryginalny (False)
+    - **variant**: `full` (pełny obraz), `preview` lub `thumbnail`
     """
     receipt = await get_receipt_by_hash(file_hash)
 
@@ -104,13 +363,36 @@ async def get_receipt_image(
     image_type = "fixed" if fixed else "original"
     image_path = receipt["file_paths"].get(image_type)
 
-    if not image_path or not os.path.exists(image_path):
+    # Obraz poprawiony jest zapisywany tylko wtedy, gdy orientacja została zmieniona
+    if fixed and not image_path:
+        image_path = receipt["file_paths"].get("original")
+
+    if not image_path or not await path_exists(image_path):
         raise HTTPException(
             status_code=404,
             detail=f"Obraz paragonu ({image_type}) nie został znaleziony"
         )
 
-    return FileResponse(image_path)
+    if variant != "full":
+        image_path = await get_image_variant(image_path, variant)
+
+    if not fixed and variant == "full":
+        # Hash pliku jest skrótem SHA-256 oryginału - nie trzeba go liczyć ponownie
+        headers = {
+            "ETag": f'"{file_hash}"',
+            "Cache-Control": f"public, max-age={settings.image.CACHE_MAX_AGE}, immutable",
+        }
+    else:
+        headers = {
+            "ETag": await get_file_etag(image_path),
+            "Cache-Control": "public, no-cache",
+        }
+    etag = headers["ETag"]
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    return FileResponse(image_path, headers=headers)
 
 
 @router.get("/receipts/{file_hash}/ocr")
@@ -132,10 +414,32 @@ async def get_receipt_ocr_text(
 
     ocr_path = receipt["file_paths"].get("ocr")
 
-    if not ocr_path or not os.path.exists(ocr_path):
+    if not ocr_path or not await path_exists(ocr_path):
         raise HTTPException(
             status_code=404,
             detail="Tekst OCR paragonu nie został znaleziony"
         )
 
     return FileResponse(ocr_path, media_type="text/plain")
+
+
+@router.get("/receipts/{file_hash}/lines", response_model=OCRResult)
+async def get_receipt_lines(
+        file_hash: str = Path(..., description="Hash pliku obrazu"),
+        prompt_version: Optional[str] = Query(None, description="Wersja promptu OCR (domyślnie ostatnio użyta)")
+):
+    """
+    Pobiera sparsowane linie paragonu i dane kontrolne na podstawie hasza.
+
+    - **file_hash**: Hash pliku obrazu
+    - **prompt_version**: Opcjonalna wersja promptu OCR (domyślnie wersja z metadanych paragonu)
+    """
+    parsed = await get_parsed_receipt(file_hash, prompt_version)
+
+    if not parsed:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Paragon o hashu {file_hash} nie został znaleziony"
+        )
+
+    return parsed
@@ -1,10 +1,13 @@
 from fastapi import APIRouter
-from app.api.endpoints import receipt
+from app.api.endpoints import receipt, jobs, prompts, analytics
 
 api_router = APIRouter()
 
 # Dodaj wszystkie endpointy
 api_router.include_router(receipt.router, tags=["receipts"])
+api_router.include_router(jobs.router, tags=["jobs"])
+api_router.include_router(prompts.router, tags=["prompts"])
+api_router.include_router(analytics.router, tags=["analytics"])
 
 # W przyszłości możesz dodać kolejne routery dla innych zasobów API
 # np. api_router.include_router(users.router, prefix="/users", tags=["users"])
@@ -10,19 +10,47 @@ from dotenv import load_dotenv
 load_dotenv()
 
 
+def _env_bool(name: str) -> Optional[bool]:
+    """Zwraca wartość logiczną zmiennej środowiskowej lub None, jeśli nie jest ustawiona"""
+    value = os.getenv(name)
+    if value is None or value == "":
+        return None
+    return value.lower() in ("true", "1", "t")
+
+
 class AppSettings(BaseModel):
     """Konfiguracja aplikacji"""
     PROJECT_NAME: str = "Paragon OCR API"
     API_V1_STR: str = ""
     DEBUG: bool = Field(default=False)
     VERSION: str = "1.0.0"
+    BATCH_MAX_FILES: int = Field(default=50)
+    BATCH_MAX_CONCURRENCY: int = Field(default=8)
+    UPLOAD_MAX_BYTES: int = Field(default=25 * 1024 * 1024)  # 0 oznacza brak limitu
+    UPLOAD_CHUNK_SIZE: int = Field(default=1024 * 1024)
+    UPLOAD_SPOOL_THRESHOLD: int = Field(default=4 * 1024 * 1024)
+    UPLOAD_TMP_DIR: str = Field(default="")  # domyślnie katalog tymczasowy systemu
+    METRICS_ENABLED: bool = Field(default=True)
 
 
 class OpenAISettings(BaseModel):
     """Konfiguracja OpenAI"""
     API_KEY: str = Field(default="")
+    BASE_URL: str = Field(default="")  # domyślnie API OpenAI, np. http://localhost:8100/v1 dla serwera testowego
     DEFAULT_MODEL: str = Field(default="gpt-4o")
     MAX_TOKENS: int = Field(default=2500)
+    REQUEST_TIMEOUT: float = Field(default=120.0)
+    CONNECT_TIMEOUT: float = Field(default=10.0)
+    MAX_CONNECTIONS: int = Field(default=100)
+    MAX_KEEPALIVE_CONNECTIONS: int = Field(default=20)
+    KEEPALIVE_EXPIRY: float = Field(default=60.0)
+    MAX_CONCURRENCY: int = Field(default=32)
+    MIN_CONCURRENCY: int = Field(default=1)
+    MAX_RETRIES: int = Field(default=4)
+    RETRY_BASE_DELAY: float = Field(default=1.0)
+    RETRY_MAX_DELAY: float = Field(default=30.0)
+    RATE_LIMIT_RPM: int = Field(default=0)  # 0 oznacza brak limitu zapytań na minutę
+    RATE_LIMIT_TPM: int = Field(default=0)  # 0 oznacza brak limitu tokenów na minutę
 
     @validator("API_KEY")
     def validate_api_key(cls, v):
@@ -31,12 +59,83 @@ class OpenAISettings(BaseModel):
         return v
 
 
+class LLMBackendSettings(BaseModel):
+    """Konfiguracja dodatkowego backendu LLM (model OpenAI lub dowolny serwer zgodny z API OpenAI)"""
+    NAME: str
+    MODEL: str
+    BASE_URL: str = Field(default="")  # domyślnie API OpenAI, np. http://localhost:8080/v1 dla serwera lokalnego
+    API_KEY: str = Field(default="")  # domyślnie klucz OPENAI_API_KEY
+    MAX_TOKENS: int = Field(default=0)  # 0 oznacza MAX_TOKENS backendu domyślnego
+    MAX_CONCURRENCY: int = Field(default=0)  # 0 oznacza OPENAI_MAX_CONCURRENCY
+    RATE_LIMIT_RPM: int = Field(default=0)
+    RATE_LIMIT_TPM: int = Field(default=0)
+    # Paragony obsługiwane przez backend (0 oznacza brak limitu)
+    MAX_LINES: int = Field(default=0)  # szacowana liczba linii tekstu
+    MAX_ASPECT: float = Field(default=0)  # stosunek wysokości do szerokości obrazu
+    MAX_PIXELS: int = Field(default=0)  # liczba pikseli obrazu wysyłanego do LLM
+
+
+class RoutingSettings(BaseModel):
+    """Konfiguracja wyboru backendu LLM"""
+    BACKENDS: List[LLMBackendSettings] = Field(default_factory=list)  # od najtańszego; backend domyślny jest ostatni
+    ESCALATION_ENABLED: bool = Field(default=True)  # ponowienie silniejszym backendem po nieudanej walidacji
+
+
 class StorageSettings(BaseModel):
     """Konfiguracja przechowywania danych"""
     DATA_DIR: str = Field(default="data")
     PROMPT_DIR: str = Field(default="app/resources/prompts")
     DEFAULT_PROMPT_VERSION: str = Field(default="1_0_3")
+    PROMPT_RELOAD_INTERVAL: float = Field(default=2.0)  # sekundy między sprawdzeniami mtime, 0 wyłącza
     CACHE_ENABLED: bool = Field(default=True)
+    CACHE_MAX_ITEMS: int = Field(default=1024)
+    INDEX_PATH: str = Field(default="")  # domyślnie {DATA_DIR}/receipts.sqlite3
+    DUPLICATE_MODE: str = Field(default="flag")  # flag, reuse lub off - obsługa podobnych obrazów paragonów
+    DUPLICATE_MAX_DISTANCE: int = Field(default=10)  # maks. odległość Hamminga skrótów (0-64) uznawana za duplikat
+    DUPLICATE_MIN_SIMILARITY: float = Field(default=0.7)  # min. korelacja profili wierszy tekstu wymagana w trybie reuse
+
+
+class ImageSettings(BaseModel):
+    """Konfiguracja przetwarzania obrazów"""
+    PROCESS_POOL_ENABLED: bool = Field(default=True)
+    PROCESS_POOL_WORKERS: int = Field(default=0)  # 0 oznacza liczbę rdzeni CPU
+    LLM_MAX_LONG_EDGE: int = Field(default=2048)  # 0 oznacza brak limitu
+    LLM_MAX_PIXELS: int = Field(default=0)  # 0 oznacza brak limitu
+    LLM_GRAYSCALE: bool = Field(default=False)
+    LLM_JPEG_QUALITY: int = Field(default=85)
+    LLM_FORMATS: str = Field(default="JPEG")  # np. "JPEG,WEBP" - wybierany jest najmniejszy wynik
+    LLM_IMAGE_DETAIL: str = Field(default="auto")  # auto, high lub low
+    ORIENTATION_ASSUME_PORTRAIT_UPRIGHT: bool = Field(default=True)
+    ORIENTATION_OSD_ENABLED: bool = Field(default=True)
+    ORIENTATION_OSD_MAX_EDGE: int = Field(default=1600)
+    THUMBNAIL_MAX_EDGE: int = Field(default=256)
+    PREVIEW_MAX_EDGE: int = Field(default=1024)
+    VARIANT_JPEG_QUALITY: int = Field(default=80)
+    CACHE_MAX_AGE: int = Field(default=31536000)  # Czas przechowywania obrazów w cache klienta/CDN (s)
+    CROP_ENABLED: bool = Field(default=False)  # Kadrowanie zdjęcia do obszaru paragonu (do włączenia po pomiarze zysku)
+    CROP_ANALYSIS_MAX_EDGE: int = Field(default=512)  # Rozmiar kopii, na której wyznaczany jest kadr
+    CROP_MARGIN: float = Field(default=0.02)  # Margines kadru (ułamek dłuższego boku)
+    CROP_MIN_AREA: float = Field(default=0.05)  # Mniejszy kadr jest uznawany za błędny
+    CROP_MAX_AREA: float = Field(default=0.9)  # Większy kadr nie jest stosowany (zbyt mały zysk)
+    DESKEW_ENABLED: bool = Field(default=True)
+    DESKEW_MIN_ANGLE: float = Field(default=1.0)  # Mniejsze pochylenie nie wpływa na OCR, a obrót kosztuje
+    DESKEW_MAX_ANGLE: float = Field(default=10.0)
+    DESKEW_FRAME_MIN_ANGLE: float = Field(default=3.0)  # Minimalne pochylenie obracanego obrazu bez kadrowania
+    PDF_RENDER_DPI: int = Field(default=200)
+    PDF_MAX_PAGES: int = Field(default=20)
+    PDF_TEXT_ENABLED: bool = Field(default=True)  # Strony z warstwą tekstową bez renderowania obrazu
+    PDF_MIN_TEXT_CHARS: int = Field(default=20)  # Minimalna długość tekstu strony uznawanej za tekstową
+
+
+class JobSettings(BaseModel):
+    """Konfiguracja kolejki zadań OCR"""
+    ENABLED: bool = Field(default=True)
+    WORKERS: int = Field(default=4)
+    DIR: str = Field(default="")  # domyślnie {DATA_DIR}/_jobs
+    POLL_INTERVAL: float = Field(default=1.0)
+    MAX_ATTEMPTS: int = Field(default=3)
+    RETRY_DELAY: float = Field(default=5.0)  # opóźnienie pierwszego ponowienia (podwajane przy kolejnych)
+    LEASE_SECONDS: float = Field(default=60.0)  # dzierżawa uruchomionego zadania, odnawiana w trakcie przetwarzania
 
 
 class Settings(BaseModel):
@@ -44,6 +143,9 @@ class Settings(BaseModel):
     app: AppSettings = Field(default_factory=AppSettings)
     openai: OpenAISettings = Field(default_factory=OpenAISettings)
     storage: StorageSettings = Field(default_factory=StorageSettings)
+    image: ImageSettings = Field(default_factory=ImageSettings)
+    jobs: JobSettings = Field(default_factory=JobSettings)
+    routing: RoutingSettings = Field(default_factory=RoutingSettings)
 
     def __init__(self, **data: Any):
         """Inicjalizuje ustawienia z pliku konfiguracyjnego lub zmiennych środowiskowych"""
@@ -63,32 +165,110 @@ class Settings(BaseModel):
             "PROJECT_NAME": os.getenv("PROJECT_NAME"),
             "API_V1_STR": os.getenv("API_V1_STR"),
             "DEBUG": os.getenv("DEBUG", "").lower() in ("true", "1", "t"),
-            "VERSION": os.getenv("VERSION")
+            "VERSION": os.getenv("VERSION"),
+            "BATCH_MAX_FILES": os.getenv("BATCH_MAX_FILES"),
+            "BATCH_MAX_CONCURRENCY": os.getenv("BATCH_MAX_CONCURRENCY"),
+            "UPLOAD_MAX_BYTES": os.getenv("UPLOAD_MAX_BYTES"),
+            "UPLOAD_CHUNK_SIZE": os.getenv("UPLOAD_CHUNK_SIZE"),
+            "UPLOAD_SPOOL_THRESHOLD": os.getenv("UPLOAD_SPOOL_THRESHOLD"),
+            "UPLOAD_TMP_DIR": os.getenv("UPLOAD_TMP_DIR"),
+            "METRICS_ENABLED": _env_bool("METRICS_ENABLED")
         }
 
         env_openai_settings = {
             "API_KEY": os.getenv("OPENAI_API_KEY"),
+            "BASE_URL": os.getenv("OPENAI_BASE_URL"),
             "DEFAULT_MODEL": os.getenv("DEFAULT_LLM_MODEL"),
-            "MAX_TOKENS": os.getenv("MAX_TOKENS")
+            "MAX_TOKENS": os.getenv("MAX_TOKENS"),
+            "REQUEST_TIMEOUT": os.getenv("OPENAI_REQUEST_TIMEOUT"),
+            "CONNECT_TIMEOUT": os.getenv("OPENAI_CONNECT_TIMEOUT"),
+            "MAX_CONNECTIONS": os.getenv("OPENAI_MAX_CONNECTIONS"),
+            "MAX_KEEPALIVE_CONNECTIONS": os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS"),
+            "KEEPALIVE_EXPIRY": os.getenv("OPENAI_KEEPALIVE_EXPIRY"),
+            "MAX_CONCURRENCY": os.getenv("OPENAI_MAX_CONCURRENCY"),
+            "MIN_CONCURRENCY": os.getenv("OPENAI_MIN_CONCURRENCY"),
+            "MAX_RETRIES": os.getenv("OPENAI_MAX_RETRIES"),
+            "RETRY_BASE_DELAY": os.getenv("OPENAI_RETRY_BASE_DELAY"),
+            "RETRY_MAX_DELAY": os.getenv("OPENAI_RETRY_MAX_DELAY"),
+            "RATE_LIMIT_RPM": os.getenv("OPENAI_RATE_LIMIT_RPM"),
+            "RATE_LIMIT_TPM": os.getenv("OPENAI_RATE_LIMIT_TPM")
         }
 
         env_storage_settings = {
             "DATA_DIR": os.getenv("DATA_DIR"),
             "PROMPT_DIR": os.getenv("PROMPT_DIR"),
             "DEFAULT_PROMPT_VERSION": os.getenv("DEFAULT_PROMPT_VERSION"),
-            "CACHE_ENABLED": os.getenv("CACHE_ENABLED", "").lower() in ("true", "1", "t")
+            "PROMPT_RELOAD_INTERVAL": os.getenv("PROMPT_RELOAD_INTERVAL"),
+            "CACHE_ENABLED": _env_bool("CACHE_ENABLED"),
+            "CACHE_MAX_ITEMS": os.getenv("CACHE_MAX_ITEMS"),
+            "INDEX_PATH": os.getenv("INDEX_PATH"),
+            "DUPLICATE_MODE": os.getenv("DUPLICATE_MODE"),
+            "DUPLICATE_MAX_DISTANCE": os.getenv("DUPLICATE_MAX_DISTANCE"),
+            "DUPLICATE_MIN_SIMILARITY": os.getenv("DUPLICATE_MIN_SIMILARITY")
+        }
+
+        env_image_settings = {
+            "PROCESS_POOL_ENABLED": _env_bool("IMAGE_PROCESS_POOL_ENABLED"),
+            "PROCESS_POOL_WORKERS": os.getenv("IMAGE_PROCESS_POOL_WORKERS"),
+            "LLM_MAX_LONG_EDGE": os.getenv("LLM_IMAGE_MAX_LONG_EDGE"),
+            "LLM_MAX_PIXELS": os.getenv("LLM_IMAGE_MAX_PIXELS"),
+            "LLM_GRAYSCALE": _env_bool("LLM_IMAGE_GRAYSCALE"),
+            "LLM_JPEG_QUALITY": os.getenv("LLM_IMAGE_JPEG_QUALITY"),
+            "LLM_FORMATS": os.getenv("LLM_IMAGE_FORMATS"),
+            "LLM_IMAGE_DETAIL": os.getenv("LLM_IMAGE_DETAIL"),
+            "ORIENTATION_ASSUME_PORTRAIT_UPRIGHT": _env_bool("ORIENTATION_ASSUME_PORTRAIT_UPRIGHT"),
+            "ORIENTATION_OSD_ENABLED": _env_bool("ORIENTATION_OSD_ENABLED"),
+            "ORIENTATION_OSD_MAX_EDGE": os.getenv("ORIENTATION_OSD_MAX_EDGE"),
+            "THUMBNAIL_MAX_EDGE": os.getenv("IMAGE_THUMBNAIL_MAX_EDGE"),
+            "PREVIEW_MAX_EDGE": os.getenv("IMAGE_PREVIEW_MAX_EDGE"),
+            "VARIANT_JPEG_QUALITY": os.getenv("IMAGE_VARIANT_JPEG_QUALITY"),
+            "CACHE_MAX_AGE": os.getenv("IMAGE_CACHE_MAX_AGE"),
+            "CROP_ENABLED": _env_bool("IMAGE_CROP_ENABLED"),
+            "CROP_ANALYSIS_MAX_EDGE": os.getenv("IMAGE_CROP_ANALYSIS_MAX_EDGE"),
+            "CROP_MARGIN": os.getenv("IMAGE_CROP_MARGIN"),
+            "CROP_MIN_AREA": os.getenv("IMAGE_CROP_MIN_AREA"),
+            "CROP_MAX_AREA": os.getenv("IMAGE_CROP_MAX_AREA"),
+            "DESKEW_ENABLED": _env_bool("IMAGE_DESKEW_ENABLED"),
+            "DESKEW_MIN_ANGLE": os.getenv("IMAGE_DESKEW_MIN_ANGLE"),
+            "DESKEW_MAX_ANGLE": os.getenv("IMAGE_DESKEW_MAX_ANGLE"),
+            "DESKEW_FRAME_MIN_ANGLE": os.getenv("IMAGE_DESKEW_FRAME_MIN_ANGLE"),
+            "PDF_RENDER_DPI": os.getenv("PDF_RENDER_DPI"),
+            "PDF_MAX_PAGES": os.getenv("PDF_MAX_PAGES"),
+            "PDF_TEXT_ENABLED": _env_bool("PDF_TEXT_ENABLED"),
+            "PDF_MIN_TEXT_CHARS": os.getenv("PDF_MIN_TEXT_CHARS")
+        }
+
+        env_job_settings = {
+            "ENABLED": _env_bool("JOBS_ENABLED"),
+            "WORKERS": os.getenv("JOBS_WORKERS"),
+            "DIR": os.getenv("JOBS_DIR"),
+            "POLL_INTERVAL": os.getenv("JOBS_POLL_INTERVAL"),
+            "MAX_ATTEMPTS": os.getenv("JOBS_MAX_ATTEMPTS"),
+            "RETRY_DELAY": os.getenv("JOBS_RETRY_DELAY"),
+            "LEASE_SECONDS": os.getenv("JOBS_LEASE_SECONDS")
+        }
+
+        env_routing_settings = {
+            "BACKENDS": json.loads(os.getenv("LLM_BACKENDS")) if os.getenv("LLM_BACKENDS") else None,
+            "ESCALATION_ENABLED": _env_bool("LLM_ESCALATION_ENABLED")
         }
 
         # Usuń None z słowników, aby nie nadpisywały wartości domyślnych
         app_settings = {k: v for k, v in env_app_settings.items() if v is not None}
         openai_settings = {k: v for k, v in env_openai_settings.items() if v is not None}
         storage_settings = {k: v for k, v in env_storage_settings.items() if v is not None}
+        image_settings = {k: v for k, v in env_image_settings.items() if v is not None}
+        job_settings = {k: v for k, v in env_job_settings.items() if v is not None}
+        routing_settings = {k: v for k, v in env_routing_settings.items() if v is not None}
 
         # Utwórz strukturę danych dla BaseModel
         merged_data = {
             "app": {**(data.get("app", {}) or {}), **app_settings},
             "openai": {**(data.get("openai", {}) or {}), **openai_settings},
-            "storage": {**(data.get("storage", {}) or {}), **storage_settings}
+            "storage": {**(data.get("storage", {}) or {}), **storage_settings},
+            "image": {**(data.get("image", {}) or {}), **image_settings},
+            "jobs": {**(data.get("jobs", {}) or {}), **job_settings},
+            "routing": {**(data.get("routing", {}) or {}), **routing_settings}
         }
 
         super().__init__(**merged_data)
@@ -0,0 +1,263 @@
+import math
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from app.core.config import settings
+
+# Domyślne przedziały histogramów czasu (w sekundach) - od szybkich etapów CPU po wywołania LLM
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """Wspólna część metryk: nazwa, opis, etykiety i blokada"""
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Licznik rosnący (np. liczba tokenów lub błędów)"""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Gauge(Metric):
+    """Wartość chwilowa (np. liczba przetwarzanych właśnie żądań)"""
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    @contextmanager
+    def track_inprogress(self, **labels: str) -> Iterator[None]:
+        """Zwiększa wartość na czas wykonania bloku"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Histogram(Metric):
+    """Histogram czasu trwania z przedziałami skumulowanymi w formacie Prometheus"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Dla każdej kombinacji etykiet: liczniki przedziałów (nieskumulowane) i suma obserwacji
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * len(self.buckets), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Mierzy czas wykonania bloku (również zakończonego wyjątkiem)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = {key: (list(counts), total[0]) for key, (counts, total) in self._values.items()}
+
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Rejestr metryk aplikacji eksportowanych w formacie tekstowym Prometheus"""
+
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+# Współdzielony rejestr metryk dla całej aplikacji
+registry = MetricsRegistry()
+
+HTTP_REQUEST_DURATION = registry.register(Histogram(
+    "paragon_http_request_duration_seconds",
+    "Czas obsługi żądań HTTP",
+    ["method", "route", "status"],
+))
+HTTP_REQUESTS_IN_FLIGHT = registry.register(Gauge(
+    "paragon_http_requests_in_flight",
+    "Liczba obsługiwanych właśnie żądań HTTP",
+))
+OCR_STAGE_DURATION = registry.register(Histogram(
+    "paragon_ocr_stage_duration_seconds",
+    "Czas trwania etapów przetwarzania paragonu",
+    ["stage"],
+))
+IMAGE_CROP_PIXEL_RATIO = registry.register(Histogram(
+    "paragon_image_crop_pixel_ratio",
+    "Udział pikseli zdjęcia zachowanych po kadrowaniu do obszaru paragonu",
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+))
+OCR_IN_FLIGHT = registry.register(Gauge(
+    "paragon_ocr_in_flight",
+    "Liczba paragonów na danym etapie przetwarzania",
+    ["stage"],
+))
+OCR_REQUESTS = registry.register(Counter(
+    "paragon_ocr_requests_total",
+    "Liczba żądań OCR paragonu",
+    ["prompt_version", "model"],
+))
+OCR_CACHE_HITS = registry.register(Counter(
+    "paragon_ocr_cache_hits_total",
+    "Liczba żądań OCR obsłużonych z cache",
+    ["prompt_version", "model"],
+))
+OCR_NEAR_DUPLICATES = registry.register(Counter(
+    "paragon_ocr_near_duplicates_total",
+    "Liczba obrazów rozpoznanych jako podobne do wcześniej przetworzonego paragonu",
+    ["action"],
+))
+OCR_ESCALATIONS = registry.register(Counter(
+    "paragon_ocr_escalations_total",
+    "Liczba ponowień OCR silniejszym backendem LLM po nieudanej walidacji wyniku",
+    ["backend", "reason"],
+))
+OCR_ERRORS = registry.register(Counter(
+    "paragon_ocr_errors_total",
+    "Liczba żądań OCR zakończonych błędem",
+    ["prompt_version", "model", "error"],
+))
+LLM_TOKENS = registry.register(Counter(
+    "paragon_llm_tokens_total",
+    "Liczba tokenów zużytych przez wywołania LLM",
+    ["prompt_version", "model", "direction"],
+))
+
+LLM_RETRIES = registry.register(Counter(
+    "paragon_llm_retries_total",
+    "Liczba ponowień wywołań LLM według przyczyny",
+    ["reason"],
+))
+LLM_CONCURRENCY_LIMIT = registry.register(Gauge(
+    "paragon_llm_concurrency_limit",
+    "Bieżący adaptacyjny limit równoległych wywołań LLM",
+    ["backend"],
+))
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    """Zapisuje czas etapu przetwarzania zmierzony poza procesem głównym (np. w puli procesów)"""
+    if settings.app.METRICS_ENABLED:
+        OCR_STAGE_DURATION.observe(seconds, stage=stage)
+
+
+@contextmanager
+def track_stage(stage: str) -> Iterator[None]:
+    """Mierzy czas etapu przetwarzania paragonu i liczbę paragonów na tym etapie"""
+    if not settings.app.METRICS_ENABLED:
+        yield
+        return
+
+    with OCR_IN_FLIGHT.track_inprogress(stage=stage), OCR_STAGE_DURATION.time(stage=stage):
+        yield
@@ -5,13 +5,22 @@ from typing import Any, Dict
 
 from fastapi import FastAPI, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.exceptions import RequestValidationError
 from fastapi.exception_handlers import http_exception_handler
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
 from app.api.router import api_router
 from app.core.config import settings
+from app.core import metrics
+from app.services.llm import init_llm_client, close_llm_client
+from app.services.index import receipt_index
+from app.services.analytics import analytics_store
+from app.services.duplicates import duplicate_index
+from app.services.prompts import prompt_registry
+from app.services.storage import ensure_receipt_index
+from app.services.jobs import start_job_workers, stop_job_workers
+from app.utils.image import init_image_executor, shutdown_image_executor
 
 # Konfiguracja logowania
 logging.basicConfig(
@@ -40,14 +49,36 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],  # Kursor paginacji historii paragonów
 )
 
 # Middleware do logowania czasu odpowiedzi
 @app.middleware("http")
 async def add_process_time_header(request: Request, call_next):
     start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
+    if not settings.app.METRICS_ENABLED:
+        response = await call_next(request)
+        response.headers["X-Process-Time"] = str(time.time() - start_time)
+        return response
+
+    status_code = 500
+    metrics.HTTP_REQUESTS_IN_FLIGHT.inc()
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        metrics.HTTP_REQUESTS_IN_FLIGHT.dec()
+        process_time = time.time() - start_time
+
+        # Szablon ścieżki zamiast ścieżki z parametrami ogranicza liczbę serii metryk
+        route = request.scope.get("route")
+        metrics.HTTP_REQUEST_DURATION.observe(
+            process_time,
+            method=request.method,
+            route=route.path if route is not None else "unmatched",
+            status=str(status_code),
+        )
+
     response.headers["X-Process-Time"] = str(process_time)
     return response
 
@@ -92,14 +123,35 @@ def health_check() -> Dict[str, Any]:
         "version": settings.app.VERSION,
         "environment": "development" if settings.app.DEBUG else "production",
         "openai_api_configured": bool(settings.openai.API_KEY),
-        "available_prompt_versions": settings.get_all_prompt_versions(),
+        "available_prompt_versions": prompt_registry.versions(),
         "default_prompt_version": settings.storage.DEFAULT_PROMPT_VERSION,
     }
 
+@app.get("/metrics", include_in_schema=False)
+def metrics_endpoint() -> PlainTextResponse:
+    """Metryki aplikacji w formacie tekstowym Prometheus"""
+    if not settings.app.METRICS_ENABLED:
+        return PlainTextResponse("Metryki są wyłączone\n", status_code=status.HTTP_404_NOT_FOUND)
+
+    return PlainTextResponse(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
 # Logger startowy
 @app.on_event("startup")
 async def startup_event():
     logger.info(f"Uruchomiono aplikację {settings.app.PROJECT_NAME} v{settings.app.VERSION}")
     logger.info(f"Model LLM: {settings.openai.DEFAULT_MODEL}")
     logger.info(f"Domyślna wersja promptu: {settings.storage.DEFAULT_PROMPT_VERSION}")
-    logger.info(f"Dostępne wersje promptów: {settings.get_all_prompt_versions()}")
+    logger.info(f"Dostępne wersje promptów: {prompt_registry.versions()}")
+    ensure_receipt_index()
+    analytics_store.load()
+    duplicate_index.load()
+    init_llm_client()
+    init_image_executor()
+    start_job_workers()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await stop_job_workers()
+    await close_llm_client()
+    shutdown_image_executor()
+    receipt_index.close()
@@ -0,0 +1,19 @@
+from pydantic import BaseModel
+from typing import Dict, List, Optional
+
+
+class AnalyticsRow(BaseModel):
+    """Model grupy wyników analizy wydatków"""
+    group: Dict[str, str]
+    receipts: int
+    amount: Optional[float] = None
+    items: Optional[int] = None
+    sales: Optional[float] = None
+    tax: Optional[float] = None
+
+
+class AnalyticsResponse(BaseModel):
+    """Model odpowiedzi z wynikami analizy wydatków"""
+    group_by: List[str]
+    groups: int
+    rows: List[AnalyticsRow]
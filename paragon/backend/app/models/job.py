@@ -0,0 +1,16 @@
+from pydantic import BaseModel
+from typing import Optional
+
+from app.models.receipt import OCRResponse
+
+
+class JobResponse(BaseModel):
+    """Model odpowiedzi z API dla zadania OCR"""
+    job_id: str
+    status: str
+    filename: Optional[str] = None
+    file_hash: str
+    created_at: str
+    updated_at: str
+    result: Optional[OCRResponse] = None
+    error: Optional[str] = None
@@ -0,0 +1,23 @@
+from pydantic import BaseModel
+from typing import List
+
+
+class PromptInfo(BaseModel):
+    """Model informacji o wersji promptu OCR"""
+    version: str
+    fingerprint: str
+    path: str
+    mtime: float
+
+
+class PromptListResponse(BaseModel):
+    """Model odpowiedzi z listą wczytanych promptów OCR"""
+    default_version: str
+    prompts: List[PromptInfo]
+
+
+class PromptReloadResponse(BaseModel):
+    """Model odpowiedzi z wynikiem przeładowania promptów OCR"""
+    loaded: List[str]
+    removed: List[str]
+    prompts: List[PromptInfo]
@@ -27,6 +27,13 @@ class OCRResult(BaseModel):
     ocr_prompt_version: str
 
 
+class NearDuplicate(BaseModel):
+    """Model informacji o wcześniej przetworzonym paragonie o podobnym obrazie"""
+    file_hash: str
+    distance: int
+    similarity: Optional[float] = None
+
+
 class OCRResponse(BaseModel):
     """Model odpowiedzi z API"""
     file_hash: str
@@ -37,3 +44,36 @@ class OCRResponse(BaseModel):
     tokens_in: int
     tokens_out: int
     ocr_prompt_version: str
+    cached: bool = False
+    near_duplicate: Optional[NearDuplicate] = None
+
+
+class BatchOCRItem(BaseModel):
+    """Model wyniku OCR dla pojedynczego pliku z przetwarzania wsadowego"""
+    filename: str
+    file_hash: Optional[str] = None
+    duplicate: bool = False
+    result: Optional[OCRResponse] = None
+    error: Optional[str] = None
+
+
+class BatchOCRResponse(BaseModel):
+    """Model odpowiedzi z API dla przetwarzania wsadowego"""
+    items: List[BatchOCRItem]
+    processed: int
+    failed: int
+
+
+class SearchHit(BaseModel):
+    """Model paragonu znalezionego w wyszukiwaniu pełnotekstowym"""
+    file_hash: str
+    score: float
+    metadata: dict
+    lines: List[OCRLine]
+
+
+class SearchResponse(BaseModel):
+    """Model odpowiedzi wyszukiwania pełnotekstowego"""
+    query: str
+    total: int
+    items: List[SearchHit]
@@ -0,0 +1,372 @@
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from app.services.index import receipt_index
+
+logger = logging.getLogger(__name__)
+
+# Wymiary grupowania: okresy (z daty paragonu) i kolumny kategorii
+PERIODS = ("day", "month", "year")
+DIMENSIONS = PERIODS + ("company", "product", "vat_class")
+
+# Maksymalna liczba kombinacji kluczy, dla której grupowanie odbywa się przez zliczanie (bez sortowania)
+DENSE_GROUPS_LIMIT = 1 << 22
+
+# Unieważnione wiersze paragonów są usuwane, gdy jest ich co najmniej tyle i stanowią taką część tabeli
+COMPACT_MIN_INVALID = 1024
+COMPACT_INVALID_RATIO = 0.25
+
+
+class Dictionary:
+    """Słownik kodujący wartości tekstowe kolumny jako kolejne liczby całkowite"""
+
+    def __init__(self):
+        self.labels: List[str] = []
+        self._codes: Dict[str, int] = {}
+
+    def encode(self, value: Optional[str]) -> int:
+        """Zwraca kod wartości (wartości różniące się wielkością liter mają ten sam kod)"""
+        label = value or ""
+        key = label.casefold()
+        code = self._codes.get(key)
+        if code is None:
+            code = self._codes[key] = len(self.labels)
+            self.labels.append(label)
+        return code
+
+    def matching(self, fragment: str) -> np.ndarray:
+        """Zwraca kody wartości zawierających podany fragment (bez rozróżniania wielkości liter)"""
+        fragment = fragment.casefold()
+        return np.array([code for key, code in self._codes.items() if fragment in key], dtype=np.int32)
+
+    def exact(self, value: str) -> np.ndarray:
+        code = self._codes.get(value.casefold())
+        return np.array([] if code is None else [code], dtype=np.int32)
+
+
+class ColumnTable:
+    """Tabela kolumnowa z tablic NumPy powiększanych przy dopisywaniu wierszy"""
+
+    def __init__(self, columns: Dict[str, Any], capacity: int = 1024):
+        self.size = 0
+        self._columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in columns.items()}
+
+    def append(self, **values: Any) -> int:
+        """Dopisuje wiersz i zwraca jego numer"""
+        if self.size == len(next(iter(self._columns.values()))):
+            for name, column in self._columns.items():
+                grown = np.zeros(len(column) * 2, dtype=column.dtype)
+                grown[:self.size] = column[:self.size]
+                self._columns[name] = grown
+
+        for name, value in values.items():
+            self._columns[name][self.size] = value
+        self.size += 1
+        return self.size - 1
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self._columns[name][:self.size]
+
+    def keep(self, mask: np.ndarray) -> None:
+        """Pozostawia tylko wiersze wskazane maską (z zachowaniem kolejności)"""
+        kept = int(np.count_nonzero(mask))
+        for column in self._columns.values():
+            column[:kept] = column[:self.size][mask]
+        self.size = kept
+
+
+def format_period(period: str, value: int) -> str:
+    """Zamienia klucz okresu (YYYYMMDD, YYYYMM lub YYYY) na etykietę ISO"""
+    if period == "day":
+        return f"{value // 10000:04d}-{value // 100 % 100:02d}-{value % 100:02d}"
+    if period == "month":
+        return f"{value // 100:04d}-{value % 100:02d}"
+    return f"{value:04d}"
+
+
+def receipt_date_key(receipt_date: Optional[str]) -> int:
+    """Zamienia datę paragonu (YYYYMMDD) na liczbę całkowitą (0 dla nieprawidłowej daty)"""
+    try:
+        return int(receipt_date)
+    except (TypeError, ValueError):
+        return 0
+
+
+class AnalyticsStore:
+    """
+    Kolumnowe agregaty wydatków w pamięci (tablice NumPy).
+
+    Tabele paragonów, pozycji zakupów (linie P/PC) i stawek VAT (linie S) są
+    wczytywane z indeksu paragonów przy starcie i uzupełniane przy każdym zapisie
+    paragonu, więc zapytania nie odczytują plików OCR. Ponowny zapis paragonu
+    unieważnia jego poprzednie wiersze, które są usuwane, gdy zajmują znaczną część
+    tabel (lub przy ponownym wczytaniu). Zmiana indeksu przez inny proces
+    (np. `python -m app.services.index rebuild`) powoduje ponowne wczytanie.
+    """
+
+    def __init__(self):
+        # Blokada wielowejściowa - zapytanie może wczytać agregaty ponownie
+        self._lock = threading.RLock()
+        self._data_version: Optional[int] = None
+        self._reset()
+
+    def _reset(self) -> None:
+        self.companies = Dictionary()
+        self.products = Dictionary()
+        self.vat_classes = Dictionary()
+        self.receipts = ColumnTable({"date": np.int32, "company": np.int32, "total": np.float64, "valid": np.bool_})
+        self.items = ColumnTable({"receipt": np.int32, "product": np.int32, "vat_class": np.int32, "amount": np.float64})
+        self.vat = ColumnTable({"receipt": np.int32, "vat_class": np.int32, "sales": np.float64, "tax": np.float64})
+        self._rows: Dict[str, int] = {}
+        self._invalid = 0
+
+    def _add(self, file_hash: str, receipt_date: Optional[str], company: Optional[str], total: Optional[float]) -> int:
+        previous = self._rows.get(file_hash)
+        if previous is not None:
+            self.receipts["valid"][previous] = False
+            self._invalid += 1
+
+        row = self.receipts.append(
+            date=receipt_date_key(receipt_date),
+            company=self.companies.encode(company),
+            total=np.nan if total is None else total,
+            valid=True,
+        )
+        self._rows[file_hash] = row
+        return row
+
+    def _add_item(self, row: int, product: str, vat_class: Optional[str], amount: float) -> None:
+        self.items.append(
+            receipt=row,
+            product=self.products.encode(product),
+            vat_class=self.vat_classes.encode(vat_class),
+            amount=amount,
+        )
+
+    def _add_vat(self, row: int, vat_class: str, sales: Optional[float], tax: Optional[float]) -> None:
+        self.vat.append(
+            receipt=row,
+            vat_class=self.vat_classes.encode(vat_class),
+            sales=np.nan if sales is None else sales,
+            tax=np.nan if tax is None else tax,
+        )
+
+    def load(self) -> None:
+        """Wczytuje agregaty z indeksu paragonów"""
+        with self._lock:
+            self._data_version = receipt_index.data_version()
+            data = receipt_index.analytics_rows()
+
+            self._reset()
+            for file_hash, receipt_date, company, total in data["receipts"]:
+                self._add(file_hash, receipt_date, company, total)
+            for file_hash, product, vat_class, amount in data["items"]:
+                if file_hash in self._rows:
+                    self._add_item(self._rows[file_hash], product, vat_class, amount)
+            for file_hash, vat_class, sales, tax in data["vat"]:
+                if file_hash in self._rows:
+                    self._add_vat(self._rows[file_hash], vat_class, sales, tax)
+
+        logger.info(
+            f"Wczytano dane analityczne: {len(self._rows)} paragonów, {self.items.size} pozycji, {self.vat.size} stawek VAT"
+        )
+
+    def add_receipt(self, metadata: Dict[str, Any], total: Optional[float], facts: Dict[str, List[tuple]]) -> None:
+        """Dopisuje (lub zastępuje) paragon zapisany przez aplikację"""
+        with self._lock:
+            if self._data_version is None:
+                # Agregaty nie zostały jeszcze wczytane - paragon trafi do nich przy wczytaniu z indeksu
+                return
+
+            row = self._add(metadata["file_hash"], metadata.get("receipt_date"), metadata.get("check_company"), total)
+            for _, product, vat_class, amount in facts.get("items", []):
+                self._add_item(row, product, vat_class, amount)
+            for vat_class, sales, tax in facts.get("vat", []):
+                self._add_vat(row, vat_class, sales, tax)
+
+            if self._invalid >= max(COMPACT_MIN_INVALID, self.receipts.size * COMPACT_INVALID_RATIO):
+                self.compact()
+
+    def compact(self) -> None:
+        """Usuwa unieważnione wiersze paragonów wraz z ich pozycjami i stawkami VAT"""
+        with self._lock:
+            valid = self.receipts["valid"].copy()
+            # Nowy numer każdego zachowanego wiersza paragonu
+            renumbered = np.cumsum(valid) - 1
+
+            for table in (self.items, self.vat):
+                table.keep(valid[table["receipt"]])
+                table["receipt"][:] = renumbered[table["receipt"]]
+            self.receipts.keep(valid)
+
+            self._rows = {file_hash: int(renumbered[row]) for file_hash, row in self._rows.items()}
+            removed, self._invalid = self._invalid, 0
+
+        logger.debug(f"Usunięto {removed} unieważnionych wierszy danych analitycznych")
+
+    def _ensure_current(self) -> None:
+        if self._data_version is None or receipt_index.data_version() != self._data_version:
+            self.load()
+
+    def _label_ranks(self, name: str) -> np.ndarray:
+        """Zwraca pozycję każdego kodu słownika wymiaru w kolejności alfabetycznej etykiet"""
+        dictionary = {"company": self.companies, "product": self.products, "vat_class": self.vat_classes}[name]
+        order = sorted(range(len(dictionary.labels)), key=lambda code: dictionary.labels[code].casefold())
+        ranks = np.empty(len(order), dtype=np.int64)
+        ranks[order] = np.arange(len(order))
+        return ranks
+
+    def _dimension(self, name: str, table: ColumnTable, dates: np.ndarray, companies: np.ndarray) -> tuple:
+        """Zwraca kody wymiaru dla wierszy tabeli oraz funkcję zamieniającą kod na etykietę"""
+        if name in PERIODS:
+            divisor = {"day": 1, "month": 100, "year": 10000}[name]
+            values = dates // divisor
+            offset = int(values.min()) if len(values) else 0
+            return values - offset, lambda code: format_period(name, int(code) + offset)
+        if name == "company":
+            return companies, lambda code: self.companies.labels[code]
+        if name == "product":
+            return table["product"], lambda code: self.products.labels[code]
+        return table["vat_class"], lambda code: self.vat_classes.labels[code]
+
+    def query(
+            self,
+            dataset: str,
+            group_by: Sequence[str],
+            date_from: Optional[str] = None,
+            date_to: Optional[str] = None,
+            company: Optional[str] = None,
+            product: Optional[str] = None,
+            vat_class: Optional[str] = None,
+            order_by: str = "key",
+            limit: int = 100,
+    ) -> Dict[str, Any]:
+        """
+        Grupuje wydatki według wymiarów.
+
+        Zbiór `spend` sumuje kwoty paragonów (TOTAL), a jeśli grupowanie lub filtr
+        dotyczy produktu lub stawki VAT - kwoty pozycji zakupów. Zbiór `vat` sumuje
+        sprzedaż opodatkowaną i podatek PTU z podsumowania paragonu.
+
+        Args:
+            dataset: Zbiór danych (`spend` lub `vat`).
+            group_by: Wymiary grupowania (`day`, `month`, `year`, `company`, `product`, `vat_class`).
+            date_from: Najwcześniejsza data paragonu (YYYYMMDD, włącznie).
+            date_to: Najpóźniejsza data paragonu (YYYYMMDD, włącznie).
+            company: Fragment nazwy sprzedawcy.
+            product: Fragment nazwy produktu.
+            vat_class: Litera stawki VAT.
+            order_by: Kolejność grup (`key` - według kluczy, `amount` - od największej kwoty).
+            limit: Maksymalna liczba grup.
+
+        Returns:
+            Słownik z listą grup (`rows`) i łączną liczbą grup (`groups`).
+
+        Raises:
+            ValueError: Jeśli wymiar lub filtr nie pasuje do zbioru danych.
+        """
+        unknown = set(group_by) - set(DIMENSIONS)
+        if unknown:
+            raise ValueError(f"Nieobsługiwane wymiary grupowania: {', '.join(sorted(unknown))}")
+        if sum(name in PERIODS for name in group_by) > 1:
+            raise ValueError("Można grupować tylko według jednego okresu (day, month lub year)")
+        if dataset == "vat" and ("product" in group_by or product):
+            raise ValueError("Podsumowanie stawek VAT nie zawiera produktów")
+
+        with self._lock:
+            self._ensure_current()
+
+            item_level = dataset == "vat" or "product" in group_by or "vat_class" in group_by or product or vat_class
+            if item_level:
+                table = self.vat if dataset == "vat" else self.items
+                receipt_rows = table["receipt"]
+            else:
+                table = self.receipts
+                receipt_rows = np.arange(table.size)
+
+            # Kolumny paragonu dla wierszy tabeli
+            dates = self.receipts["date"][receipt_rows]
+            companies = self.receipts["company"][receipt_rows]
+
+            mask = self.receipts["valid"][receipt_rows]
+            if date_from:
+                mask &= dates >= int(date_from)
+            if date_to:
+                mask &= dates <= int(date_to)
+            if company:
+                mask &= np.isin(companies, self.companies.matching(company))
+            if product:
+                mask &= np.isin(table["product"], self.products.matching(product))
+            if vat_class:
+                mask &= np.isin(table["vat_class"], self.vat_classes.exact(vat_class))
+
+            dimensions = [self._dimension(name, table, dates, companies) for name in group_by]
+            codes = [values[mask].astype(np.int64) for values, _ in dimensions]
+            receipt_rows = receipt_rows[mask]
+
+            # Jeden klucz całkowity dla kombinacji wymiarów
+            sizes = [int(values.max()) + 1 if len(values) else 1 for values in codes]
+            if not codes:
+                inverse = np.zeros(len(receipt_rows), dtype=np.int64)
+                groups = 1 if len(receipt_rows) else 0
+                group_codes = []
+            elif np.prod(sizes, dtype=np.float64) <= DENSE_GROUPS_LIMIT:
+                keys = np.ravel_multi_index(codes, sizes)
+                group_keys = np.flatnonzero(np.bincount(keys, minlength=1))
+                inverse = np.searchsorted(group_keys, keys)
+                groups = len(group_keys)
+                group_codes = list(np.unravel_index(group_keys, sizes))
+            else:
+                unique, inverse = np.unique(np.stack(codes, axis=1), axis=0, return_inverse=True)
+                inverse = inverse.reshape(-1)
+                groups = len(unique)
+                group_codes = list(unique.T)
+
+            def group_sum(column: str) -> np.ndarray:
+                return np.bincount(inverse, weights=np.nan_to_num(table[column][mask]), minlength=groups)
+
+            # Liczba różnych paragonów w grupie (wiersz tabeli paragonów to zawsze osobny paragon)
+            if item_level:
+                pairs = np.unique(inverse * self.receipts.size + receipt_rows)
+                result = {"receipts": np.bincount(pairs // max(1, self.receipts.size), minlength=groups)}
+            else:
+                result = {"receipts": np.bincount(inverse, minlength=groups)}
+            if dataset == "vat":
+                result["sales"] = group_sum("sales")
+                result["tax"] = group_sum("tax")
+                amounts = result["sales"]
+            elif item_level:
+                result["amount"] = amounts = group_sum("amount")
+                result["items"] = np.bincount(inverse, minlength=groups)
+            else:
+                result["amount"] = amounts = group_sum("total")
+
+            if order_by == "amount":
+                order = np.argsort(-amounts, kind="stable")
+            else:
+                # Kolejność według etykiet (okresy chronologicznie, nazwy alfabetycznie)
+                ranks = [
+                    self._label_ranks(name)[group_codes[position]] if name not in PERIODS else group_codes[position]
+                    for position, name in enumerate(group_by)
+                ]
+                order = np.lexsort(ranks[::-1]) if ranks else np.arange(groups)
+            rows = []
+            for index in order[:limit]:
+                row = {
+                    "group": {
+                        name: dimensions[position][1](group_codes[position][index])
+                        for position, name in enumerate(group_by)
+                    },
+                }
+                for name, values in result.items():
+                    row[name] = int(values[index]) if name in ("receipts", "items") else round(float(values[index]), 2)
+                rows.append(row)
+
+        return {"groups": groups, "rows": rows}
+
+
+# Współdzielona instancja agregatów dla całej aplikacji
+analytics_store = AnalyticsStore()
@@ -0,0 +1,57 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+from app.core.config import settings
+
+
+class OCRResultCache:
+    """
+    Ograniczony rozmiarem cache LRU wyników OCR w pamięci.
+
+    Kluczem jest krotka (hash pliku, wersja promptu, odcisk treści promptu),
+    więc ten sam obraz przetworzony inną wersją lub zmienioną treścią promptu
+    nie trafia w cache.
+    """
+
+    def __init__(self, max_items: int = 1024):
+        self.max_items = max_items
+        self._items: "OrderedDict[Hashable, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Dict[str, Any]]:
+        """Zwraca kopię zapisanego wyniku lub None, jeśli klucza nie ma w cache"""
+        with self._lock:
+            result = self._items.get(key)
+            if result is None:
+                return None
+            self._items.move_to_end(key)
+            return dict(result)
+
+    def set(self, key: Hashable, result: Dict[str, Any]) -> None:
+        """Zapisuje wynik i usuwa najdawniej używane wpisy po przekroczeniu limitu"""
+        if self.max_items <= 0:
+            return
+
+        with self._lock:
+            self._items[key] = dict(result)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        """Usuwa wpis z cache"""
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self) -> None:
+        """Czyści cały cache"""
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+# Współdzielona instancja cache dla całej aplikacji
+ocr_cache = OCRResultCache(max_items=settings.storage.CACHE_MAX_ITEMS)
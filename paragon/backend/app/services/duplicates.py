@@ -0,0 +1,132 @@
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from app.services.index import receipt_index
+
+logger = logging.getLogger(__name__)
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """Zwraca liczbę różniących się bitów dwóch skrótów"""
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """
+    Drzewo BK dla metryki Hamminga.
+
+    Każdy węzeł przechowuje skrót i hasze paragonów o tym skrócie, a dzieci są
+    indeksowane odległością od skrótu węzła. Przy wyszukiwaniu z promieniem `r`
+    nierówność trójkąta pozwala odwiedzać tylko dzieci w odległości d-r..d+r,
+    więc zapytanie nie porównuje skrótu ze wszystkimi zapisanymi obrazami.
+    """
+
+    def __init__(self):
+        # Węzeł: [skrót, lista haszy paragonów, dzieci {odległość: węzeł}]
+        self._root: Optional[list] = None
+        self.size = 0
+
+    def add(self, value: int, file_hash: str) -> None:
+        """Dodaje skrót obrazu paragonu"""
+        self.size += 1
+        if self._root is None:
+            self._root = [value, [file_hash], {}]
+            return
+
+        node = self._root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(file_hash)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [file_hash], {}]
+                return
+            node = child
+
+    def find(self, value: int, max_distance: int) -> List[Tuple[int, str, int]]:
+        """
+        Wyszukuje skróty w odległości co najwyżej `max_distance`.
+
+        Returns:
+            Trójki (odległość, hash paragonu, skrót) posortowane od najbardziej podobnych.
+        """
+        matches = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                matches.extend((distance, file_hash, node[0]) for file_hash in node[1])
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return sorted(matches)
+
+
+class DuplicateIndex:
+    """
+    Indeks skrótów percepcyjnych obrazów paragonów w pamięci (drzewo BK).
+
+    Skróty są wczytywane z indeksu paragonów przy starcie i dopisywane przy każdym
+    zapisie paragonu. Zmiana indeksu przez inny proces (np. `python -m app.services.index rebuild`)
+    powoduje ponowne wczytanie. Drzewo nie obsługuje usuwania - wpisy nieaktualne
+    (paragon zapisany ponownie z innym skrótem) są pomijane przy wyszukiwaniu.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._data_version: Optional[int] = None
+        self._tree = BKTree()
+        self._hashes: Dict[str, int] = {}
+
+    def load(self) -> None:
+        """Wczytuje skróty z indeksu paragonów"""
+        with self._lock:
+            self._data_version = receipt_index.data_version()
+            self._tree = BKTree()
+            self._hashes = {}
+            for file_hash, image_hash in receipt_index.image_hashes():
+                self._add(file_hash, image_hash)
+
+        logger.info(f"Wczytano skróty obrazów paragonów: {len(self._hashes)}")
+
+    def _add(self, file_hash: str, image_hash: str) -> None:
+        value = int(image_hash, 16)
+        if self._hashes.get(file_hash) == value:
+            return
+        self._hashes[file_hash] = value
+        self._tree.add(value, file_hash)
+
+    def add(self, file_hash: str, image_hash: Optional[str]) -> None:
+        """Dopisuje skrót obrazu paragonu zapisanego przez aplikację"""
+        if not image_hash:
+            return
+        with self._lock:
+            if self._data_version is None:
+                # Indeks nie został jeszcze wczytany - skrót trafi do niego przy wczytaniu
+                return
+            self._add(file_hash, image_hash)
+
+    def find(self, image_hash: str, max_distance: int) -> List[Tuple[int, str]]:
+        """
+        Wyszukuje paragony o obrazach podobnych do obrazu o podanym skrócie.
+
+        Returns:
+            Pary (odległość Hamminga, hash paragonu) posortowane od najbardziej podobnych.
+        """
+        value = int(image_hash, 16)
+        with self._lock:
+            if self._data_version is None or receipt_index.data_version() != self._data_version:
+                self.load()
+            return [
+                (distance, file_hash)
+                for distance, file_hash, stored in self._tree.find(value, max_distance)
+                if self._hashes.get(file_hash) == stored
+            ]
+
+
+# Współdzielona instancja indeksu skrótów dla całej aplikacji
+duplicate_index = DuplicateIndex()
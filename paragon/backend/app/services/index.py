@@ -0,0 +1,481 @@
+import os
+import re
+import json
+import base64
+import sqlite3
+import logging
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from app.core.config import settings
+from app.utils.parser import parse_amount
+
+logger = logging.getLogger(__name__)
+
+# Zmiana schematu wymusza przebudowę indeksu z plików w DATA_DIR
+SCHEMA_VERSION = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS receipts (
+    file_hash TEXT PRIMARY KEY,
+    receipt_date TEXT NOT NULL,
+    prompt_version TEXT,
+    created_at TEXT NOT NULL,
+    check_company TEXT,
+    company_key TEXT,
+    check_total TEXT,
+    total_amount REAL,
+    image_hash TEXT,
+    metadata_mtime REAL,
+    metadata TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_receipts_created_at ON receipts (created_at, file_hash);
+CREATE INDEX IF NOT EXISTS idx_receipts_receipt_date ON receipts (receipt_date, file_hash);
+CREATE INDEX IF NOT EXISTS idx_receipts_prompt_created_at ON receipts (prompt_version, created_at, file_hash);
+CREATE INDEX IF NOT EXISTS idx_receipts_total_amount ON receipts (total_amount);
+CREATE INDEX IF NOT EXISTS idx_receipts_company_key ON receipts (company_key, created_at, file_hash);
+CREATE TABLE IF NOT EXISTS receipt_items (
+    file_hash TEXT NOT NULL,
+    line_number INTEGER NOT NULL,
+    product TEXT NOT NULL,
+    vat_class TEXT,
+    amount REAL NOT NULL,
+    PRIMARY KEY (file_hash, line_number)
+);
+CREATE TABLE IF NOT EXISTS receipt_vat (
+    file_hash TEXT NOT NULL,
+    vat_class TEXT NOT NULL,
+    sales REAL,
+    tax REAL,
+    PRIMARY KEY (file_hash, vat_class)
+);
+CREATE TABLE IF NOT EXISTS receipt_lines (
+    id INTEGER PRIMARY KEY,
+    file_hash TEXT NOT NULL,
+    line_number INTEGER NOT NULL,
+    category TEXT,
+    content TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_receipt_lines_file_hash ON receipt_lines (file_hash);
+CREATE VIRTUAL TABLE IF NOT EXISTS receipt_lines_fts USING fts5(
+    content,
+    content='receipt_lines',
+    content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS receipt_lines_insert AFTER INSERT ON receipt_lines BEGIN
+    INSERT INTO receipt_lines_fts (rowid, content) VALUES (new.id, replace(replace(new.content, 'ł', 'l'), 'Ł', 'L'));
+END;
+CREATE TRIGGER IF NOT EXISTS receipt_lines_delete AFTER DELETE ON receipt_lines BEGIN
+    INSERT INTO receipt_lines_fts (receipt_lines_fts, rowid, content)
+    VALUES ('delete', old.id, replace(replace(old.content, 'ł', 'l'), 'Ł', 'L'));
+END;
+"""
+
+# Znak większy od każdego innego - górna granica zakresu kluczy sprzedawcy o danym prefiksie
+COMPANY_PREFIX_END = "\U0010ffff"
+
+# Tabele z danymi paragonu (usuwane razem z wpisem paragonu)
+RECEIPT_TABLES = ("receipts", "receipt_items", "receipt_vat", "receipt_lines")
+
+COLUMNS = (
+    "file_hash", "receipt_date", "prompt_version", "created_at", "check_company",
+    "company_key", "check_total", "total_amount", "image_hash", "metadata_mtime", "metadata",
+)
+UPSERT_SQL = f"INSERT OR REPLACE INTO receipts ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+
+# Dozwolone klucze sortowania historii (kolumny z indeksem)
+SORT_FIELDS = ("created_at", "receipt_date")
+
+
+def build_search_query(text: str) -> str:
+    """
+    Zamienia tekst wyszukiwania na zapytanie FTS5 (wszystkie słowa, dopasowanie prefiksów).
+
+    Tokenizator `unicode61` usuwa znaki diakrytyczne poza literą "ł", która jest
+    zamieniana na "l" zarówno w indeksie, jak i w zapytaniu.
+
+    Raises:
+        ValueError: Jeśli tekst nie zawiera żadnego słowa.
+    """
+    words = re.findall(r"\w+", text.replace("ł", "l").replace("Ł", "L"))
+    if not words:
+        raise ValueError("Zapytanie nie zawiera słów do wyszukania")
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def encode_cursor(sort: str, descending: bool, key: Tuple[str, str]) -> str:
+    """Koduje pozycję ostatniego zwróconego paragonu jako nieprzezroczysty kursor"""
+    payload = json.dumps({"sort": sort, "desc": descending, "key": list(key)}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str, descending: bool) -> Tuple[str, str]:
+    """
+    Odczytuje kursor paginacji.
+
+    Raises:
+        ValueError: Jeśli kursor jest uszkodzony lub dotyczy innego sortowania.
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        key = payload["key"]
+        if not (isinstance(key, list) and len(key) == 2 and all(isinstance(value, str) for value in key)):
+            raise ValueError
+    except Exception:
+        raise ValueError("Nieprawidłowy kursor paginacji") from None
+
+    if payload.get("sort") != sort or payload.get("desc") != descending:
+        raise ValueError("Kursor dotyczy innego sortowania")
+
+    return key[0], key[1]
+
+
+class ReceiptIndex:
+    """
+    Indeks metadanych paragonów w SQLite (tryb WAL).
+
+    Indeks jest aktualizowany przy każdym zapisie paragonu i zastępuje
+    przeszukiwanie katalogów w DATA_DIR przy odczycie historii i szczegółów.
+    Pliki `*_metadata.json` pozostają źródłem prawdy - indeks można w każdej
+    chwili odbudować poleceniem `python -m app.services.index rebuild`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.created = False
+
+    def _connect(self) -> sqlite3.Connection:
+        """Otwiera połączenie i tworzy schemat przy pierwszym użyciu"""
+        if self._connection is not None:
+            return self._connection
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.created = not os.path.exists(self.path)
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+
+        user_version = connection.execute("PRAGMA user_version").fetchone()[0]
+        if user_version != SCHEMA_VERSION:
+            if user_version:
+                logger.info(f"Zmiana schematu indeksu paragonów ({user_version} -> {SCHEMA_VERSION}), indeks zostanie odbudowany")
+            connection.executescript(
+                "DROP TABLE IF EXISTS receipt_lines_fts;"
+                + "".join(f"DROP TABLE IF EXISTS {table};" for table in RECEIPT_TABLES)
+            )
+            self.created = True
+
+        connection.executescript(SCHEMA)
+        connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        connection.commit()
+
+        self._connection = connection
+        return connection
+
+    def close(self) -> None:
+        """Zamyka połączenie z bazą"""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    @staticmethod
+    def _row(metadata: Dict[str, Any], metadata_mtime: Optional[float]) -> tuple:
+        company = metadata.get("check_company")
+        return (
+            metadata["file_hash"],
+            metadata.get("receipt_date") or "",
+            metadata.get("prompt_version"),
+            metadata.get("created_at") or "",
+            company,
+            company.casefold() if company else None,
+            metadata.get("check_total"),
+            parse_amount(metadata.get("check_total")),
+            metadata.get("image_hash"),
+            metadata_mtime,
+            json.dumps(metadata, ensure_ascii=False),
+        )
+
+    @staticmethod
+    def _write_facts(connection: sqlite3.Connection, file_hash: str, facts: Dict[str, List[tuple]]) -> None:
+        """Zastępuje pozycje zakupów, podsumowanie stawek VAT i linie do wyszukiwania pełnotekstowego paragonu"""
+        for table in RECEIPT_TABLES[1:]:
+            connection.execute(f"DELETE FROM {table} WHERE file_hash = ?", (file_hash,))
+        connection.executemany(
+            "INSERT OR REPLACE INTO receipt_items VALUES (?, ?, ?, ?, ?)",
+            [(file_hash, *item) for item in facts.get("items", [])],
+        )
+        connection.executemany(
+            "INSERT OR REPLACE INTO receipt_vat VALUES (?, ?, ?, ?)",
+            [(file_hash, *vat) for vat in facts.get("vat", [])],
+        )
+        connection.executemany(
+            "INSERT INTO receipt_lines (file_hash, line_number, category, content) VALUES (?, ?, ?, ?)",
+            [(file_hash, *line) for line in facts.get("lines", [])],
+        )
+
+    def upsert(
+            self,
+            metadata: Dict[str, Any],
+            metadata_mtime: Optional[float] = None,
+            facts: Optional[Dict[str, List[tuple]]] = None,
+    ) -> None:
+        """Dodaje lub aktualizuje wpis paragonu (oraz jego pozycje, jeśli je podano)"""
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(UPSERT_SQL, self._row(metadata, metadata_mtime))
+                if facts is not None:
+                    self._write_facts(connection, metadata["file_hash"], facts)
+
+    def get(self, file_hash: str) -> Optional[Dict[str, Any]]:
+        """Zwraca metadane paragonu lub None, jeśli nie ma go w indeksie"""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT metadata FROM receipts WHERE file_hash = ?", (file_hash,)
+            ).fetchone()
+        return json.loads(row["metadata"]) if row else None
+
+    def history(
+            self,
+            limit: int = 10,
+            offset: int = 0,
+            sort: str = "created_at",
+            descending: bool = True,
+            after: Optional[Tuple[str, str]] = None,
+            date_from: Optional[str] = None,
+            date_to: Optional[str] = None,
+            company: Optional[str] = None,
+            total_min: Optional[float] = None,
+            total_max: Optional[float] = None,
+            prompt_version: Optional[str] = None,
+    ) -> Tuple[List[Dict[str, Any]], Optional[Tuple[str, str]]]:
+        """
+        Zwraca stronę historii paragonów (paginacja kursorem po kluczu sortowania).
+
+        Args:
+            limit: Maksymalna liczba wyników.
+            offset: Przesunięcie (tylko bez kursora, zachowane dla zgodności).
+            sort: Klucz sortowania (`created_at` lub `receipt_date`).
+            descending: Czy sortować malejąco (od najnowszych).
+            after: Klucz (wartość sortowania, hash) ostatniego paragonu poprzedniej strony.
+            date_from: Najwcześniejsza data paragonu (YYYYMMDD, włącznie).
+            date_to: Najpóźniejsza data paragonu (YYYYMMDD, włącznie).
+            company: Początek nazwy sprzedawcy (bez rozróżniania wielkości liter).
+            total_min: Minimalna kwota paragonu.
+            total_max: Maksymalna kwota paragonu.
+            prompt_version: Wersja promptu OCR.
+
+        Returns:
+            Lista metadanych i klucz ostatniego paragonu, jeśli istnieje kolejna strona.
+        """
+        if sort not in SORT_FIELDS:
+            raise ValueError(f"Nieobsługiwany klucz sortowania: {sort}")
+
+        conditions, parameters = [], []
+        if after is not None:
+            conditions.append(f"({sort}, file_hash) {'<' if descending else '>'} (?, ?)")
+            parameters.extend(after)
+        if date_from:
+            conditions.append("receipt_date >= ?")
+            parameters.append(date_from)
+        if date_to:
+            conditions.append("receipt_date <= ?")
+            parameters.append(date_to)
+        if company:
+            # Zakres po prefiksie korzysta z indeksu (w przeciwieństwie do wyszukiwania fragmentu)
+            prefix = company.strip().casefold()
+            conditions.append("company_key >= ? AND company_key < ?")
+            parameters.extend([prefix, prefix + COMPANY_PREFIX_END])
+        if total_min is not None:
+            conditions.append("total_amount >= ?")
+            parameters.append(total_min)
+        if total_max is not None:
+            conditions.append("total_amount <= ?")
+            parameters.append(total_max)
+        if prompt_version:
+            conditions.append("prompt_version = ?")
+            parameters.append(prompt_version)
+
+        direction = "DESC" if descending else "ASC"
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        # Pobierz jeden wiersz więcej, aby sprawdzić, czy istnieje kolejna strona
+        sql = (
+            f"SELECT {sort} AS sort_key, file_hash, metadata FROM receipts {where} "
+            f"ORDER BY {sort} {direction}, file_hash {direction} LIMIT ? OFFSET ?"
+        )
+        parameters.extend([limit + 1, 0 if after is not None else offset])
+
+        with self._lock:
+            rows = self._connect().execute(sql, parameters).fetchall()
+
+        next_key = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_key = (rows[-1]["sort_key"], rows[-1]["file_hash"])
+
+        return [json.loads(row["metadata"]) for row in rows], next_key
+
+    def count(self) -> int:
+        """Zwraca liczbę paragonów w indeksie"""
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM receipts").fetchone()[0]
+
+    def mtimes(self) -> Dict[str, Optional[float]]:
+        """Zwraca czasy modyfikacji plików metadanych zapisane w indeksie"""
+        with self._lock:
+            rows = self._connect().execute("SELECT file_hash, metadata_mtime FROM receipts").fetchall()
+        return {row["file_hash"]: row["metadata_mtime"] for row in rows}
+
+    def apply(
+            self,
+            upserts: Iterable[tuple],
+            deletes: Iterable[str] = (),
+            clear: bool = False,
+    ) -> None:
+        """
+        Wprowadza wiele zmian w jednej transakcji.
+
+        Args:
+            upserts: Trójki (metadane, czas modyfikacji pliku metadanych, pozycje paragonu lub None).
+            deletes: Hasze paragonów do usunięcia.
+            clear: Czy najpierw usunąć wszystkie wpisy.
+        """
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                if clear:
+                    for table in RECEIPT_TABLES:
+                        connection.execute(f"DELETE FROM {table}")
+                for table in RECEIPT_TABLES:
+                    connection.executemany(
+                        f"DELETE FROM {table} WHERE file_hash = ?",
+                        [(file_hash,) for file_hash in deletes],
+                    )
+                for metadata, mtime, facts in upserts:
+                    connection.execute(UPSERT_SQL, self._row(metadata, mtime))
+                    if facts is not None:
+                        self._write_facts(connection, metadata["file_hash"], facts)
+
+    def data_version(self) -> int:
+        """Zwraca licznik zmian bazy wprowadzonych przez inne połączenia (np. polecenie `rebuild`)"""
+        with self._lock:
+            return self._connect().execute("PRAGMA data_version").fetchone()[0]
+
+    def search(self, query: str, limit: int = 10, offset: int = 0) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Wyszukuje paragony zawierające linie pasujące do zapytania.
+
+        Paragony są uszeregowane według najlepszego dopasowania linii (bm25).
+
+        Args:
+            query: Tekst wyszukiwania (wielkość liter i znaki diakrytyczne nie mają znaczenia).
+            limit: Maksymalna liczba paragonów.
+            offset: Przesunięcie do paginacji.
+
+        Returns:
+            Lista wyników (metadane paragonu, ocena i pasujące linie) oraz łączna liczba pasujących paragonów.
+        """
+        matches = (
+            "WITH matches AS MATERIALIZED ("
+            " SELECT l.file_hash, l.line_number, l.category, l.content, bm25(receipt_lines_fts) AS score"
+            " FROM receipt_lines_fts JOIN receipt_lines l ON l.id = receipt_lines_fts.rowid"
+            " WHERE receipt_lines_fts MATCH ?) "
+        )
+        fts_query = build_search_query(query)
+
+        with self._lock:
+            connection = self._connect()
+            total = connection.execute(
+                matches + "SELECT COUNT(DISTINCT file_hash) FROM matches", (fts_query,)
+            ).fetchone()[0]
+            rows = connection.execute(
+                matches
+                + "SELECT m.file_hash, MIN(m.score) AS score,"
+                " json_group_array(json_array(m.line_number, m.category, m.content)) AS lines, r.metadata"
+                " FROM matches m JOIN receipts r ON r.file_hash = m.file_hash"
+                " GROUP BY m.file_hash ORDER BY score, m.file_hash LIMIT ? OFFSET ?",
+                (fts_query, limit, offset),
+            ).fetchall()
+
+        results = []
+        for row in rows:
+            # Sortowanie tylko po numerze linii - kategoria może być NULL
+            lines = sorted(json.loads(row["lines"]), key=lambda line: line[0])
+            results.append({
+                "file_hash": row["file_hash"],
+                # bm25 zwraca wartości ujemne - im mniejsza, tym lepsze dopasowanie
+                "score": round(-row["score"], 4),
+                "metadata": json.loads(row["metadata"]),
+                "lines": [
+                    {"line_number": line_number, "category": category, "content": content}
+                    for line_number, category, content in lines
+                ],
+            })
+        return results, total
+
+    def image_hashes(self) -> List[tuple]:
+        """Zwraca pary (hash pliku, skrót percepcyjny obrazu) paragonów, dla których zapisano skrót"""
+        with self._lock:
+            return self._connect().execute(
+                "SELECT file_hash, image_hash FROM receipts WHERE image_hash IS NOT NULL"
+            ).fetchall()
+
+    def analytics_rows(self) -> Dict[str, List[tuple]]:
+        """
+        Zwraca dane do budowy agregatów analitycznych.
+
+        Returns:
+            Słownik z listami krotek: `receipts` (hash, data, sprzedawca, kwota),
+            `items` (hash, produkt, stawka VAT, kwota) i `vat` (hash, stawka VAT, sprzedaż, podatek).
+        """
+        with self._lock:
+            connection = self._connect()
+            return {
+                "receipts": connection.execute(
+                    "SELECT file_hash, receipt_date, check_company, total_amount FROM receipts"
+                ).fetchall(),
+                "items": connection.execute(
+                    "SELECT file_hash, product, vat_class, amount FROM receipt_items ORDER BY file_hash, line_number"
+                ).fetchall(),
+                "vat": connection.execute("SELECT file_hash, vat_class, sales, tax FROM receipt_vat").fetchall(),
+            }
+
+
+def get_index_path() -> str:
+    """Zwraca ścieżkę pliku indeksu (domyślnie w katalogu DATA_DIR)"""
+    return settings.storage.INDEX_PATH or os.path.join(settings.DATA_DIR, "receipts.sqlite3")
+
+
+# Współdzielona instancja indeksu dla całej aplikacji
+receipt_index = ReceiptIndex(get_index_path())
+
+
+def main() -> None:
+    """Polecenie do odbudowy lub uzgodnienia indeksu z zawartością DATA_DIR"""
+    import argparse
+
+    from app.services.storage import reconcile_receipt_index
+
+    parser = argparse.ArgumentParser(description="Zarządzanie indeksem metadanych paragonów")
+    parser.add_argument(
+        "command",
+        choices=["rebuild", "reconcile"],
+        help="rebuild - odbudowa od zera, reconcile - uzupełnienie zmian względem plików",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    stats = reconcile_receipt_index(full=args.command == "rebuild")
+    logger.info(f"Indeks paragonów ({args.command}): {json.dumps(stats)}")
+
+
+if __name__ == "__main__":
+    main()
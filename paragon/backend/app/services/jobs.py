@@ -0,0 +1,434 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Union
+
+from fastapi import HTTPException
+
+from app.core.config import settings
+from app.services.ocr import process_receipt_data
+from app.services.storage import atomic_copy, atomic_write
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    filename TEXT,
+    file_hash TEXT NOT NULL,
+    prompt_version TEXT,
+    use_cache INTEGER NOT NULL,
+    refresh_cache INTEGER NOT NULL,
+    payload_path TEXT,
+    options TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL DEFAULT 0,
+    lease_expires_at REAL,
+    result TEXT,
+    error TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at);
+"""
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+
+ATTEMPTS_EXCEEDED_ERROR = "Przekroczono maksymalną liczbę prób przetworzenia zadania"
+
+
+class JobQueue:
+    """
+    Trwała kolejka zadań OCR oparta na SQLite.
+
+    Przesłane obrazy są zapisywane w katalogu kolejki, a stan zadań w bazie,
+    dzięki czemu zadania przerwane przez restart są po starcie wznawiane.
+
+    Uruchomione zadanie ma dzierżawę (`lease_expires_at`) odnawianą przez proces roboczy.
+    Zadanie z wygasłą dzierżawą (proces zakończył się w trakcie przetwarzania) jest ponownie
+    pobierane przez `claim`, więc bazę może współdzielić kilka procesów aplikacji (np. workery uvicorn).
+    """
+
+    def __init__(self, directory: str, lease_seconds: float = 60.0, max_attempts: int = 3):
+        self.directory = directory
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Otwiera połączenie i tworzy schemat przy pierwszym użyciu"""
+        if self._connection is not None:
+            return self._connection
+
+        os.makedirs(self.directory, exist_ok=True)
+        connection = sqlite3.connect(
+            os.path.join(self.directory, "jobs.sqlite3"),
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+
+        # Migracja baz utworzonych przed dodaniem kolumny z opcjami przetwarzania
+        columns = [row["name"] for row in connection.execute("PRAGMA table_info(jobs)")]
+        if "options" not in columns:
+            connection.execute("ALTER TABLE jobs ADD COLUMN options TEXT")
+
+        self._connection = connection
+        return connection
+
+    def close(self) -> None:
+        """Zamyka połączenie z bazą"""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        job = dict(row)
+        job["use_cache"] = bool(job["use_cache"])
+        job["refresh_cache"] = bool(job["refresh_cache"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        job["options"] = json.loads(job["options"]) if job["options"] else {}
+        return job
+
+    def enqueue(
+            self,
+            image_data: Union[bytes, str],
+            file_hash: str,
+            filename: Optional[str] = None,
+            prompt_version: Optional[str] = None,
+            use_cache: bool = True,
+            refresh_cache: bool = False,
+            options: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Dodaje zadanie OCR do kolejki.
+
+        `image_data` to bajty obrazu albo ścieżka do pliku, który zostanie skopiowany
+        do katalogu kolejki. `options` to dodatkowe argumenty `process_receipt_data`
+        (np. `use_osd`).
+
+        Returns:
+            Słownik z danymi utworzonego zadania.
+        """
+        job_id = uuid.uuid4().hex
+        now = datetime.now().isoformat()
+
+        with self._lock:
+            connection = self._connect()
+
+            # Najpierw trwały zapis obrazu, potem wpis w kolejce
+            payload_path = os.path.join(self.directory, f"{job_id}.bin")
+            if isinstance(image_data, bytes):
+                atomic_write(payload_path, image_data)
+            else:
+                atomic_copy(image_data, payload_path)
+
+            connection.execute(
+                "INSERT INTO jobs (id, status, filename, file_hash, prompt_version, use_cache, refresh_cache, "
+                "payload_path, options, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, JOB_QUEUED, filename, file_hash, prompt_version, int(use_cache), int(refresh_cache),
+                 payload_path, json.dumps(options or {}), now, now),
+            )
+            row = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+        return self._to_dict(row)
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """
+        Pobiera najstarsze dostępne zadanie i oznacza je jako uruchomione (z dzierżawą).
+
+        Dostępne są zadania oczekujące oraz uruchomione, których dzierżawa wygasła w trakcie
+        działania aplikacji (proces przetwarzający zadanie zakończył się). Zadanie z wygasłą
+        dzierżawą, które wykorzystało limit prób, jest oznaczane jako nieudane.
+        """
+        while True:
+            now = time.time()
+            expired_payload = None
+
+            with self._lock:
+                connection = self._connect()
+                connection.execute("BEGIN IMMEDIATE")
+                try:
+                    row = connection.execute(
+                        "SELECT id, status, attempts, payload_path FROM jobs "
+                        "WHERE (status = ? AND available_at <= ?) OR (status = ? AND lease_expires_at < ?) "
+                        "ORDER BY created_at LIMIT 1",
+                        (JOB_QUEUED, now, JOB_RUNNING, now),
+                    ).fetchone()
+                    if row is None:
+                        connection.execute("COMMIT")
+                        return None
+
+                    if row["status"] == JOB_RUNNING and row["attempts"] >= self.max_attempts:
+                        connection.execute(
+                            "UPDATE jobs SET status = ?, error = ?, payload_path = NULL, lease_expires_at = NULL, "
+                            "updated_at = ? WHERE id = ?",
+                            (JOB_FAILED, ATTEMPTS_EXCEEDED_ERROR, datetime.now().isoformat(), row["id"]),
+                        )
+                        connection.execute("COMMIT")
+                        expired_payload = row["payload_path"]
+                        job = None
+                    else:
+                        connection.execute(
+                            "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_expires_at = ?, "
+                            "updated_at = ? WHERE id = ?",
+                            (JOB_RUNNING, now + self.lease_seconds, datetime.now().isoformat(), row["id"]),
+                        )
+                        job = connection.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+                        connection.execute("COMMIT")
+                except Exception:
+                    connection.execute("ROLLBACK")
+                    raise
+
+            if job is not None:
+                if row["status"] == JOB_RUNNING:
+                    logger.warning(f"Dzierżawa zadania {row['id']} wygasła - zadanie zostało pobrane ponownie")
+                return self._to_dict(job)
+
+            logger.warning(f"Zadanie {row['id']} przekroczyło limit prób po wygaśnięciu dzierżawy")
+            if expired_payload and os.path.exists(expired_payload):
+                os.remove(expired_payload)
+
+    def renew(self, job_id: str) -> None:
+        """Przedłuża dzierżawę uruchomionego zadania"""
+        with self._lock:
+            self._connect().execute(
+                "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND status = ?",
+                (time.time() + self.lease_seconds, job_id, JOB_RUNNING),
+            )
+
+    def retry(self, job_id: str, error: str, delay: float) -> None:
+        """Przywraca zadanie do kolejki po błędzie przejściowym (najwcześniej po `delay` sekundach)"""
+        with self._lock:
+            self._connect().execute(
+                "UPDATE jobs SET status = ?, error = ?, available_at = ?, lease_expires_at = NULL, updated_at = ? "
+                "WHERE id = ?",
+                (JOB_QUEUED, error, time.time() + delay, datetime.now().isoformat(), job_id),
+            )
+
+    def _finish(self, job_id: str, status: str, result: Optional[dict], error: Optional[str]) -> None:
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT payload_path FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            connection.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, payload_path = NULL, lease_expires_at = NULL, "
+                "updated_at = ? WHERE id = ?",
+                (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error,
+                 datetime.now().isoformat(), job_id),
+            )
+
+        # Obraz jest już zapisany w DATA_DIR (lub zadanie nie powiodło się) - kopia w kolejce jest zbędna
+        if row is not None and row["payload_path"] and os.path.exists(row["payload_path"]):
+            os.remove(row["payload_path"])
+
+    def complete(self, job_id: str, result: dict) -> None:
+        """Oznacza zadanie jako zakończone i zapisuje jego wynik"""
+        self._finish(job_id, JOB_COMPLETED, result, None)
+
+    def fail(self, job_id: str, error: str) -> None:
+        """Oznacza zadanie jako zakończone błędem"""
+        self._finish(job_id, JOB_FAILED, None, error)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Zwraca dane zadania lub None, jeśli zadanie nie istnieje"""
+        with self._lock:
+            row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def recover(self, max_attempts: int) -> List[str]:
+        """
+        Przywraca do kolejki zadania przerwane przez restart lub awarię procesu.
+
+        Pomijane są zadania z ważną dzierżawą - przetwarza je inny działający proces.
+        Zadania, które przekroczyły limit prób, są oznaczane jako nieudane.
+
+        Returns:
+            Lista identyfikatorów zadań przywróconych do kolejki.
+        """
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT id, attempts FROM jobs WHERE status = ? AND COALESCE(lease_expires_at, 0) < ?",
+                (JOB_RUNNING, time.time()),
+            ).fetchall()
+
+        recovered = []
+        for row in rows:
+            if row["attempts"] >= max_attempts:
+                self.fail(row["id"], ATTEMPTS_EXCEEDED_ERROR)
+                continue
+
+            with self._lock:
+                self._connect().execute(
+                    "UPDATE jobs SET status = ?, lease_expires_at = NULL, updated_at = ? WHERE id = ? AND status = ?",
+                    (JOB_QUEUED, datetime.now().isoformat(), row["id"], JOB_RUNNING),
+                )
+            recovered.append(row["id"])
+
+        return recovered
+
+
+def get_jobs_dir() -> str:
+    """Zwraca katalog kolejki zadań (domyślnie w katalogu DATA_DIR)"""
+    return settings.jobs.DIR or os.path.join(settings.DATA_DIR, "_jobs")
+
+
+# Współdzielona instancja kolejki dla całej aplikacji
+job_queue = JobQueue(
+    get_jobs_dir(), lease_seconds=settings.jobs.LEASE_SECONDS, max_attempts=settings.jobs.MAX_ATTEMPTS
+)
+
+_workers: List[asyncio.Task] = []
+_wakeup: Optional[asyncio.Event] = None
+
+
+async def renew_lease(job_id: str) -> None:
+    """Odnawia dzierżawę zadania, dopóki jest przetwarzane"""
+    while True:
+        await asyncio.sleep(job_queue.lease_seconds / 3)
+        try:
+            await asyncio.to_thread(job_queue.renew, job_id)
+        except sqlite3.Error as e:
+            logger.warning(f"Nie udało się odnowić dzierżawy zadania {job_id}: {str(e)}")
+
+
+async def fail_or_retry(job: Dict[str, Any], error: str) -> None:
+    """Przywraca zadanie do kolejki po błędzie przejściowym lub oznacza je jako nieudane po ostatniej próbie"""
+    if job["attempts"] >= settings.jobs.MAX_ATTEMPTS:
+        await asyncio.to_thread(job_queue.fail, job["id"], error)
+        return
+
+    # Wykładnicze opóźnienie kolejnych prób
+    delay = settings.jobs.RETRY_DELAY * 2 ** (job["attempts"] - 1)
+    logger.info(f"Zadanie {job['id']} wraca do kolejki (próba {job['attempts']}, za {delay:.0f} s): {error}")
+    await asyncio.to_thread(job_queue.retry, job["id"], error, delay)
+
+
+async def run_job(job: Dict[str, Any]) -> None:
+    """Wykonuje pojedyncze zadanie OCR i zapisuje jego wynik w kolejce"""
+    heartbeat = asyncio.create_task(renew_lease(job["id"]))
+    try:
+        # Obraz jest przekazywany jako ścieżka - nie trzeba go wczytywać do pamięci
+        result = await process_receipt_data(
+            job["payload_path"],
+            job["file_hash"],
+            prompt_version=job["prompt_version"],
+            use_cache=job["use_cache"],
+            refresh_cache=job["refresh_cache"],
+            **job["options"],
+        )
+    except HTTPException as e:
+        # Błędy 5xx (np. wyczerpane ponowienia wywołań LLM) są przejściowe, 4xx - nie
+        if e.status_code >= 500:
+            await fail_or_retry(job, str(e.detail))
+        else:
+            await asyncio.to_thread(job_queue.fail, job["id"], str(e.detail))
+    except Exception as e:
+        logger.error(f"Błąd przetwarzania zadania {job['id']}: {str(e)}", exc_info=True)
+        await fail_or_retry(job, f"{type(e).__name__}: {str(e)}")
+    else:
+        await asyncio.to_thread(job_queue.complete, job["id"], result)
+    finally:
+        heartbeat.cancel()
+
+
+async def job_worker(worker_id: int) -> None:
+    """Pętla procesu roboczego pobierającego zadania z kolejki"""
+    errors = 0
+    while True:
+        try:
+            job = await asyncio.to_thread(job_queue.claim)
+            if job is not None:
+                logger.debug(f"Proces roboczy {worker_id} przetwarza zadanie {job['id']}")
+                await run_job(job)
+            errors = 0
+        except Exception as e:
+            # Np. "database is locked" przy bazie współdzielonej przez kilka procesów -
+            # zadanie bez zapisanego wyniku wróci do kolejki po wygaśnięciu dzierżawy
+            errors += 1
+            delay = min(settings.jobs.POLL_INTERVAL * 2 ** errors, 30.0)
+            logger.error(f"Błąd procesu roboczego {worker_id} kolejki OCR (ponowienie za {delay:.1f} s): {str(e)}")
+            await asyncio.sleep(delay)
+            continue
+
+        if job is None:
+            _wakeup.clear()
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout=settings.jobs.POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+
+def notify_job_workers() -> None:
+    """Budzi procesy robocze po dodaniu nowego zadania"""
+    if _wakeup is not None:
+        _wakeup.set()
+
+
+async def enqueue_receipt_job(
+        image_data: Union[bytes, str],
+        file_hash: str,
+        filename: Optional[str] = None,
+        prompt_version: Optional[str] = None,
+        use_cache: bool = True,
+        refresh_cache: bool = False,
+        options: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """
+    Dodaje paragon do kolejki zadań i budzi procesy robocze.
+
+    Zapis obrazu i wpis w bazie są wykonywane w wątku, aby nie blokować pętli zdarzeń.
+    """
+    job = await asyncio.to_thread(
+        job_queue.enqueue,
+        image_data,
+        file_hash,
+        filename=filename,
+        prompt_version=prompt_version,
+        use_cache=use_cache,
+        refresh_cache=refresh_cache,
+        options=options,
+    )
+    notify_job_workers()
+    return job
+
+
+def start_job_workers() -> None:
+    """Przywraca przerwane zadania i uruchamia pulę procesów roboczych"""
+    global _wakeup
+
+    if not settings.jobs.ENABLED or _workers:
+        return
+
+    recovered = job_queue.recover(settings.jobs.MAX_ATTEMPTS)
+    if recovered:
+        logger.info(f"Przywrócono do kolejki {len(recovered)} przerwanych zadań OCR")
+
+    _wakeup = asyncio.Event()
+    for worker_id in range(settings.jobs.WORKERS):
+        _workers.append(asyncio.create_task(job_worker(worker_id)))
+
+    logger.info(f"Uruchomiono {settings.jobs.WORKERS} procesów roboczych kolejki OCR")
+
+
+async def stop_job_workers() -> None:
+    """Zatrzymuje procesy robocze (przerwane zadania zostaną wznowione po restarcie)"""
+    for worker in _workers:
+        worker.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    job_queue.close()
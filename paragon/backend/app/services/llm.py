@@ -0,0 +1,474 @@
+import math
+import time
+import random
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+import httpx
+from fastapi import HTTPException
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError
+
+from app.core.config import settings
+from app.core.metrics import LLM_CONCURRENCY_LIMIT, LLM_RETRIES, track_stage
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Kody odpowiedzi, po których warto ponowić wywołanie (przekroczenie czasu, konflikt, limit zapytań)
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+
+class TokenBucket:
+    """
+    Budżet odnawiany w czasie (np. zapytania lub tokeny na minutę).
+
+    Poziom może spaść poniżej zera, gdy rzeczywiste zużycie tokenów
+    okaże się większe od szacowanego - kolejne wywołania czekają wtedy dłużej.
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Zwraca czas oczekiwania (w sekundach) na dostępność `amount` jednostek"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        # Żądanie większe niż cały budżet czeka tylko na jego pełne odnowienie
+        needed = min(amount, self.capacity)
+        if self.level >= needed:
+            return 0.0
+        return (needed - self.level) / self.rate
+
+    def consume(self, amount: float) -> None:
+        if self.rate > 0:
+            self._refill()
+            self.level -= amount
+
+    def refund(self, amount: float) -> None:
+        """Koryguje poziom o różnicę między szacowanym a rzeczywistym zużyciem"""
+        if self.rate > 0:
+            self._refill()
+            self.level = min(self.capacity, self.level + amount)
+
+
+class LLMScheduler:
+    """
+    Harmonogram wywołań LLM po stronie klienta.
+
+    - pilnuje budżetów zapytań i tokenów na minutę (`RATE_LIMIT_RPM`, `RATE_LIMIT_TPM`),
+    - ponawia wywołania zakończone limitem zapytań (429), błędem serwera (5xx)
+      lub błędem połączenia z wykładniczym opóźnieniem z losowym rozrzutem,
+      respektując nagłówek `Retry-After`,
+    - dostosowuje liczbę równoległych wywołań (AIMD): po odpowiedzi 429 limit
+      jest zmniejszany o połowę, a po każdym udanym wywołaniu rośnie o 1/limit.
+
+    Po wyczerpaniu prób zgłaszany jest błąd HTTP 503 z nagłówkiem `Retry-After`
+    zamiast ogólnego błędu 500. `name` (nazwa backendu) jest etykietą metryki limitu.
+    """
+
+    def __init__(
+            self,
+            max_concurrency: int,
+            min_concurrency: int = 1,
+            rpm: int = 0,
+            tpm: int = 0,
+            max_retries: int = 4,
+            base_delay: float = 1.0,
+            max_delay: float = 30.0,
+            name: str = "default",
+    ):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+        self._budget_lock = asyncio.Lock()
+        self._publish_limit()
+
+    def _publish_limit(self) -> None:
+        """Udostępnia bieżący limit równoległych wywołań w metrykach"""
+        if settings.app.METRICS_ENABLED:
+            LLM_CONCURRENCY_LIMIT.set(self.limit, backend=self.name)
+
+    async def _acquire_slot(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def _release_slot(self) -> None:
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    async def _acquire_budget(self, estimated_tokens: int) -> None:
+        """Czeka na budżet zapytań i tokenów (kolejność zgłoszeń jest zachowana)"""
+        async with self._budget_lock:
+            while True:
+                wait = max(
+                    self._paused_until - time.monotonic(),
+                    self._requests.delay(1),
+                    self._tokens.delay(estimated_tokens),
+                )
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            self._requests.consume(1)
+            self._tokens.consume(estimated_tokens)
+
+    async def _on_success(self) -> None:
+        async with self._condition:
+            previous = int(self.limit)
+            self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            self._publish_limit()
+
+            # Wyższy limit wpuszcza wywołania czekające na miejsce
+            if int(self.limit) > previous:
+                self._condition.notify_all()
+
+    def _on_throttle(self, retry_after: Optional[float]) -> None:
+        now = time.monotonic()
+        if retry_after:
+            self._paused_until = max(self._paused_until, now + retry_after)
+
+        # Jedno zmniejszenie na okno - seria odpowiedzi 429 z tej samej chwili nie zeruje limitu
+        if now - self._last_decrease >= max(self.base_delay, 1.0):
+            self._last_decrease = now
+            self.limit = max(float(self.min_concurrency), self.limit / 2)
+            self._publish_limit()
+            logger.warning(f"Ograniczenie liczby zapytań przez LLM - limit równoległych wywołań: {int(self.limit)}")
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        """Opóźnienie wykładnicze z pełnym losowym rozrzutem, nie krótsze niż `Retry-After`"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    @staticmethod
+    def _retry_after(error: Exception) -> Optional[float]:
+        """Odczytuje `retry-after-ms` lub `Retry-After` (sekundy albo data HTTP) z odpowiedzi"""
+        response = getattr(error, "response", None)
+        if response is None:
+            return None
+
+        headers = response.headers
+        try:
+            if headers.get("retry-after-ms"):
+                return float(headers["retry-after-ms"]) / 1000
+            value = headers.get("retry-after")
+            if not value:
+                return None
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    async def _call(self, request: Callable[[], Awaitable[T]], estimated_tokens: int) -> T:
+        for attempt in range(self.max_retries + 1):
+            with track_stage("llm_budget"):
+                await self._acquire_budget(estimated_tokens)
+
+            try:
+                response = await request()
+            except APIStatusError as e:
+                if e.status_code not in RETRYABLE_STATUS_CODES and e.status_code < 500:
+                    raise
+                retry_after = self._retry_after(e)
+                throttled = e.status_code == 429
+                reason = str(e.status_code)
+                error = e
+            except APIConnectionError as e:
+                retry_after = None
+                throttled = False
+                reason = "connection"
+                error = e
+            else:
+                await self._on_success()
+                return response
+
+            if throttled:
+                self._on_throttle(retry_after)
+
+            delay = self._backoff(attempt, retry_after)
+            if attempt == self.max_retries:
+                break
+
+            if settings.app.METRICS_ENABLED:
+                LLM_RETRIES.inc(reason=reason)
+            logger.warning(
+                f"Wywołanie LLM nie powiodło się ({reason}), ponowienie {attempt + 1}/{self.max_retries} za {delay:.1f} s"
+            )
+            await asyncio.sleep(delay)
+
+        logger.error(f"Wywołanie LLM nie powiodło się po {self.max_retries + 1} próbach: {str(error)}")
+        raise HTTPException(
+            status_code=503,
+            detail="Usługa LLM jest chwilowo przeciążona lub niedostępna, spróbuj ponownie później",
+            headers={"Retry-After": str(max(1, math.ceil(delay)))},
+        ) from error
+
+    @asynccontextmanager
+    async def slot(self, estimated_tokens: int) -> AsyncIterator["LLMCall"]:
+        """
+        Rezerwuje miejsce na wywołanie LLM na czas bloku.
+
+        Miejsce jest trzymane do końca bloku, więc obejmuje też odczyt
+        odpowiedzi strumieniowej. Wywołanie wykonuje się przez `LLMCall.send`.
+        """
+        call = LLMCall(self, estimated_tokens)
+        with track_stage("llm_queue"):
+            await self._acquire_slot()
+        try:
+            yield call
+        finally:
+            await self._release_slot()
+
+
+class LLMCall:
+    """Pojedyncze wywołanie LLM w ramach zarezerwowanego miejsca harmonogramu"""
+
+    def __init__(self, scheduler: LLMScheduler, estimated_tokens: int):
+        self.scheduler = scheduler
+        self.estimated_tokens = estimated_tokens
+
+    async def send(self, request: Callable[[], Awaitable[T]]) -> T:
+        """Wykonuje wywołanie z ponowieniami (`request` tworzy nowe żądanie przy każdej próbie)"""
+        return await self.scheduler._call(request, self.estimated_tokens)
+
+    def record_usage(self, tokens: int) -> None:
+        """Koryguje budżet tokenów o różnicę między szacowanym a rzeczywistym zużyciem"""
+        self.scheduler._tokens.refund(self.estimated_tokens - tokens)
+
+
+def estimate_image_tokens(width: int, height: int, detail: str = "auto") -> int:
+    """
+    Szacuje liczbę tokenów obrazu według zasad rozliczania obrazów przez OpenAI.
+
+    Obraz jest skalowany do 2048x2048, potem krótszy bok do 768 px,
+    a każdy kafelek 512x512 kosztuje 170 tokenów (plus 85 tokenów bazowo).
+    """
+    if detail == "low":
+        return 85
+
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def estimate_request_tokens(
+        prompt_text: str,
+        image_width: int = 0,
+        image_height: int = 0,
+        max_tokens: Optional[int] = None,
+) -> int:
+    """
+    Szacuje tokeny wywołania OCR: prompt (~4 znaki na token), obraz i maksymalna długość odpowiedzi.
+
+    Dla wywołań bez obrazu (np. tekst strony PDF) `prompt_text` obejmuje cały tekst żądania.
+    `max_tokens` to limit odpowiedzi backendu (domyślnie `MAX_TOKENS`).
+    """
+    image_tokens = 0
+    if image_width and image_height:
+        image_tokens = estimate_image_tokens(image_width, image_height, settings.image.LLM_IMAGE_DETAIL)
+
+    if max_tokens is None:
+        max_tokens = settings.openai.MAX_TOKENS
+
+    return len(prompt_text) // 4 + image_tokens + max_tokens
+
+
+class LLMBackend:
+    """
+    Backend LLM: model, klient zgodny z API OpenAI i własny harmonogram wywołań.
+
+    Limity (`max_lines`, `max_aspect`, `max_pixels`) określają paragony, które router
+    może skierować do backendu - 0 oznacza brak limitu.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            model: str,
+            client: AsyncOpenAI,
+            scheduler: LLMScheduler,
+            max_tokens: int,
+            max_lines: int = 0,
+            max_aspect: float = 0,
+            max_pixels: int = 0,
+    ):
+        self.name = name
+        self.model = model
+        self.client = client
+        self.scheduler = scheduler
+        self.max_tokens = max_tokens
+        self.max_lines = max_lines
+        self.max_aspect = max_aspect
+        self.max_pixels = max_pixels
+
+    def accepts(self, features: Dict[str, Any]) -> bool:
+        """Sprawdza, czy cechy paragonu (`lines`, `aspect`, `pixels`) mieszczą się w limitach backendu"""
+        limits = (("lines", self.max_lines), ("aspect", self.max_aspect), ("pixels", self.max_pixels))
+        return all(not limit or features.get(name, 0) <= limit for name, limit in limits)
+
+    def describe(self) -> Dict[str, Any]:
+        """Zwraca opis backendu do metadanych paragonu"""
+        return {"name": self.name, "model": self.model}
+
+
+# Domyślny backend (konfiguracja OPENAI_*) jest zawsze ostatnim, najsilniejszym szczeblem
+DEFAULT_BACKEND_NAME = "default"
+
+# Klient HTTP i backendy współdzielone przez całą aplikację (tworzone przy starcie)
+_http_client: Optional[httpx.AsyncClient] = None
+_backends: List[LLMBackend] = []
+
+
+def _create_scheduler(name: str, max_concurrency: int, rpm: int, tpm: int) -> LLMScheduler:
+    openai_settings = settings.openai
+    return LLMScheduler(
+        name=name,
+        max_concurrency=max_concurrency,
+        min_concurrency=openai_settings.MIN_CONCURRENCY,
+        rpm=rpm,
+        tpm=tpm,
+        max_retries=openai_settings.MAX_RETRIES,
+        base_delay=openai_settings.RETRY_BASE_DELAY,
+        max_delay=openai_settings.RETRY_MAX_DELAY,
+    )
+
+
+def init_llm_client() -> AsyncOpenAI:
+    """
+    Tworzy backendy LLM ze wspólną pulą połączeń HTTP.
+
+    Backendy z `routing.BACKENDS` (od najtańszego) poprzedzają backend domyślny
+    skonfigurowany zmiennymi `OPENAI_*`. Każdy backend ma własnego klienta
+    i harmonogram (limity zapytań i tokenów dotyczą konkretnego dostawcy).
+
+    Returns:
+        Klient AsyncOpenAI backendu domyślnego.
+    """
+    global _http_client, _backends
+
+    if _backends:
+        return get_llm_client()
+
+    openai_settings = settings.openai
+    _http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=openai_settings.MAX_CONNECTIONS,
+            max_keepalive_connections=openai_settings.MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=openai_settings.KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            openai_settings.REQUEST_TIMEOUT,
+            connect=openai_settings.CONNECT_TIMEOUT,
+        ),
+    )
+
+    backends = []
+    for backend_settings in settings.routing.BACKENDS:
+        backends.append(LLMBackend(
+            name=backend_settings.NAME,
+            model=backend_settings.MODEL,
+            # Ponowienia obsługuje harmonogram, a nie klient OpenAI
+            client=AsyncOpenAI(
+                api_key=backend_settings.API_KEY or openai_settings.API_KEY or "none",
+                base_url=backend_settings.BASE_URL or openai_settings.BASE_URL or None,
+                http_client=_http_client,
+                max_retries=0,
+            ),
+            scheduler=_create_scheduler(
+                backend_settings.NAME,
+                backend_settings.MAX_CONCURRENCY or openai_settings.MAX_CONCURRENCY,
+                backend_settings.RATE_LIMIT_RPM,
+                backend_settings.RATE_LIMIT_TPM,
+            ),
+            max_tokens=backend_settings.MAX_TOKENS or openai_settings.MAX_TOKENS,
+            max_lines=backend_settings.MAX_LINES,
+            max_aspect=backend_settings.MAX_ASPECT,
+            max_pixels=backend_settings.MAX_PIXELS,
+        ))
+
+    backends.append(LLMBackend(
+        name=DEFAULT_BACKEND_NAME,
+        model=openai_settings.DEFAULT_MODEL,
+        client=AsyncOpenAI(
+            api_key=openai_settings.API_KEY,
+            base_url=openai_settings.BASE_URL or None,
+            http_client=_http_client,
+            max_retries=0,
+        ),
+        scheduler=_create_scheduler(
+            DEFAULT_BACKEND_NAME,
+            openai_settings.MAX_CONCURRENCY,
+            openai_settings.RATE_LIMIT_RPM,
+            openai_settings.RATE_LIMIT_TPM,
+        ),
+        max_tokens=openai_settings.MAX_TOKENS,
+    ))
+    _backends = backends
+
+    logger.info(
+        f"Utworzono klienta OpenAI (maks. połączeń: {openai_settings.MAX_CONNECTIONS}, "
+        f"maks. równoległych wywołań: {openai_settings.MAX_CONCURRENCY}, "
+        f"limit RPM: {openai_settings.RATE_LIMIT_RPM or 'brak'}, limit TPM: {openai_settings.RATE_LIMIT_TPM or 'brak'})"
+    )
+    if len(backends) > 1:
+        logger.info(f"Backendy LLM (od najtańszego): {[f'{b.name} ({b.model})' for b in backends]}")
+    return get_llm_client()
+
+
+async def close_llm_client() -> None:
+    """Zamyka klientów backendów LLM i wspólną pulę połączeń"""
+    global _http_client, _backends
+
+    if _http_client is not None:
+        await _http_client.aclose()
+
+    _http_client = None
+    _backends = []
+
+
+def get_llm_backends() -> List[LLMBackend]:
+    """Zwraca backendy LLM od najtańszego do domyślnego, tworząc je przy pierwszym użyciu"""
+    if not _backends:
+        init_llm_client()
+    return _backends
+
+
+def get_llm_client() -> AsyncOpenAI:
+    """Zwraca klienta OpenAI backendu domyślnego, tworząc go przy pierwszym użyciu"""
+    return get_llm_backends()[-1].client
+
+
+def get_llm_scheduler() -> LLMScheduler:
+    """Zwraca harmonogram wywołań backendu domyślnego (limity, ponowienia i adaptacyjna współbieżność)"""
+    return get_llm_backends()[-1].scheduler
@@ -1,107 +1,310 @@
-import io
-from PIL import Image
-from openai import OpenAI
-from fastapi import UploadFile
+import time
+import os
+import base64
+import asyncio
+import logging
+from contextlib import contextmanager
+from typing import AsyncIterator, Callable, Iterator, List, Optional, Tuple, Union
+from fastapi import UploadFile, HTTPException
+from fastapi.encoders import jsonable_encoder
 from app.core.config import settings
-from app.utils.image import calculate_sha256, fix_rotation, convert_to_base64
-from app.services.storage import save_receipt_files
+from app.core.metrics import (
+    IMAGE_CROP_PIXEL_RATIO,
+    LLM_TOKENS,
+    OCR_CACHE_HITS,
+    OCR_ERRORS,
+    OCR_ESCALATIONS,
+    OCR_NEAR_DUPLICATES,
+    OCR_REQUESTS,
+    observe_stage,
+    track_stage,
+)
+from app.utils.image import (
+    load_receipt_fingerprint,
+    prepare_receipt_image,
+    profile_similarity,
+    run_image_task,
+    validate_image_filename,
+)
+from app.utils.pdf import inspect_pdf, is_pdf, pdf_support_available, prepare_pdf_page
+from app.utils.upload import IngestedUpload, ingest_upload, spool_to_file
+from app.services.cache import ocr_cache
+from app.services.duplicates import duplicate_index
+from app.services.llm import LLMBackend, estimate_request_tokens, get_llm_backends
+from app.services.prompts import prompt_registry
+from app.services.index import receipt_index
+from app.services.storage import (
+    save_receipt_files,
+    load_ocr_text,
+    load_parsed_result,
+    save_parsed_result,
+    get_receipt_by_hash,
+)
+from app.models.receipt import OCRResult
+from app.utils.parser import merge_receipt_pages, parse_receipt_text, parse_table_line, validate_receipt_text
+
+logger = logging.getLogger(__name__)
 
 
 def load_prompt(version: str = "1_0_3") -> str:
-    """Wczytuje prompt dla danej wersji"""
-    prompt_path = f"{settings.PROMPT_DIR}/ocr_v{version}.txt"
-    try:
-        with open(prompt_path, "r", encoding="utf-8") as f:
-            return f.read()
-    except FileNotFoundError:
-        raise FileNotFoundError(f"⚠️ Plik prompta {prompt_path} nie istnieje!")
+    """Zwraca treść promptu dla danej wersji z rejestru promptów"""
+    return prompt_registry.get(version)["text"]
 
 
 def extract_check_data(receipt_text: str) -> tuple:
     """Wyciąga dane kontrolne z tekstu OCR"""
-    # Ekstrakcja daty
-    check_date = [
-        x.split('|')[2].strip()
-        for x in receipt_text.split("\n")
-        if x.count('|') > 2 and x.split('|')[1].strip() == 'DATE'
-    ]
-    check_date = check_date[0] if len(check_date) > 0 else '19000101'
+    _, check, _ = parse_receipt_text(receipt_text)
 
-    # Ekstrakcja firmy
-    check_company = [
-        x.split('|')[2].strip()
-        for x in receipt_text.split("\n")
-        if x.count('|') > 2 and x.split('|')[1].strip() == 'COMPANY'
-    ]
-    check_company = check_company[0] if len(check_company) > 0 else 'UNKNOWN'
+    return check.date, check.company, check.total
+
+
+def build_ocr_result(
+        file_hash: str,
+        prompt_version: str,
+        receipt_text: str,
+        llm_model: Optional[str] = None,
+        tokens_in: Optional[int] = None,
+        tokens_out: Optional[int] = None,
+) -> OCRResult:
+    """
+    Buduje strukturalny wynik OCR z tekstu zwróconego przez LLM.
+
+    Brakujące informacje o modelu i tokenach są odczytywane z parametrów
+    dopisanych do zapisanego pliku `*_ocr_{version}.txt`.
+    """
+    lines, check, parameters = parse_receipt_text(receipt_text)
+
+    try:
+        if tokens_in is None:
+            tokens_in = int(parameters.get('TOKENS IN', 0))
+        if tokens_out is None:
+            tokens_out = int(parameters.get('TOKENS OUT', 0))
+    except ValueError:
+        tokens_in, tokens_out = 0, 0
+
+    return OCRResult(
+        file_hash=file_hash,
+        check=check,
+        lines=lines,
+        llm_model=llm_model or parameters.get('LLM MODEL', settings.DEFAULT_LLM_MODEL),
+        tokens_in=tokens_in,
+        tokens_out=tokens_out,
+        ocr_prompt_version=prompt_version,
+    )
+
+
+def result_from_parsed(parsed: dict) -> dict:
+    """Zamienia zapisany strukturalny wynik OCR na wynik w formacie odpowiedzi API"""
+    return {
+        'file_hash': parsed['file_hash'],
+        'check_date': parsed['check']['date'],
+        'check_company': parsed['check']['company'],
+        'check_total': parsed['check']['total'],
+        'llm_model': parsed['llm_model'],
+        'tokens_in': parsed['tokens_in'],
+        'tokens_out': parsed['tokens_out'],
+        'ocr_prompt_version': parsed['ocr_prompt_version'],
+    }
 
-    # Ekstrakcja kwoty całkowitej
-    check_total = [
-        x.split('|')[2].strip()
-        for x in receipt_text.split("\n")
-        if x.count('|') > 2 and x.split('|')[1].strip() == 'TOTAL'
-    ]
-    check_total = check_total[0] if len(check_total) > 0 else '0.00'
 
-    return check_date, check_company, check_total
+async def get_parsed_receipt(file_hash: str, prompt_version: Optional[str] = None) -> Optional[dict]:
+    """
+    Zwraca strukturalny wynik OCR paragonu (linie i dane kontrolne).
 
+    Wynik jest czytany z pliku `*_ocr_{version}.json`. Dla paragonów zapisanych
+    przed wprowadzeniem tego pliku tekst OCR jest parsowany raz, a wynik zapisywany.
 
-async def process_receipt_image(file: UploadFile, prompt_version: str = None) -> dict:
-    """Przetwarza obraz paragonu i wykonuje OCR"""
+    Args:
+        file_hash: Hash pliku obrazu.
+        prompt_version: Wersja promptu OCR (domyślnie wersja z metadanych paragonu).
+
+    Returns:
+        Słownik w formacie OCRResult lub None, jeśli paragonu nie znaleziono.
+    """
     if prompt_version is None:
-        prompt_version = settings.DEFAULT_PROMPT_VERSION
+        metadata = await get_receipt_by_hash(file_hash)
+        if not metadata:
+            return None
+        prompt_version = metadata['prompt_version']
 
-    # Wczytaj obraz
-    image_data = await file.read()
-    file_hash = calculate_sha256(image_data)
-    image = Image.open(io.BytesIO(image_data))
+    parsed = await load_parsed_result(file_hash, prompt_version)
+    if parsed is not None:
+        return parsed
 
-    # Popraw orientację obrazu
-    image_fixed = fix_rotation(image)
+    receipt_text = await load_ocr_text(file_hash, prompt_version)
+    if receipt_text is None:
+        return None
 
-    # Przekonwertuj obraz do base64
-    base64_image = convert_to_base64(image_fixed)
+    parsed = jsonable_encoder(build_ocr_result(file_hash, prompt_version, receipt_text))
+    await save_parsed_result(file_hash, prompt_version, parsed)
+    return parsed
 
-    # Wczytaj prompt i skonfiguruj OpenAI
-    ocr_prompt = load_prompt(version=prompt_version)
-    client = OpenAI(api_key=settings.OPENAI_API_KEY)
 
-    # Wykonaj OCR przy użyciu OpenAI
-    response = client.chat.completions.create(
-        model=settings.DEFAULT_LLM_MODEL,
-        messages=[
-            {
-                "role": "system",
-                "content": ocr_prompt,
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "Please analyze the following image and extract all text exactly as displayed, without modifications."
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
-                        },
+async def get_cached_result(file_hash: str, prompt_version: str, prompt_fingerprint: str) -> Optional[dict]:
+    """
+    Zwraca wcześniejszy wynik OCR dla obrazu i wersji promptu.
+
+    Najpierw sprawdza cache w pamięci, a następnie zapisany na dysku wynik
+    strukturalny (lub tekst OCR), który po odczycie trafia do cache w pamięci.
+    Wynik uzyskany promptem o innej treści (inny odcisk) nie jest zwracany.
+    Wyniki zapisane przed wprowadzeniem odcisków są traktowane jako aktualne.
+    """
+    cache_key = (file_hash, prompt_version, prompt_fingerprint)
+    result = ocr_cache.get(cache_key)
+    if result is not None:
+        return result
+
+    parsed = await get_parsed_receipt(file_hash, prompt_version)
+    if parsed is None:
+        return None
+
+    if parsed.get('prompt_fingerprint') not in (None, prompt_fingerprint):
+        return None
+
+    result = result_from_parsed(parsed)
+    ocr_cache.set(cache_key, result)
+    return result
+
+
+async def process_receipt_image(
+        file: UploadFile,
+        prompt_version: str = None,
+        use_cache: bool = True,
+        refresh_cache: bool = False,
+        use_osd: bool = True,
+) -> dict:
+    """
+    Przetwarza obraz paragonu i wykonuje OCR.
+
+    - **use_cache**: czy zwrócić zapisany wynik, jeśli obraz był już przetworzony
+    - **refresh_cache**: czy wymusić ponowny OCR i nadpisać wpis w cache
+    - **use_osd**: czy dopuścić wykrywanie orientacji przez Tesseract OSD
+    """
+    # Wczytaj obraz porcjami (hash liczony w trakcie odczytu)
+    with await ingest_upload(file) as upload:
+        return await process_receipt_data(
+            upload.source,
+            upload.file_hash,
+            prompt_version=prompt_version,
+            use_cache=use_cache,
+            refresh_cache=refresh_cache,
+            use_osd=use_osd,
+        )
+
+
+def resolve_prompt(prompt_version: Optional[str] = None) -> dict:
+    """
+    Zwraca prompt OCR z rejestru (domyślnie wersję z konfiguracji).
+
+    Raises:
+        HTTPException: Jeśli nie ma promptu o podanej wersji (400).
+    """
+    if prompt_version is None:
+        prompt_version = settings.DEFAULT_PROMPT_VERSION
+
+    try:
+        return prompt_registry.get(prompt_version)
+    except FileNotFoundError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Nieznana wersja promptu OCR: {prompt_version}"
+        )
+
+
+def build_llm_messages(prompt: dict, prepared_image: dict) -> List[dict]:
+    """Buduje wiadomości żądania OCR do LLM (prompt systemowy i obraz paragonu)"""
+    with track_stage("base64"):
+        base64_image = base64.b64encode(prepared_image['llm_bytes']).decode("utf-8")
+
+    return [
+        {
+            "role": "system",
+            "content": prompt['text'],
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": "Please analyze the following image and extract all text exactly as displayed, without modifications."
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{prepared_image['image_mime']};base64,{base64_image}",
+                        "detail": settings.image.LLM_IMAGE_DETAIL,
                     },
-                ],
-            }
-        ],
-        max_tokens=2500
+                },
+            ],
+        }
+    ]
+
+
+def build_llm_text_messages(prompt: dict, text: str) -> List[dict]:
+    """Buduje wiadomości żądania OCR do LLM dla strony PDF z warstwą tekstową (bez obrazu)"""
+    return [
+        {
+            "role": "system",
+            "content": prompt['text'],
+        },
+        {
+            "role": "user",
+            "content": (
+                "Please analyze the following text extracted from a receipt document and present it "
+                "exactly as written, without modifications.\n\n" + text
+            ),
+        }
+    ]
+
+
+def estimate_llm_tokens(prompt: dict, prepared_image: dict, max_tokens: Optional[int] = None) -> int:
+    """Szacuje tokeny wywołania OCR na potrzeby budżetu tokenów na minutę"""
+    return estimate_request_tokens(
+        prompt['text'],
+        prepared_image['llm_image']['width'],
+        prepared_image['llm_image']['height'],
+        max_tokens=max_tokens,
     )
 
-    receipt_text = response.choices[0].message.content
 
-    # Wyciągnij dane kontrolne
-    check_date, check_company, check_total = extract_check_data(receipt_text)
+async def finalize_ocr_result(
+        image_data: Union[bytes, str],
+        file_hash: str,
+        prompt: dict,
+        prepared_image: dict,
+        receipt_text: str,
+        tokens_in: int,
+        tokens_out: int,
+        near_duplicate: Optional[dict] = None,
+        routing: Optional[dict] = None,
+) -> dict:
+    """
+    Parsuje odpowiedź LLM, zapisuje pliki paragonu i aktualizuje cache.
+
+    `near_duplicate` (podobny wcześniej przetworzony paragon w trybie `flag`)
+    trafia do metadanych i wyniku, ale nie do cache. `routing` (z `request_routed_ocr`)
+    określa backend i model, który zwrócił odpowiedź, oraz kolejne próby.
+
+    Returns:
+        Wynik OCR w formacie odpowiedzi API (bez flagi `cached`).
+    """
+    prompt_version = prompt['version']
+    model = routing['model'] if routing else settings.DEFAULT_LLM_MODEL
+
+    # Sparsuj linie paragonu i dane kontrolne w jednym przebiegu
+    with track_stage("parse"):
+        parsed = build_ocr_result(
+            file_hash,
+            prompt_version,
+            receipt_text,
+            llm_model=model,
+            tokens_in=tokens_in,
+            tokens_out=tokens_out,
+        )
+    check_date, check_company, check_total = parsed.check.date, parsed.check.company, parsed.check.total
 
     # Dodaj informacje o modelu i tokenach
-    tokens_in = response.usage.prompt_tokens
-    tokens_out = response.usage.completion_tokens
-    receipt_text += f'\n| LLM MODEL | {settings.DEFAULT_LLM_MODEL} |\n| TOKENS IN | {tokens_in} |\n| TOKENS OUT | {tokens_out} |'
+    receipt_text += f'\n| LLM MODEL | {model} |\n| TOKENS IN | {tokens_in} |\n| TOKENS OUT | {tokens_out} |'
 
     # Dodaj hash pliku
     receipt_text += f'\n| HASH | {file_hash} |'
@@ -110,23 +313,797 @@ async def process_receipt_image(file: UploadFile, prompt_version: str = None) ->
     receipt_text += f'\n| OCR PROMPT VERSION | {prompt_version} |'
 
     # Zapisz pliki
-    save_receipt_files(
-        receipt_date=check_date,
-        file_hash=file_hash,
-        original_image=image,
-        fixed_image=image_fixed,
-        ocr_text=receipt_text,
-        prompt_version=prompt_version
-    )
+    with track_stage("storage"):
+        await save_receipt_files(
+            receipt_date=check_date,
+            file_hash=file_hash,
+            original_image=image_data,
+            fixed_image=prepared_image['fixed_bytes'],
+            ocr_text=receipt_text,
+            prompt_version=prompt_version,
+            prompt_fingerprint=prompt['fingerprint'],
+            check_company=check_company,
+            check_total=check_total,
+            llm_info={
+                'model': model,
+                'backend': routing['backend'] if routing else None,
+                'tokens_in': tokens_in,
+                'tokens_out': tokens_out,
+                'image': prepared_image['llm_image'],
+                **({'routing': {
+                    **({'features': prepared_image['features']} if prepared_image.get('features') else {}),
+                    'attempts': routing.get('attempts', []),
+                }} if routing else {}),
+            },
+            processing={
+                'orientation': prepared_image.get('orientation'),
+                **prepared_image.get('processing', {}),
+                **({'near_duplicate': near_duplicate} if near_duplicate else {}),
+            },
+            original_extension=prepared_image['original_extension'],
+            fixed_extension=prepared_image['fixed_extension'],
+            parsed_result={**jsonable_encoder(parsed), 'prompt_fingerprint': prompt['fingerprint']},
+            image_hash=prepared_image.get('image_hash'),
+        )
 
-    # Zwróć dane
-    return {
+    result = {
         'file_hash': file_hash,
         'check_date': check_date,
         'check_company': check_company,
         'check_total': check_total,
-        'llm_model': settings.DEFAULT_LLM_MODEL,
+        'llm_model': model,
         'tokens_in': tokens_in,
         'tokens_out': tokens_out,
         'ocr_prompt_version': prompt_version,
     }
+
+    # Świeży wynik zastępuje wpis w cache niezależnie od trybu żądania
+    if settings.storage.CACHE_ENABLED:
+        ocr_cache.set((file_hash, prompt_version, prompt['fingerprint']), result)
+
+    if near_duplicate:
+        return {**result, 'near_duplicate': near_duplicate}
+    return result
+
+
+@contextmanager
+def track_ocr_request(prompt_version: Optional[str]) -> Iterator[dict]:
+    """
+    Liczy żądania OCR i błędy dla wersji promptu i modelu oraz mierzy całkowity czas przetwarzania.
+
+    Zwraca etykiety żądania - przetwarzanie ustawia w nich `model` backendu, który
+    odpowiedział (lub modelu wyniku z cache), a liczniki są zwiększane na końcu żądania.
+    """
+    labels = {
+        'prompt_version': prompt_version or settings.DEFAULT_PROMPT_VERSION,
+        'model': settings.DEFAULT_LLM_MODEL,
+    }
+    if not settings.app.METRICS_ENABLED:
+        yield labels
+        return
+
+    try:
+        with track_stage("total"):
+            yield labels
+    except Exception as e:
+        OCR_ERRORS.inc(error=type(e).__name__, **labels)
+        raise
+    finally:
+        OCR_REQUESTS.inc(**labels)
+
+
+def record_cache_hit(request: dict, result: dict) -> None:
+    """Liczy żądanie OCR obsłużone z cache (z modelem, który utworzył wynik)"""
+    request['model'] = result['llm_model']
+    if settings.app.METRICS_ENABLED:
+        OCR_CACHE_HITS.inc(**request)
+
+
+def record_near_duplicate(action: str) -> None:
+    """Liczy obraz rozpoznany jako podobny do wcześniej przetworzonego paragonu"""
+    if settings.app.METRICS_ENABLED:
+        OCR_NEAR_DUPLICATES.inc(action=action)
+
+
+async def prepare_image(image_data: Union[bytes, str], use_osd: bool) -> dict:
+    """Wykonuje obróbkę obrazu w puli procesów i zapisuje czasy jej etapów"""
+    with track_stage("image"):
+        prepared_image = await run_image_task(prepare_receipt_image, image_data, use_osd)
+
+    for stage, seconds in prepared_image['timings'].items():
+        observe_stage(f"image_{stage}", seconds)
+
+    crop = prepared_image['processing'].get('crop')
+    if crop is not None and settings.app.METRICS_ENABLED:
+        IMAGE_CROP_PIXEL_RATIO.observe(crop['pixel_ratio'])
+
+    return prepared_image
+
+
+async def confirm_near_duplicate(candidate: str, prepared_image: dict) -> Optional[float]:
+    """
+    Porównuje profil wierszy tekstu obrazu z zapisanym obrazem podobnego paragonu.
+
+    Skróty percepcyjne bywają bliskie dla różnych paragonów o podobnym wyglądzie (ten sam
+    sklep, to samo tło), dlatego przed ponownym użyciem wyniku OCR potwierdzamy, że układ
+    linii tekstu obu paragonów jest zgodny. Zapisany obraz jest wczytywany tylko dla
+    kandydata z wynikiem OCR do ponownego użycia.
+
+    Returns:
+        Korelacja profili (do 1.0) lub None, jeśli nie da się jej wyznaczyć.
+    """
+    row_profile = prepared_image.get('row_profile')
+    receipt = await get_receipt_by_hash(candidate)
+    original_path = ((receipt or {}).get('file_paths') or {}).get('original')
+    if not row_profile or not original_path:
+        return None
+
+    try:
+        with track_stage("duplicate_confirm"):
+            fingerprint = await run_image_task(load_receipt_fingerprint, original_path)
+    except Exception as e:
+        logger.warning(f"Nie udało się wczytać obrazu podobnego paragonu {candidate}: {str(e)}")
+        return None
+    return round(profile_similarity(row_profile, fingerprint['row_profile']), 3)
+
+
+async def find_near_duplicate(file_hash: str, prompt: dict, prepared_image: dict, reuse: bool = True) -> Optional[dict]:
+    """
+    Szuka wcześniej przetworzonego paragonu o podobnym obrazie.
+
+    Obrazy są porównywane odległością Hamminga skrótów percepcyjnych obszaru paragonu
+    (co najwyżej `DUPLICATE_MAX_DISTANCE`, z uwzględnieniem obrotu o 180°). W trybie `flag`
+    zwracany jest najbardziej podobny paragon bez wyniku. W trybie `reuse` (i gdy `reuse`
+    jest prawdą) zwracany jest najbardziej podobny paragon z wynikiem OCR dla tej samej
+    wersji i treści promptu, jeśli profile wierszy tekstu obu obrazów są zgodne
+    (`DUPLICATE_MIN_SIMILARITY`) - w przeciwnym razie paragon jest tylko oznaczany.
+
+    Returns:
+        Słownik z haszem paragonu (`file_hash`), odległością (`distance`), korelacją profili
+        (`similarity`, jeśli była sprawdzana) i, jeśli wynik można użyć ponownie,
+        wynikiem OCR (`result`) lub None.
+    """
+    storage_settings = settings.storage
+    mode = storage_settings.DUPLICATE_MODE
+    image_hash = prepared_image.get('image_hash')
+    if mode not in ("reuse", "flag") or not image_hash:
+        return None
+
+    with track_stage("duplicate_lookup"):
+        distances = {}
+        for query_hash in (image_hash, prepared_image.get('image_hash_rotated')):
+            if not query_hash:
+                continue
+            for distance, candidate in duplicate_index.find(query_hash, storage_settings.DUPLICATE_MAX_DISTANCE):
+                if candidate != file_hash:
+                    distances[candidate] = min(distance, distances.get(candidate, distance))
+        candidates = sorted((distance, candidate) for candidate, distance in distances.items())
+
+    for distance, candidate in candidates:
+        if mode == "reuse" and reuse:
+            result = await get_cached_result(candidate, prompt['version'], prompt['fingerprint'])
+            if result is None:
+                continue
+            similarity = await confirm_near_duplicate(candidate, prepared_image)
+            if similarity is not None and similarity >= storage_settings.DUPLICATE_MIN_SIMILARITY:
+                record_near_duplicate("reuse")
+                return {'file_hash': candidate, 'distance': distance, 'similarity': similarity, 'result': result}
+
+            record_near_duplicate("flag")
+            return {'file_hash': candidate, 'distance': distance, 'similarity': similarity}
+
+        record_near_duplicate("flag")
+        return {'file_hash': candidate, 'distance': distance}
+
+    return None
+
+
+def select_backends(features: Optional[dict]) -> List[LLMBackend]:
+    """
+    Wybiera backendy LLM dla paragonu na podstawie tanich cech obrazu lub tekstu.
+
+    Pierwszym backendem jest najtańszy, którego limity obejmują cechy paragonu
+    (`lines`, `aspect`, `pixels`), a kolejne - silniejsze backendy, do których
+    trafia paragon po nieudanej walidacji wyniku. Backend domyślny nie ma limitów,
+    więc zawsze jest ostatnim szczeblem.
+    """
+    backends = [backend for backend in get_llm_backends() if backend.accepts(features or {})]
+    if not settings.routing.ESCALATION_ENABLED:
+        return backends[:1]
+    return backends
+
+
+def record_llm_tokens(prompt: dict, backend: LLMBackend, tokens_in: int, tokens_out: int) -> None:
+    """Liczy tokeny wywołania LLM dla wersji promptu i modelu backendu"""
+    if not settings.app.METRICS_ENABLED:
+        return
+    LLM_TOKENS.inc(tokens_in, prompt_version=prompt['version'], model=backend.model, direction="in")
+    LLM_TOKENS.inc(tokens_out, prompt_version=prompt['version'], model=backend.model, direction="out")
+
+
+def check_ocr_response(receipt_text: str, finish_reason: Optional[str], check: bool = True) -> List[str]:
+    """Zwraca problemy odpowiedzi LLM (walidacja wyniku i odpowiedź obcięta limitem tokenów)"""
+    problems = validate_receipt_text(receipt_text, check=check)
+    if finish_reason == "length":
+        problems.append("truncated")
+    return problems
+
+
+def record_escalation(backend: LLMBackend, problems: List[str]) -> None:
+    """Liczy ponowienie OCR silniejszym backendem"""
+    logger.info(f"Wynik backendu LLM {backend.name} ({backend.model}) nie przeszedł walidacji: {problems}")
+    if settings.app.METRICS_ENABLED:
+        OCR_ESCALATIONS.inc(backend=backend.name, reason=problems[0])
+
+
+async def request_ocr_completion(
+        backend: LLMBackend,
+        prompt: dict,
+        messages: List[dict],
+        estimated_tokens: int,
+) -> Tuple[str, int, int, Optional[str]]:
+    """
+    Wykonuje wywołanie OCR do backendu LLM (bez strumieniowania).
+
+    Returns:
+        Krotka (treść odpowiedzi, tokeny wejściowe, tokeny wyjściowe, powód zakończenia odpowiedzi).
+    """
+    client = backend.client
+
+    # Harmonogram pilnuje limitów zapytań i tokenów oraz ponawia wywołania po błędach przejściowych
+    async with backend.scheduler.slot(estimated_tokens) as call:
+        with track_stage("llm"):
+            response = await call.send(lambda: client.chat.completions.create(
+                model=backend.model,
+                messages=messages,
+                max_tokens=backend.max_tokens
+            ))
+        call.record_usage(response.usage.prompt_tokens + response.usage.completion_tokens)
+
+    tokens_in, tokens_out = response.usage.prompt_tokens, response.usage.completion_tokens
+    record_llm_tokens(prompt, backend, tokens_in, tokens_out)
+
+    choice = response.choices[0]
+    return choice.message.content, tokens_in, tokens_out, choice.finish_reason
+
+
+async def stream_ocr_completion(
+        backend: LLMBackend,
+        prompt: dict,
+        messages: List[dict],
+        estimated_tokens: int,
+        on_line: Callable[[dict], None],
+) -> Tuple[str, int, int, Optional[str]]:
+    """
+    Wykonuje wywołanie OCR do backendu LLM ze strumieniowaniem odpowiedzi.
+
+    Każdy kompletny wiersz tabeli RECEIPT jest przekazywany do `on_line` (OCRLine
+    jako słownik), gdy tylko zostanie odczytany z odpowiedzi.
+
+    Returns:
+        Krotka jak z `request_ocr_completion`.
+    """
+    client = backend.client
+    chunks = []
+    pending = ''
+    usage = None
+    finish_reason = None
+
+    async with backend.scheduler.slot(estimated_tokens) as call:
+        with track_stage("llm"):
+            started = time.perf_counter()
+            first_token = True
+            # Ponowienia są możliwe tylko przed otrzymaniem pierwszego fragmentu odpowiedzi
+            stream = await call.send(lambda: client.chat.completions.create(
+                model=backend.model,
+                messages=messages,
+                max_tokens=backend.max_tokens,
+                stream=True,
+                stream_options={"include_usage": True},
+            ))
+
+            async for chunk in stream:
+                # Ostatni fragment strumienia zawiera tylko zużycie tokenów
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].finish_reason:
+                    finish_reason = chunk.choices[0].finish_reason
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+
+                if first_token:
+                    observe_stage("llm_first_token", time.perf_counter() - started)
+                    first_token = False
+
+                content = chunk.choices[0].delta.content
+                chunks.append(content)
+                pending += content
+
+                # Parsuj tylko kompletne wiersze - ostatni może jeszcze być niepełny
+                *complete_lines, pending = pending.split('\n')
+                for raw_line in complete_lines:
+                    line = parse_table_line(raw_line)
+                    if line is not None:
+                        on_line(jsonable_encoder(line))
+
+        if usage is not None:
+            call.record_usage(usage.prompt_tokens + usage.completion_tokens)
+
+    line = parse_table_line(pending)
+    if line is not None:
+        on_line(jsonable_encoder(line))
+
+    tokens_in = usage.prompt_tokens if usage is not None else 0
+    tokens_out = usage.completion_tokens if usage is not None else 0
+    record_llm_tokens(prompt, backend, tokens_in, tokens_out)
+    return ''.join(chunks), tokens_in, tokens_out, finish_reason
+
+
+async def request_routed_ocr(
+        prompt: dict,
+        messages: List[dict],
+        backends: List[LLMBackend],
+        estimate_tokens: Callable[[int], int],
+        check: bool = True,
+        attempts: Optional[List[dict]] = None,
+        request: Optional[dict] = None,
+) -> dict:
+    """
+    Wykonuje OCR kolejnymi backendami, aż wynik przejdzie walidację.
+
+    Args:
+        prompt: Prompt OCR z rejestru.
+        messages: Wiadomości żądania (takie same dla każdego backendu).
+        backends: Backendy od wybranego przez router do najsilniejszego (`select_backends`).
+        estimate_tokens: Szacunek tokenów wywołania dla limitu odpowiedzi backendu.
+        check: Czy walidacja wymaga daty i kwoty (patrz `validate_receipt_text`).
+        attempts: Wcześniejsze próby (np. strumieniowana odpowiedź pierwszego backendu).
+        request: Etykiety żądania z `track_ocr_request` - ustawiany jest w nich model bieżącej próby.
+
+    Returns:
+        Słownik z odpowiedzią ostatniego backendu (`text`), tokenami wszystkich prób
+        i opisem wyboru backendu (`routing`: `backend`, `model`, `attempts`).
+    """
+    attempts = list(attempts or [])
+
+    for index, backend in enumerate(backends):
+        if request is not None:
+            request['model'] = backend.model
+        receipt_text, tokens_in, tokens_out, finish_reason = await request_ocr_completion(
+            backend, prompt, messages, estimate_tokens(backend.max_tokens),
+        )
+        problems = check_ocr_response(receipt_text, finish_reason, check=check)
+        attempts.append({
+            **backend.describe(),
+            'tokens_in': tokens_in,
+            'tokens_out': tokens_out,
+            'problems': problems,
+        })
+
+        if not problems or index == len(backends) - 1:
+            break
+        record_escalation(backend, problems)
+
+    return {
+        'text': receipt_text,
+        'tokens_in': sum(attempt['tokens_in'] for attempt in attempts),
+        'tokens_out': sum(attempt['tokens_out'] for attempt in attempts),
+        'routing': {'backend': backend.name, 'model': backend.model, 'attempts': attempts},
+    }
+
+
+def use_pdf_text(text: str) -> bool:
+    """Sprawdza, czy stronę PDF można wysłać do LLM jako osadzony tekst zamiast obrazu"""
+    return settings.image.PDF_TEXT_ENABLED and len(text) >= settings.image.PDF_MIN_TEXT_CHARS
+
+
+async def ocr_pdf_page(image_data: Union[bytes, str], prompt: dict, page_index: int, text: str) -> dict:
+    """
+    Wykonuje OCR jednej strony dokumentu PDF.
+
+    Strona z osadzonym tekstem (co najmniej `PDF_MIN_TEXT_CHARS` znaków) jest wysyłana
+    do LLM jako tekst - bez renderowania obrazu. Pozostałe strony są renderowane
+    w puli procesów dopiero w tym momencie. Backend LLM jest wybierany osobno dla każdej strony.
+
+    Returns:
+        Słownik z odpowiedzią LLM (`text`), tokenami, opisem strony (`page`)
+        i wyborem backendu (`routing`).
+    """
+    if use_pdf_text(text):
+        messages = build_llm_text_messages(prompt, text)
+        features = {'lines': text.count('\n') + 1}
+        page = {'page': page_index + 1, 'source': 'text', 'chars': len(text)}
+
+        def estimate_tokens(max_tokens: int) -> int:
+            return estimate_request_tokens(prompt['text'] + text, max_tokens=max_tokens)
+    else:
+        with track_stage("image"):
+            prepared_page = await run_image_task(prepare_pdf_page, image_data, page_index)
+
+        for stage, seconds in prepared_page['timings'].items():
+            observe_stage(f"image_{stage}", seconds)
+
+        messages = build_llm_messages(prompt, prepared_page)
+        features = prepared_page['features']
+        page = {**prepared_page['llm_image'], 'source': 'image'}
+
+        def estimate_tokens(max_tokens: int) -> int:
+            return estimate_llm_tokens(prompt, prepared_page, max_tokens)
+
+    # Pojedyncza strona nie musi zawierać daty ani sumy - walidowane są tylko linie
+    routed = await request_routed_ocr(prompt, messages, select_backends(features), estimate_tokens, check=False)
+    page.update(features=features, backend=routed['routing']['backend'])
+    return {**routed, 'page': page}
+
+
+async def process_pdf_data(image_data: Union[bytes, str], file_hash: str, prompt: dict) -> dict:
+    """
+    Wykonuje OCR dokumentu PDF (np. e-paragonu lub wielostronicowej faktury).
+
+    Strony są przetwarzane równolegle (liczbę jednoczesnych wywołań LLM ogranicza
+    harmonogram), a odpowiedzi łączone w jeden paragon z ciągłą numeracją linii.
+
+    Raises:
+        HTTPException: Jeśli obsługa PDF jest niedostępna (415), dokument ma zbyt wiele
+            stron (413) lub nie można go odczytać (400).
+    """
+    if not pdf_support_available():
+        raise HTTPException(
+            status_code=415,
+            detail="Obsługa plików PDF wymaga pakietu pypdfium2"
+        )
+
+    try:
+        with track_stage("pdf_inspect"):
+            document = await run_image_task(inspect_pdf, image_data)
+    except RuntimeError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Nie można odczytać pliku PDF: {str(e)}"
+        )
+
+    if document['pages'] == 0:
+        raise HTTPException(status_code=400, detail="Plik PDF nie zawiera stron")
+
+    if document['pages'] > settings.image.PDF_MAX_PAGES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Plik PDF ma zbyt wiele stron ({document['pages']}, maksymalnie {settings.image.PDF_MAX_PAGES})"
+        )
+
+    # Strony renderowane są w osobnych zadaniach puli procesów - dokument trzymany w pamięci
+    # zapisujemy raz do pliku tymczasowego, żeby nie serializować jego bajtów dla każdej strony
+    image_pages = sum(1 for text in document['texts'] if not use_pdf_text(text))
+    spool_path = None
+    if isinstance(image_data, bytes) and image_pages > 1:
+        spool_path = await asyncio.to_thread(spool_to_file, image_data)
+
+    try:
+        pages = await asyncio.gather(*(
+            ocr_pdf_page(spool_path or image_data, prompt, index, text)
+            for index, text in enumerate(document['texts'])
+        ))
+    finally:
+        if spool_path is not None:
+            os.remove(spool_path)
+
+    page_info = [page['page'] for page in pages]
+    text_pages = sum(1 for page in page_info if page['source'] == 'text')
+
+    # Model paragonu to najsilniejszy backend użyty dla którejkolwiek strony
+    backends = get_llm_backends()
+    used = {page['backend'] for page in page_info}
+    backend = [backend for backend in backends if backend.name in used][-1]
+    prepared_document = {
+        'fixed_bytes': None,
+        'original_extension': 'pdf',
+        'fixed_extension': 'jpg',
+        'llm_image': {'format': 'PDF', 'pages': page_info},
+        'processing': {
+            'pdf': {
+                'pages': len(pages),
+                'text_pages': text_pages,
+                'image_pages': len(pages) - text_pages,
+                'dpi': settings.image.PDF_RENDER_DPI,
+            },
+        },
+    }
+
+    return await finalize_ocr_result(
+        image_data,
+        file_hash,
+        prompt,
+        prepared_document,
+        merge_receipt_pages([page['text'] for page in pages]),
+        sum(page['tokens_in'] for page in pages),
+        sum(page['tokens_out'] for page in pages),
+        routing={
+            'backend': backend.name,
+            'model': backend.model,
+            'attempts': [attempt for page in pages for attempt in page['routing']['attempts']],
+        },
+    )
+
+
+async def process_receipt_data(
+        image_data: Union[bytes, str],
+        file_hash: str,
+        prompt_version: str = None,
+        use_cache: bool = True,
+        refresh_cache: bool = False,
+        use_osd: bool = True,
+) -> dict:
+    """
+    Wykonuje OCR dla wczytanego obrazu paragonu o znanym haszu.
+
+    `image_data` to bajty obrazu albo ścieżka do pliku z obrazem - duże pliki
+    nie muszą być wtedy wczytywane do pamięci procesu obsługującego żądania.
+    """
+    with track_ocr_request(prompt_version) as request:
+        # Prompt z rejestru w pamięci (odcisk treści jest częścią klucza cache)
+        prompt = resolve_prompt(prompt_version)
+
+        # Sprawdź, czy ten sam obraz był już przetworzony tą wersją promptu
+        if settings.storage.CACHE_ENABLED and use_cache and not refresh_cache:
+            cached_result = await get_cached_result(file_hash, prompt['version'], prompt['fingerprint'])
+            if cached_result is not None:
+                record_cache_hit(request, cached_result)
+                cached_result['cached'] = True
+                return cached_result
+
+        # Dokumenty PDF są przetwarzane strona po stronie
+        if is_pdf(image_data):
+            result = await process_pdf_data(image_data, file_hash, prompt)
+            request['model'] = result['llm_model']
+            return {**result, 'cached': False}
+
+        # Dekodowanie, poprawa orientacji i kodowanie obrazu w puli procesów
+        prepared_image = await prepare_image(image_data, use_osd)
+
+        # Podobny obraz (np. ponowne zdjęcie tego samego paragonu) - wynik bez wywołania LLM
+        near_duplicate = await find_near_duplicate(
+            file_hash, prompt, prepared_image, reuse=use_cache and not refresh_cache,
+        )
+        if near_duplicate is not None and 'result' in near_duplicate:
+            result = near_duplicate.pop('result')
+            request['model'] = result['llm_model']
+            return {**result, 'cached': True, 'near_duplicate': near_duplicate}
+
+        # Wykonaj OCR najtańszym backendem odpowiednim dla paragonu (bez blokowania pętli zdarzeń)
+        messages = build_llm_messages(prompt, prepared_image)
+        routed = await request_routed_ocr(
+            prompt,
+            messages,
+            select_backends(prepared_image['features']),
+            lambda max_tokens: estimate_llm_tokens(prompt, prepared_image, max_tokens),
+            request=request,
+        )
+
+        result = await finalize_ocr_result(
+            image_data,
+            file_hash,
+            prompt,
+            prepared_image,
+            routed['text'],
+            routed['tokens_in'],
+            routed['tokens_out'],
+            near_duplicate,
+            routed['routing'],
+        )
+
+        # Zwróć dane
+        return {**result, 'cached': False}
+
+
+async def stream_receipt_data(
+        image_data: Union[bytes, str],
+        file_hash: str,
+        prompt_version: str = None,
+        use_cache: bool = True,
+        refresh_cache: bool = False,
+        use_osd: bool = True,
+) -> AsyncIterator[Tuple[str, dict]]:
+    """
+    Wykonuje OCR jak `process_receipt_data`, ale zwraca wynik przyrostowo.
+
+    Odpowiedź LLM jest pobierana strumieniowo (`stream=True`), a każdy kompletny
+    wiersz tabeli RECEIPT jest od razu zwracany jako zdarzenie `line` (OCRLine).
+    Po zapisaniu plików zwracane jest zdarzenie `result` z danymi kontrolnymi,
+    tokenami i haszem. Wynik z cache jest zwracany w ten sam sposób.
+
+    Strumieniowana jest odpowiedź backendu wybranego przez router. Jeśli nie przejdzie
+    walidacji, zwracane jest zdarzenie `reset` (dotychczasowe linie należy odrzucić),
+    a linie odpowiedzi silniejszego backendu są zwracane po jej otrzymaniu w całości.
+
+    Yields:
+        Pary (nazwa_zdarzenia, dane).
+    """
+    with track_ocr_request(prompt_version) as request:
+        prompt = resolve_prompt(prompt_version)
+
+        if settings.storage.CACHE_ENABLED and use_cache and not refresh_cache:
+            cached_result = await get_cached_result(file_hash, prompt['version'], prompt['fingerprint'])
+            if cached_result is not None:
+                record_cache_hit(request, cached_result)
+                parsed = await get_parsed_receipt(file_hash, prompt['version']) or {'lines': []}
+                for line in parsed['lines']:
+                    yield 'line', line
+                yield 'result', {**cached_result, 'cached': True}
+                return
+
+        # Strony PDF są przetwarzane równolegle - linie są zwracane po połączeniu stron
+        if is_pdf(image_data):
+            result = await process_pdf_data(image_data, file_hash, prompt)
+            request['model'] = result['llm_model']
+            parsed = await get_parsed_receipt(file_hash, prompt['version']) or {'lines': []}
+            for line in parsed['lines']:
+                yield 'line', line
+            yield 'result', {**result, 'cached': False}
+            return
+
+        prepared_image = await prepare_image(image_data, use_osd)
+
+        near_duplicate = await find_near_duplicate(
+            file_hash, prompt, prepared_image, reuse=use_cache and not refresh_cache,
+        )
+        if near_duplicate is not None and 'result' in near_duplicate:
+            result = near_duplicate.pop('result')
+            request['model'] = result['llm_model']
+            parsed = await get_parsed_receipt(result['file_hash'], prompt['version']) or {'lines': []}
+            for line in parsed['lines']:
+                yield 'line', line
+            yield 'result', {**result, 'cached': True, 'near_duplicate': near_duplicate}
+            return
+
+        backends = select_backends(prepared_image['features'])
+        backend = backends[0]
+        request['model'] = backend.model
+
+        def estimate_tokens(max_tokens: int) -> int:
+            return estimate_llm_tokens(prompt, prepared_image, max_tokens)
+
+        messages = build_llm_messages(prompt, prepared_image)
+
+        # Odpowiedź LLM jest czytana w osobnym zadaniu do bufora linii - miejsce w harmonogramie
+        # jest zwalniane po zakończeniu odpowiedzi, a nie po odebraniu linii przez wolnego klienta
+        buffered_lines: asyncio.Queue = asyncio.Queue()
+        reader = asyncio.create_task(stream_ocr_completion(
+            backend, prompt, messages, estimate_tokens(backend.max_tokens), buffered_lines.put_nowait,
+        ))
+        reader.add_done_callback(lambda _: buffered_lines.put_nowait(None))
+        try:
+            while (line := await buffered_lines.get()) is not None:
+                yield 'line', line
+            receipt_text, tokens_in, tokens_out, finish_reason = await reader
+        finally:
+            # Klient rozłączył się w trakcie odpowiedzi - przerwij jej odczyt
+            reader.cancel()
+
+        problems = check_ocr_response(receipt_text, finish_reason)
+        routed = {
+            'text': receipt_text,
+            'tokens_in': tokens_in,
+            'tokens_out': tokens_out,
+            'routing': {
+                'backend': backend.name,
+                'model': backend.model,
+                'attempts': [{
+                    **backend.describe(),
+                    'tokens_in': tokens_in,
+                    'tokens_out': tokens_out,
+                    'problems': problems,
+                }],
+            },
+        }
+
+        # Wynik nie przeszedł walidacji - ponów silniejszym backendem (bez strumieniowania)
+        if problems and len(backends) > 1:
+            record_escalation(backend, problems)
+            yield 'reset', {'backend': backend.name, 'problems': problems}
+
+            routed = await request_routed_ocr(
+                prompt, messages, backends[1:], estimate_tokens,
+                attempts=routed['routing']['attempts'], request=request,
+            )
+            lines, _, _ = parse_receipt_text(routed['text'])
+            for line in lines:
+                yield 'line', jsonable_encoder(line)
+
+        result = await finalize_ocr_result(
+            image_data,
+            file_hash,
+            prompt,
+            prepared_image,
+            routed['text'],
+            routed['tokens_in'],
+            routed['tokens_out'],
+            near_duplicate,
+            routed['routing'],
+        )
+
+        yield 'result', {**result, 'cached': False}
+
+
+async def process_receipt_batch(
+        files: List[UploadFile],
+        prompt_version: str = None,
+        use_cache: bool = True,
+        refresh_cache: bool = False,
+        use_osd: bool = True,
+) -> List[dict]:
+    """
+    Przetwarza wiele obrazów paragonów równolegle.
+
+    Pliki są deduplikowane po haszu, a liczba jednocześnie przetwarzanych
+    obrazów jest ograniczona przez `BATCH_MAX_CONCURRENCY`. Błąd jednego pliku
+    jest zwracany w jego pozycji i nie przerywa przetwarzania pozostałych.
+
+    Returns:
+        Lista pozycji w kolejności plików: `filename`, `file_hash`, `duplicate`,
+        `result` (wynik OCR lub None) i `error` (komunikat błędu lub None).
+    """
+    semaphore = asyncio.Semaphore(settings.app.BATCH_MAX_CONCURRENCY)
+
+    items = []
+    uploads = {}
+    for file in files:
+        item = {
+            'filename': file.filename or '',
+            'file_hash': None,
+            'duplicate': False,
+            'result': None,
+            'error': None,
+        }
+        items.append(item)
+
+        is_valid, error_message = validate_image_filename(file.filename)
+        if not is_valid:
+            item['error'] = error_message
+            continue
+
+        try:
+            upload = await ingest_upload(file)
+        except HTTPException as e:
+            item['error'] = str(e.detail)
+            continue
+
+        item['file_hash'] = upload.file_hash
+        if upload.file_hash in uploads:
+            item['duplicate'] = True
+            upload.close()
+        else:
+            uploads[upload.file_hash] = upload
+
+    async def process_one(upload: IngestedUpload) -> dict:
+        file_hash = upload.file_hash
+        async with semaphore:
+            try:
+                result = await process_receipt_data(
+                    upload.source,
+                    file_hash,
+                    prompt_version=prompt_version,
+                    use_cache=use_cache,
+                    refresh_cache=refresh_cache,
+                    use_osd=use_osd,
+                )
+                return {'result': result, 'error': None}
+            except HTTPException as e:
+                return {'result': None, 'error': str(e.detail)}
+            except Exception as e:
+                logger.error(f"Błąd przetwarzania paragonu {file_hash}: {str(e)}", exc_info=True)
+                return {'result': None, 'error': f"{type(e).__name__}: {str(e)}"}
+            finally:
+                upload.close()
+
+    try:
+        outcomes = await asyncio.gather(*(process_one(upload) for upload in uploads.values()))
+    finally:
+        for upload in uploads.values():
+            upload.close()
+    outcomes = dict(zip(uploads, outcomes))
+
+    for item in items:
+        if item['file_hash'] is not None:
+            item.update(outcomes[item['file_hash']])
+
+    return items
@@ -0,0 +1,174 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+PROMPT_FILE_PREFIX = "ocr_v"
+PROMPT_FILE_SUFFIX = ".txt"
+
+
+class PromptRegistry:
+    """
+    Rejestr promptów OCR trzymanych w pamięci.
+
+    Wszystkie wersje z `PROMPT_DIR` są wczytywane raz, a później co
+    `PROMPT_RELOAD_INTERVAL` sekund sprawdzane są czasy modyfikacji katalogu
+    i plików - zmienione lub nowe prompty są wczytywane bez restartu aplikacji.
+    Każdy prompt ma odcisk treści (`fingerprint`) używany w kluczu cache wyników OCR.
+    """
+
+    def __init__(self, directory: str, reload_interval: float = 2.0):
+        self.directory = directory
+        self.reload_interval = reload_interval
+        self._prompts: Dict[str, Dict[str, Any]] = {}
+        self._dir_mtime: Optional[float] = None
+        self._checked_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _read_prompt(version: str, path: Path) -> Dict[str, Any]:
+        text = path.read_text(encoding="utf-8")
+        return {
+            "version": version,
+            "text": text,
+            "fingerprint": hashlib.sha256(text.encode("utf-8")).hexdigest()[:16],
+            "path": str(path),
+            "mtime": path.stat().st_mtime,
+        }
+
+    def _scan(self) -> Dict[str, Any]:
+        """Wczytuje nowe i zmienione prompty oraz usuwa prompty bez plików (wywoływane pod blokadą)"""
+        stats = {"loaded": [], "removed": []}
+        prompt_dir = Path(self.directory)
+
+        if not prompt_dir.exists():
+            stats["removed"] = sorted(self._prompts)
+            self._prompts = {}
+            self._dir_mtime = None
+            return stats
+
+        self._dir_mtime = prompt_dir.stat().st_mtime
+        # Nowy słownik podmieniany w całości - odczyty bez blokady widzą spójny stan
+        prompts = dict(self._prompts)
+        found = set()
+
+        for path in prompt_dir.glob(f"{PROMPT_FILE_PREFIX}*{PROMPT_FILE_SUFFIX}"):
+            version = path.stem[len(PROMPT_FILE_PREFIX):]
+            found.add(version)
+
+            current = prompts.get(version)
+            try:
+                if current is not None and current["mtime"] == path.stat().st_mtime:
+                    continue
+                prompts[version] = self._read_prompt(version, path)
+            except OSError as e:
+                logger.warning(f"Nie udało się wczytać promptu {path}: {str(e)}")
+                continue
+
+            stats["loaded"].append(version)
+
+        for version in list(prompts):
+            if version not in found:
+                del prompts[version]
+                stats["removed"].append(version)
+
+        self._prompts = prompts
+
+        if stats["loaded"] or stats["removed"]:
+            logger.info(f"Zaktualizowano rejestr promptów: {stats}")
+
+        return stats
+
+    def _is_stale(self) -> bool:
+        """Sprawdza czasy modyfikacji katalogu i wczytanych plików promptów"""
+        try:
+            if Path(self.directory).stat().st_mtime != self._dir_mtime:
+                return True
+        except OSError:
+            return self._dir_mtime is not None
+
+        for prompt in self._prompts.values():
+            try:
+                if os.path.getmtime(prompt["path"]) != prompt["mtime"]:
+                    return True
+            except OSError:
+                return True
+
+        return False
+
+    def _refresh(self) -> None:
+        """Wczytuje prompty przy pierwszym użyciu i okresowo sprawdza zmiany plików"""
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is None:
+                self._scan()
+            elif self.reload_interval > 0 and now - self._checked_at >= self.reload_interval:
+                if self._is_stale():
+                    self._scan()
+            else:
+                return
+            self._checked_at = now
+
+    def reload(self) -> Dict[str, Any]:
+        """
+        Wymusza ponowne wczytanie promptów z dysku.
+
+        Returns:
+            Listy wersji wczytanych (nowych lub zmienionych) i usuniętych.
+        """
+        with self._lock:
+            stats = self._scan()
+            self._checked_at = time.monotonic()
+        return stats
+
+    def get(self, version: str) -> Dict[str, Any]:
+        """
+        Zwraca prompt o podanej wersji.
+
+        Returns:
+            Słownik z kluczami `version`, `text`, `fingerprint`, `path` i `mtime`.
+
+        Raises:
+            FileNotFoundError: Jeśli nie ma promptu o tej wersji.
+        """
+        self._refresh()
+        prompt = self._prompts.get(version)
+
+        if prompt is None:
+            # Plik mógł zostać dodany przed upływem interwału sprawdzania
+            prompt_path = Path(self.directory) / f"{PROMPT_FILE_PREFIX}{version}{PROMPT_FILE_SUFFIX}"
+            if prompt_path.exists():
+                self.reload()
+                prompt = self._prompts.get(version)
+
+        if prompt is None:
+            raise FileNotFoundError(
+                f"⚠️ Plik prompta {self.directory}/{PROMPT_FILE_PREFIX}{version}{PROMPT_FILE_SUFFIX} nie istnieje!"
+            )
+
+        return prompt
+
+    def versions(self) -> List[str]:
+        """Zwraca posortowaną listę dostępnych wersji promptów"""
+        self._refresh()
+        return sorted(self._prompts)
+
+    def describe(self) -> List[Dict[str, Any]]:
+        """Zwraca informacje o wczytanych promptach (bez treści)"""
+        self._refresh()
+        prompts = self._prompts
+        return [
+            {key: value for key, value in prompts[version].items() if key != "text"}
+            for version in sorted(prompts)
+        ]
+
+
+# Współdzielona instancja rejestru dla całej aplikacji
+prompt_registry = PromptRegistry(settings.storage.PROMPT_DIR, settings.storage.PROMPT_RELOAD_INTERVAL)
@@ -1,12 +1,28 @@
 import os
 import json
+import shutil
+import asyncio
+import logging
+import hashlib
+import tempfile
 from pathlib import Path
-from typing import Dict, Any, Optional, List
+from functools import lru_cache
+from typing import Dict, Any, Optional, List, Tuple, Union
 from datetime import datetime
 
-from PIL import Image
-
 from app.core.config import settings
+from app.services.index import receipt_index, encode_cursor, decode_cursor
+from app.services.analytics import analytics_store
+from app.services.duplicates import duplicate_index
+from app.utils.image import render_image_variant, run_image_task
+from app.utils.pdf import render_pdf_variant
+from app.utils.parser import extract_receipt_facts, parse_amount, parse_receipt_text
+
+logger = logging.getLogger(__name__)
+
+
+# Katalog z pomniejszonymi wersjami obrazów (wewnątrz katalogu paragonu)
+VARIANTS_DIR = "variants"
 
 
 def ensure_directory_exists(directory: str) -> None:
@@ -14,93 +30,515 @@ def ensure_directory_exists(directory: str) -> None:
     os.makedirs(directory, exist_ok=True)
 
 
-def save_receipt_files(
+def atomic_write(path: str, data: Union[bytes, str]) -> None:
+    """
+    Zapisuje plik atomowo: dane trafiają do pliku tymczasowego w tym samym
+    katalogu, który po zapisaniu na dysk jest przenoszony na miejsce docelowe.
+    Przerwany zapis nie zostawia więc częściowo zapisanego pliku.
+    """
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data.encode("utf-8") if isinstance(data, str) else data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def atomic_copy(source_path: str, path: str) -> None:
+    """Kopiuje plik atomowo (przez plik tymczasowy w katalogu docelowym)"""
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+    try:
+        with open(source_path, "rb") as source, os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(source, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def write_json(path: str, data: Any, indent: Optional[int] = None) -> None:
+    """Zapisuje plik JSON atomowo"""
+    atomic_write(path, json.dumps(data, ensure_ascii=False, indent=indent))
+
+
+async def path_exists(path: str) -> bool:
+    """Sprawdza istnienie pliku poza pętlą zdarzeń"""
+    return await asyncio.to_thread(os.path.exists, path)
+
+
+def _save_receipt_files(
         receipt_date: str,
         file_hash: str,
-        original_image: Image.Image,
-        fixed_image: Image.Image,
+        original_image: Union[bytes, str],
+        fixed_image: Optional[bytes],
         ocr_text: str,
-        prompt_version: str
+        prompt_version: str,
+        prompt_fingerprint: Optional[str] = None,
+        check_company: Optional[str] = None,
+        check_total: Optional[str] = None,
+        llm_info: Optional[Dict[str, Any]] = None,
+        processing: Optional[Dict[str, Any]] = None,
+        original_extension: str = "jpg",
+        fixed_extension: str = "jpg",
+        parsed_result: Optional[Dict[str, Any]] = None,
+        image_hash: Optional[str] = None,
 ) -> None:
-    """Zapisuje pliki paragonu w odpowiedniej strukturze katalogów"""
+    """
+    Zapisuje atomowo pliki paragonu (obrazy, tekst OCR, wynik i metadane) w katalogu `DATA_DIR/{data}/{hash}`.
+
+    Args:
+        receipt_date: Data paragonu (YYYYMMDD) - nazwa katalogu.
+        file_hash: Hash SHA-256 oryginalnego pliku.
+        original_image: Bajty oryginału lub ścieżka do pliku tymczasowego (zapisywany bez zmian).
+        fixed_image: Zakodowany obraz po poprawie orientacji lub None, jeśli się nie zmienił.
+        ocr_text: Tekst OCR zwrócony przez LLM.
+        prompt_version: Wersja promptu OCR.
+        prompt_fingerprint: Odcisk treści promptu.
+        check_company: Sprzedawca z tabeli kontrolnej.
+        check_total: Kwota z tabeli kontrolnej.
+        llm_info: Model, tokeny i rozmiar obrazu wysłanego do LLM.
+        processing: Opis etapów obróbki obrazu.
+        original_extension: Rozszerzenie pliku oryginału.
+        fixed_extension: Rozszerzenie poprawionego obrazu.
+        parsed_result: Linie i dane kontrolne w formacie OCRResult.
+        image_hash: Skrót percepcyjny obrazu (wykrywanie podobnych zdjęć).
+    """
 
     # Ścieżka do katalogu z plikami
     output_dir = os.path.join(settings.DATA_DIR, receipt_date, file_hash)
     ensure_directory_exists(output_dir)
 
-    # Zapis obrazków
-    original_image.save(os.path.join(output_dir, f"{file_hash}.jpg"), format="JPEG")
-    fixed_image.save(os.path.join(output_dir, f"{file_hash}_fixed.jpg"), format="JPEG")
+    # Zapis obrazków bez ponownego kodowania
+    original_path = os.path.join(output_dir, f"{file_hash}.{original_extension}")
+    if isinstance(original_image, bytes):
+        atomic_write(original_path, original_image)
+    else:
+        atomic_copy(original_image, original_path)
+
+    fixed_path = None
+    if fixed_image is not None:
+        fixed_path = os.path.join(output_dir, f"{file_hash}_fixed.{fixed_extension}")
+        atomic_write(fixed_path, fixed_image)
+
+    # Usuń obraz poprawiony z wcześniejszego przetwarzania, jeśli nie jest już aktualny
+    for file_name in os.listdir(output_dir):
+        stale_path = os.path.join(output_dir, file_name)
+        if file_name.startswith(f"{file_hash}_fixed.") and stale_path != fixed_path:
+            os.remove(stale_path)
+
+    # Pomniejszone wersje obrazów są tworzone ponownie z nowych plików
+    shutil.rmtree(os.path.join(output_dir, VARIANTS_DIR), ignore_errors=True)
 
     # Zapis OCR
-    with open(os.path.join(output_dir, f"{file_hash}_ocr_{prompt_version}.txt"), "w",
-              encoding="utf-8") as text_file:
-        text_file.write(ocr_text)
+    atomic_write(os.path.join(output_dir, f"{file_hash}_ocr_{prompt_version}.txt"), ocr_text)
+
+    # Zapis strukturalnego wyniku OCR
+    parsed_path = None
+    if parsed_result is not None:
+        parsed_path = os.path.join(output_dir, f"{file_hash}_ocr_{prompt_version}.json")
+        write_json(parsed_path, parsed_result)
 
     # Zapis metadanych (nowa funkcjonalność)
     metadata = {
         "file_hash": file_hash,
         "receipt_date": receipt_date,
         "prompt_version": prompt_version,
+        "prompt_fingerprint": prompt_fingerprint,
         "created_at": datetime.now().isoformat(),
+        "check_company": check_company,
+        "check_total": check_total,
+        "llm": llm_info,
+        "processing": processing,
+        "image_hash": image_hash,
         "file_paths": {
-            "original": os.path.join(output_dir, f"{file_hash}.jpg"),
-            "fixed": os.path.join(output_dir, f"{file_hash}_fixed.jpg"),
-            "ocr": os.path.join(output_dir, f"{file_hash}_ocr_{prompt_version}.txt")
+            "original": original_path,
+            "fixed": fixed_path,
+            "ocr": os.path.join(output_dir, f"{file_hash}_ocr_{prompt_version}.txt"),
+            "parsed": parsed_path
         }
     }
 
-    with open(os.path.join(output_dir, f"{file_hash}_metadata.json"), "w", encoding="utf-8") as json_file:
-        json.dump(metadata, json_file, indent=2)
+    # Metadane są zapisywane na końcu - ich obecność oznacza kompletny zapis paragonu
+    metadata_path = os.path.join(output_dir, f"{file_hash}_metadata.json")
+    write_json(metadata_path, metadata, indent=2)
+
+    # Pozycje zakupów i stawki VAT dla analiz wydatków
+    lines = parsed_result["lines"] if parsed_result is not None else parse_receipt_text(ocr_text)[0]
+    facts = extract_receipt_facts(lines)
+
+    # Aktualizacja indeksu metadanych, agregatów analitycznych i skrótów obrazów
+    receipt_index.upsert(metadata, os.path.getmtime(metadata_path), facts)
+    analytics_store.add_receipt(metadata, parse_amount(check_total), facts)
+    duplicate_index.add(file_hash, image_hash)
+
+
+def get_receipt_dir(file_hash: str) -> Optional[str]:
+    """Zwraca katalog z plikami paragonu na podstawie indeksu lub None, jeśli paragonu nie ma w indeksie"""
+    metadata = receipt_index.get(file_hash)
+    if not metadata or not metadata.get("file_paths", {}).get("ocr"):
+        return None
+
+    return os.path.dirname(metadata["file_paths"]["ocr"])
+
+
+def _load_ocr_text(file_hash: str, prompt_version: str) -> Optional[str]:
+    """
+    Wczytuje zapisany tekst OCR paragonu dla danej wersji promptu.
+
+    Args:
+        file_hash: Hash pliku obrazu.
+        prompt_version: Wersja promptu OCR.
+
+    Returns:
+        Tekst OCR lub None, jeśli paragon nie był jeszcze przetworzony tą wersją promptu.
+    """
+    output_dir = get_receipt_dir(file_hash)
+    if output_dir is None:
+        return None
+
+    ocr_path = os.path.join(output_dir, f"{file_hash}_ocr_{prompt_version}.txt")
+
+    if not os.path.exists(ocr_path):
+        return None
+
+    try:
+        with open(ocr_path, "r", encoding="utf-8") as f:
+            return f.read()
+    except Exception:
+        return None
+
+
+def get_parsed_result_path(file_hash: str, prompt_version: str) -> Optional[str]:
+    """Zwraca ścieżkę pliku ze strukturalnym wynikiem OCR lub None, jeśli paragonu nie ma w indeksie"""
+    output_dir = get_receipt_dir(file_hash)
+    if output_dir is None:
+        return None
+
+    return os.path.join(output_dir, f"{file_hash}_ocr_{prompt_version}.json")
+
+
+def _load_parsed_result(file_hash: str, prompt_version: str) -> Optional[Dict[str, Any]]:
+    """
+    Wczytuje strukturalny wynik OCR paragonu dla danej wersji promptu.
+
+    Args:
+        file_hash: Hash pliku obrazu.
+        prompt_version: Wersja promptu OCR.
+
+    Returns:
+        Słownik w formacie OCRResult lub None, jeśli plik nie istnieje.
+    """
+    parsed_path = get_parsed_result_path(file_hash, prompt_version)
+    if not parsed_path or not os.path.exists(parsed_path):
+        return None
+
+    try:
+        with open(parsed_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def _save_parsed_result(file_hash: str, prompt_version: str, parsed_result: Dict[str, Any]) -> None:
+    """Zapisuje strukturalny wynik OCR obok tekstu OCR paragonu"""
+    parsed_path = get_parsed_result_path(file_hash, prompt_version)
+    if not parsed_path:
+        return
 
+    write_json(parsed_path, parsed_result)
 
-async def get_receipt_history(limit: int = 10, offset: int = 0) -> List[Dict[str, Any]]:
+
+def read_receipt_metadata(date_dir: str, file_hash: str) -> Optional[Dict[str, Any]]:
+    """
+    Wczytuje metadane paragonu z katalogu `DATA_DIR/{data}/{hash}`.
+
+    Args:
+        date_dir: Nazwa katalogu z datą.
+        file_hash: Hash pliku obrazu.
+
+    Returns:
+        Słownik z metadanymi lub None, jeśli nie da się ich odczytać ani odtworzyć.
+    """
+    hash_dir_path = os.path.join(settings.DATA_DIR, date_dir, file_hash)
+    metadata_path = os.path.join(hash_dir_path, f"{file_hash}_metadata.json")
+
+    if not os.path.exists(metadata_path):
+        return None
+
+    try:
+        with open(metadata_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        # Plik metadanych uszkodzony, spróbuj utworzyć go na podstawie dostępnych plików
+        try:
+            # Znajdź pliki OCR i obrazy
+            files = os.listdir(hash_dir_path)
+            ocr_files = [f for f in files if f.endswith('.txt')]
+
+            if not ocr_files:
+                return None
+
+            # Wybierz najnowszy plik OCR
+            ocr_file = sorted(ocr_files)[-1]
+            prompt_version = ocr_file.split('_ocr_')[1].split('.txt')[0]
+
+            # Oryginał i obraz poprawiony mogą mieć różne rozszerzenia (obraz poprawiony jest opcjonalny)
+            original_file = next((f for f in files if f.startswith(f"{file_hash}.")), f"{file_hash}.jpg")
+            fixed_file = next((f for f in files if f.startswith(f"{file_hash}_fixed.")), None)
+
+            # Data utworzenia z czasu modyfikacji pliku OCR, a nie z chwili naprawy
+            ocr_path = os.path.join(hash_dir_path, ocr_file)
+            created_at = datetime.fromtimestamp(os.path.getmtime(ocr_path)).isoformat()
+            parsed_file = f"{file_hash}_ocr_{prompt_version}.json"
+
+            # Stwórz słownik metadanych
+            metadata = {
+                "file_hash": file_hash,
+                "receipt_date": date_dir,
+                "prompt_version": prompt_version,
+                "created_at": created_at,
+                "file_paths": {
+                    "original": os.path.join(hash_dir_path, original_file),
+                    "fixed": os.path.join(hash_dir_path, fixed_file) if fixed_file else None,
+                    "ocr": ocr_path,
+                    "parsed": os.path.join(hash_dir_path, parsed_file) if parsed_file in files else None
+                }
+            }
+
+            # Zapisz metadane
+            write_json(metadata_path, metadata, indent=2)
+
+            return metadata
+        except Exception:
+            return None
+
+
+def load_receipt_facts(metadata: Dict[str, Any]) -> Optional[Dict[str, List[tuple]]]:
+    """
+    Wyodrębnia pozycje zakupów, stawki VAT i linie do wyszukiwania z zapisanych plików paragonu.
+
+    Korzysta ze strukturalnego wyniku OCR, a dla paragonów zapisanych przed jego
+    wprowadzeniem - z tekstu OCR. Zwraca None, jeśli żadnego z plików nie da się odczytać.
+    """
+    file_paths = metadata.get("file_paths") or {}
+    try:
+        if file_paths.get("parsed") and os.path.exists(file_paths["parsed"]):
+            with open(file_paths["parsed"], "r", encoding="utf-8") as f:
+                return extract_receipt_facts(json.load(f)["lines"])
+        if file_paths.get("ocr") and os.path.exists(file_paths["ocr"]):
+            with open(file_paths["ocr"], "r", encoding="utf-8") as f:
+                return extract_receipt_facts(parse_receipt_text(f.read())[0])
+    except Exception as e:
+        logger.warning(f"Nie udało się odczytać pozycji paragonu {metadata.get('file_hash')}: {e}")
+    return None
+
+
+def reconcile_receipt_index(full: bool = False) -> Dict[str, int]:
+    """
+    Uzgadnia indeks metadanych z plikami zapisanymi w DATA_DIR.
+
+    Args:
+        full: Czy odbudować indeks od zera (True), czy tylko wczytać nowe
+            i zmienione pliki metadanych oraz usunąć wpisy bez plików (False).
+
+    Returns:
+        Statystyki uzgadniania (liczba wpisów dodanych/zaktualizowanych, usuniętych i pominiętych).
+    """
+    indexed_mtimes = {} if full else receipt_index.mtimes()
+    seen = set()
+    upserts = []
+    skipped = 0
+
+    if os.path.exists(settings.DATA_DIR):
+        for date_dir in os.listdir(settings.DATA_DIR):
+            date_path = os.path.join(settings.DATA_DIR, date_dir)
+
+            # Pomiń pliki (np. sam indeks) i katalogi pomocnicze
+            if not os.path.isdir(date_path) or date_dir.startswith(("_", ".")):
+                continue
+
+            for hash_dir in os.listdir(date_path):
+                metadata_path = os.path.join(date_path, hash_dir, f"{hash_dir}_metadata.json")
+
+                if not os.path.exists(metadata_path):
+                    continue
+
+                seen.add(hash_dir)
+                mtime = os.path.getmtime(metadata_path)
+                if indexed_mtimes.get(hash_dir) == mtime:
+                    continue
+
+                metadata = read_receipt_metadata(date_dir, hash_dir)
+                if metadata is None or metadata.get("file_hash") != hash_dir:
+                    skipped += 1
+                    continue
+
+                upserts.append((metadata, os.path.getmtime(metadata_path), load_receipt_facts(metadata)))
+
+    deletes = [file_hash for file_hash in indexed_mtimes if file_hash not in seen]
+    receipt_index.apply(upserts, deletes, clear=full)
+
+    return {"updated": len(upserts), "deleted": len(deletes), "skipped": skipped}
+
+
+def ensure_receipt_index() -> None:
+    """Buduje indeks metadanych z plików, jeśli nie istniał lub zmienił się jego schemat"""
+    receipt_index.count()
+    if receipt_index.created:
+        stats = reconcile_receipt_index(full=True)
+        receipt_index.created = False
+        logger.info(f"Zbudowano indeks paragonów: {stats}")
+
+
+async def save_receipt_files(*args: Any, **kwargs: Any) -> None:
+    """Zapisuje pliki paragonu poza pętlą zdarzeń (argumenty jak w `_save_receipt_files`)"""
+    await asyncio.to_thread(_save_receipt_files, *args, **kwargs)
+
+
+async def load_ocr_text(file_hash: str, prompt_version: str) -> Optional[str]:
+    """Wczytuje tekst OCR paragonu poza pętlą zdarzeń"""
+    return await asyncio.to_thread(_load_ocr_text, file_hash, prompt_version)
+
+
+async def load_parsed_result(file_hash: str, prompt_version: str) -> Optional[Dict[str, Any]]:
+    """Wczytuje strukturalny wynik OCR paragonu poza pętlą zdarzeń"""
+    return await asyncio.to_thread(_load_parsed_result, file_hash, prompt_version)
+
+
+async def save_parsed_result(file_hash: str, prompt_version: str, parsed_result: Dict[str, Any]) -> None:
+    """Zapisuje strukturalny wynik OCR paragonu poza pętlą zdarzeń"""
+    await asyncio.to_thread(_save_parsed_result, file_hash, prompt_version, parsed_result)
+
+
+async def get_receipt_history(
+        limit: int = 10,
+        offset: int = 0,
+        cursor: Optional[str] = None,
+        sort: str = "created_at",
+        descending: bool = True,
+        **filters: Any,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
     """
     Pobiera historię przetworzonych paragonów.
 
     Args:
         limit: Maksymalna liczba wyników.
-        offset: Przesunięcie do paginacji.
+        offset: Przesunięcie do paginacji (ignorowane, gdy podano kursor).
+        cursor: Kursor zwrócony z poprzednią stroną.
+        sort: Klucz sortowania (`created_at` lub `receipt_date`).
+        descending: Czy sortować malejąco.
+        **filters: Filtry przekazywane do indeksu (`date_from`, `date_to`, `company`,
+            `total_min`, `total_max`, `prompt_version`).
 
     Returns:
-        Lista metadanych paragonów.
+        Lista metadanych paragonów i kursor kolejnej strony (None dla ostatniej strony).
+
+    Raises:
+        ValueError: Jeśli kursor jest nieprawidłowy.
+    """
+    after = decode_cursor(cursor, sort, descending) if cursor else None
+    receipts, next_key = await asyncio.to_thread(
+        receipt_index.history,
+        limit=limit,
+        offset=offset,
+        sort=sort,
+        descending=descending,
+        after=after,
+        **filters,
+    )
+    next_cursor = encode_cursor(sort, descending, next_key) if next_key else None
+    return receipts, next_cursor
+
+
+def get_variant_max_edge(variant: str) -> int:
+    """Zwraca długość dłuższego boku pomniejszonej wersji obrazu (`thumbnail` lub `preview`)"""
+    return {
+        "thumbnail": settings.image.THUMBNAIL_MAX_EDGE,
+        "preview": settings.image.PREVIEW_MAX_EDGE,
+    }[variant]
+
+
+async def get_image_variant(source_path: str, variant: str) -> str:
     """
-    receipts = []
+    Zwraca ścieżkę pomniejszonej wersji obrazu paragonu.
 
-    if not os.path.exists(settings.DATA_DIR):
-        return receipts
+    Wersja jest tworzona raz (w puli procesów do przetwarzania obrazów) i zapisywana
+    w katalogu `variants` paragonu. Rozmiar jest częścią nazwy pliku, więc zmiana
+    konfiguracji powoduje utworzenie nowej wersji.
 
-    # Przeszukaj wszystkie katalogi z datami
-    for date_dir in sorted(os.listdir(settings.DATA_DIR), reverse=True):
-        date_path = os.path.join(settings.DATA_DIR, date_dir)
+    Args:
+        source_path: Ścieżka obrazu źródłowego (oryginalnego lub poprawionego).
+        variant: Rodzaj wersji (`thumbnail` lub `preview`).
+    """
+    max_long_edge = get_variant_max_edge(variant)
+    source_name = os.path.splitext(os.path.basename(source_path))[0]
+    variant_path = os.path.join(
+        os.path.dirname(source_path), VARIANTS_DIR, f"{source_name}_{variant}_{max_long_edge}.jpg"
+    )
+    if await path_exists(variant_path):
+        return variant_path
 
-        if not os.path.isdir(date_path):
-            continue
+    # Dla paragonów w PDF pomniejszona wersja pokazuje pierwszą stronę
+    render = render_pdf_variant if source_path.lower().endswith(".pdf") else render_image_variant
+    image_bytes = await run_image_task(render, source_path, max_long_edge, settings.image.VARIANT_JPEG_QUALITY)
 
-        # Przeszukaj wszystkie katalogi z hashami
-        for hash_dir in os.listdir(date_path):
-            hash_path = os.path.join(date_path, hash_dir)
+    def write_variant() -> None:
+        ensure_directory_exists(os.path.dirname(variant_path))
+        atomic_write(variant_path, image_bytes)
+
+    await asyncio.to_thread(write_variant)
+    return variant_path
 
-            if not os.path.isdir(hash_path):
-                continue
 
-            # Znajdź plik metadanych
-            metadata_path = os.path.join(hash_path, f"{hash_dir}_metadata.json")
+@lru_cache(maxsize=4096)
+def _file_etag(path: str, mtime_ns: int, size: int) -> str:
+    """Liczy ETag dla wersji pliku (czas modyfikacji i rozmiar są częścią klucza cache)"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return f'"{digest.hexdigest()}"'
 
-            if os.path.exists(metadata_path):
-                try:
-                    with open(metadata_path, "r", encoding="utf-8") as f:
-                        metadata = json.load(f)
-                        receipts.append(metadata)
-                except Exception:
-                    # Zignoruj uszkodzone pliki metadanych
-                    pass
 
-    # Sortuj według daty utworzenia (od najnowszych)
-    receipts.sort(key=lambda x: x.get("created_at", ""), reverse=True)
+def _get_file_etag(path: str) -> str:
+    stat = os.stat(path)
+    return _file_etag(path, stat.st_mtime_ns, stat.st_size)
 
-    # Zastosuj limit i offset
-    return receipts[offset:offset + limit]
+
+async def get_file_etag(path: str) -> str:
+    """
+    Zwraca silny znacznik ETag pliku (skrót SHA-256 treści).
+
+    Skrót jest liczony raz dla danej wersji pliku (czas modyfikacji i rozmiar).
+    """
+    return await asyncio.to_thread(_get_file_etag, path)
+
+
+async def search_receipts(query: str, limit: int = 10, offset: int = 0) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Wyszukuje paragony po treści linii (indeks pełnotekstowy).
+
+    Returns:
+        Lista wyników i łączna liczba pasujących paragonów.
+
+    Raises:
+        ValueError: Jeśli zapytanie nie zawiera słów do wyszukania.
+    """
+    return await asyncio.to_thread(receipt_index.search, query, limit, offset)
 
 
 async def get_receipt_by_hash(file_hash: str) -> Optional[Dict[str, Any]]:
@@ -113,54 +551,4 @@ async def get_receipt_by_hash(file_hash: str) -> Optional[Dict[str, Any]]:
     Returns:
         Słownik z danymi paragonu lub None, jeśli nie znaleziono.
     """
-    if not os.path.exists(settings.DATA_DIR):
-        return None
-
-    # Przeszukaj wszystkie katalogi z datami
-    for date_dir in os.listdir(settings.DATA_DIR):
-        hash_dir_path = os.path.join(settings.DATA_DIR, date_dir, file_hash)
-
-        if os.path.isdir(hash_dir_path):
-            # Znajdź plik metadanych
-            metadata_path = os.path.join(hash_dir_path, f"{file_hash}_metadata.json")
-
-            if os.path.exists(metadata_path):
-                try:
-                    with open(metadata_path, "r", encoding="utf-8") as f:
-                        return json.load(f)
-                except Exception:
-                    # Plik metadanych uszkodzony, spróbuj utworzyć go na podstawie dostępnych plików
-                    try:
-                        # Znajdź pliki OCR i obrazy
-                        files = os.listdir(hash_dir_path)
-                        ocr_files = [f for f in files if f.endswith('.txt')]
-
-                        if not ocr_files:
-                            return None
-
-                        # Wybierz najnowszy plik OCR
-                        ocr_file = sorted(ocr_files)[-1]
-                        prompt_version = ocr_file.split('_ocr_')[1].split('.txt')[0]
-
-                        # Stwórz słownik metadanych
-                        metadata = {
-                            "file_hash": file_hash,
-                            "receipt_date": date_dir,
-                            "prompt_version": prompt_version,
-                            "created_at": datetime.now().isoformat(),
-                            "file_paths": {
-                                "original": os.path.join(hash_dir_path, f"{file_hash}.jpg"),
-                                "fixed": os.path.join(hash_dir_path, f"{file_hash}_fixed.jpg"),
-                                "ocr": os.path.join(hash_dir_path, ocr_file)
-                            }
-                        }
-
-                        # Zapisz metadane
-                        with open(metadata_path, "w", encoding="utf-8") as f:
-                            json.dump(metadata, f, indent=2)
-
-                        return metadata
-                    except Exception:
-                        return None
-
-    return None
+    return await asyncio.to_thread(receipt_index.get, file_hash)
@@ -1,14 +1,71 @@
 import io
+import os
+import asyncio
+import time
 import hashlib
-from typing import Optional, Tuple
-import base64
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple, Union
 import logging
-from PIL import Image
+import numpy as np
+from PIL import Image, ImageOps
 import pytesseract
-from fastapi import HTTPException
+
+from app.core.config import settings
 
 logger = logging.getLogger(__name__)
 
+# Pula procesów dla etapów obróbki obrazu obciążających CPU
+_image_executor: Optional[ProcessPoolExecutor] = None
+
+
+def init_image_executor() -> Optional[Executor]:
+    """
+    Tworzy pulę procesów do przetwarzania obrazów.
+
+    Returns:
+        Pula procesów lub None, jeśli pula jest wyłączona w konfiguracji
+        (wtedy zadania trafiają do domyślnej puli wątków pętli zdarzeń).
+    """
+    global _image_executor
+
+    if not settings.image.PROCESS_POOL_ENABLED:
+        return None
+
+    if _image_executor is None:
+        max_workers = settings.image.PROCESS_POOL_WORKERS or os.cpu_count() or 1
+        _image_executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        logger.info(f"Utworzono pulę procesów do przetwarzania obrazów ({max_workers} procesów)")
+
+    return _image_executor
+
+
+def shutdown_image_executor() -> None:
+    """Zamyka pulę procesów do przetwarzania obrazów"""
+    global _image_executor
+
+    if _image_executor is not None:
+        _image_executor.shutdown(wait=False, cancel_futures=True)
+        _image_executor = None
+
+
+async def run_image_task(func: Callable[..., Any], *args: Any) -> Any:
+    """
+    Uruchamia zadanie przetwarzania obrazu poza pętlą zdarzeń.
+
+    Args:
+        func: Funkcja na poziomie modułu (musi dać się zserializować przez pickle).
+        *args: Argumenty funkcji - najlepiej bajty, a nie obiekty PIL.
+
+    Returns:
+        Wynik funkcji.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(init_image_executor(), func, *args)
+
 
 def calculate_sha256(image_data: bytes) -> str:
     """
@@ -25,6 +82,109 @@ def calculate_sha256(image_data: bytes) -> str:
     return sha256_hash.hexdigest()
 
 
+def calculate_image_hash(image: Image.Image, hash_size: int = 8) -> str:
+    """
+    Oblicza skrót percepcyjny obrazu (dHash).
+
+    Obraz jest zmniejszany do (hash_size + 1) x hash_size pikseli w skali szarości,
+    a każdy bit skrótu mówi, czy piksel jest jaśniejszy od sąsiada po prawej.
+    Skrót nie zmienia się (lub zmienia się nieznacznie) po ponownej kompresji,
+    przeskalowaniu czy niewielkim kadrowaniu, więc podobieństwo obrazów można
+    mierzyć odległością Hamminga skrótów.
+
+    Args:
+        image: Obraz w formacie PIL.Image (po poprawie orientacji).
+        hash_size: Liczba wierszy i bitów w wierszu (skrót ma hash_size^2 bitów).
+
+    Returns:
+        Skrót w formacie heksadecymalnym.
+    """
+    if image.mode not in ("L", "RGB"):
+        image = image.convert("RGB")
+
+    small = image.resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS, reducing_gap=3.0).convert("L")
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = pixels[:, :-1] > pixels[:, 1:]
+    return np.packbits(bits.ravel()).tobytes().hex()
+
+
+def receipt_region(image: Image.Image, analysis_max_edge: int = 512) -> np.ndarray:
+    """
+    Zwraca obszar paragonu na zmniejszonej kopii obrazu w skali szarości.
+
+    Obszar jest wyznaczany tak jak przy kadrowaniu (`find_receipt_box`), niezależnie
+    od `CROP_ENABLED`, a kontrast jest rozciągany. Obszar szerszy niż wyższy jest
+    obracany o 90°, więc zdjęcia tego samego paragonu wykonane w poziomie i w pionie
+    dają ten sam obszar - z dokładnością do obrotu o 180°.
+
+    Returns:
+        Tablica uint8 z obszarem paragonu (cały obraz, jeśli paragonu nie znaleziono).
+    """
+    width, height = image.size
+    scale = min(1.0, analysis_max_edge / max(width, height))
+    analysis_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    analysis = image.resize(analysis_size, Image.BILINEAR, reducing_gap=2.0).convert("L")
+    gray = np.asarray(analysis)
+
+    box = find_receipt_box(gray > otsu_threshold(gray))
+    if box is not None:
+        analysis = analysis.crop(box)
+    analysis = ImageOps.autocontrast(analysis, cutoff=1)
+    if analysis.width > analysis.height:
+        analysis = analysis.transpose(Image.Transpose.ROTATE_90)
+    return np.asarray(analysis)
+
+
+def text_row_profile(region: np.ndarray, length: int = 256) -> list:
+    """
+    Zwraca profil wierszy tekstu obszaru paragonu.
+
+    Profil to udział ciemnych pikseli w kolejnych wierszach środkowego pasa obszaru
+    (bez 20% z każdej strony), przeskalowany do `length` wartości. Układ linii tekstu
+    jest charakterystyczny dla treści paragonu, więc profil odróżnia różne paragony
+    o podobnym wyglądzie (ten sam sklep, to samo tło), których skróty są bliskie.
+    """
+    width = region.shape[1]
+    band = region[:, width // 5:width - width // 5] if width >= 5 else region
+    rows = (band < otsu_threshold(band)).mean(axis=1)
+    profile = np.interp(np.linspace(0, len(rows) - 1, length), np.arange(len(rows)), rows)
+    return [round(float(value), 4) for value in profile]
+
+
+def profile_similarity(a: list, b: list) -> float:
+    """Zwraca korelację profili wierszy tekstu (większą z obu orientacji - obrót o 180°)"""
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    if len(a) != len(b) or a.std() == 0 or b.std() == 0:
+        return 0.0
+    return float(max(np.corrcoef(a, b)[0, 1], np.corrcoef(a[::-1], b)[0, 1]))
+
+
+def receipt_fingerprint(image: Image.Image) -> Dict[str, Any]:
+    """
+    Oblicza cechy obrazu paragonu do wykrywania ponownie przesłanych zdjęć.
+
+    Skróty są liczone na znormalizowanym obszarze paragonu (`receipt_region`), a nie na
+    całym kadrze - tło i orientacja zdjęcia nie wpływają na wynik. Obszar może być
+    obrócony o 180° względem innego zdjęcia tego samego paragonu, dlatego obok skrótu
+    (`image_hash`) zwracany jest skrót obszaru obróconego (`image_hash_rotated`)
+    używany przy wyszukiwaniu. Profil wierszy tekstu (`row_profile`) służy
+    do potwierdzenia podobieństwa przed ponownym użyciem wyniku OCR.
+    """
+    region = receipt_region(image)
+    region_image = Image.fromarray(region)
+    return {
+        "image_hash": calculate_image_hash(region_image),
+        "image_hash_rotated": calculate_image_hash(region_image.transpose(Image.Transpose.ROTATE_180)),
+        "row_profile": text_row_profile(region),
+    }
+
+
+def load_receipt_fingerprint(path: str) -> Dict[str, Any]:
+    """Oblicza cechy zapisanego obrazu paragonu (`receipt_fingerprint`) - funkcja dla puli procesów"""
+    image, _ = fix_orientation(Image.open(path), use_osd=False)
+    return receipt_fingerprint(image)
+
+
 def detect_rotation(image: Image.Image) -> int:
     """
     Wykrywa kąt obrotu tekstu w obrazie i zwraca wymagany kąt do poprawnego obrócenia.
@@ -55,130 +215,587 @@ def detect_rotation(image: Image.Image) -> int:
         return 0
 
 
-def fix_rotation(image: Image.Image) -> Image.Image:
+EXIF_ORIENTATION_TAG = 0x0112
+
+
+def fix_orientation(image: Image.Image, use_osd: bool = True) -> Tuple[Image.Image, Dict[str, Any]]:
     """
-    Poprawia rotację obrazu jeśli jest potrzebna.
+    Poprawia orientację obrazu, zaczynając od najtańszej metody.
+
+    Kolejne poziomy wykrywania:
+        1. `exif` - obrót zgodnie ze znacznikiem orientacji EXIF zapisanym przez aparat,
+        2. `aspect` - obraz pionowy nie jest uznawany za obrócony o 90° (paragony są
+           wysokie i wąskie), o ile włączono `ORIENTATION_ASSUME_PORTRAIT_UPRIGHT` -
+           OSD może dla niego wykryć już tylko obrót o 180°,
+        3. `osd` - Tesseract OSD na zmniejszonej kopii w skali szarości,
+        4. `none` - orientacja pozostaje bez zmian.
 
     Args:
         image: Obraz w formacie PIL.Image.
+        use_osd: Czy dopuścić wykrywanie przez Tesseract OSD (dodatkowo wymaga
+            włączenia `ORIENTATION_OSD_ENABLED` w konfiguracji).
 
     Returns:
-        Obraz po poprawieniu rotacji.
+        Tuple zawierający: (obraz_po_poprawie, informacja_o_orientacji), gdzie informacja
+        zawiera poziom, który zdecydował (`tier`), oraz kąt obrotu w stopniach (`angle`).
     """
+    image_settings = settings.image
+
+    # Poziom 1: znacznik orientacji EXIF
+    exif_orientation = 1
     try:
-        rotate_angle = detect_rotation(image)
-        if rotate_angle != 0:
-            return image.rotate(-rotate_angle, expand=True)
-        return image
+        exif_orientation = image.getexif().get(EXIF_ORIENTATION_TAG, 1)
+        if exif_orientation != 1:
+            image = ImageOps.exif_transpose(image)
     except Exception as e:
-        logger.warning(f"Nie udało się poprawić rotacji: {str(e)}. Zwracam oryginalny obraz.")
-        return image
+        logger.warning(f"Nie udało się odczytać orientacji EXIF: {str(e)}")
+
+    # Poziom 2: obraz pionowy nie jest obrócony o 90°, ale nadal może być odwrócony
+    width, height = image.size
+    portrait = height >= width and image_settings.ORIENTATION_ASSUME_PORTRAIT_UPRIGHT
+    fallback_tier = "exif" if exif_orientation != 1 else ("aspect" if portrait else "none")
+
+    # Poziom 3: Tesseract OSD na zmniejszonej kopii
+    if use_osd and image_settings.ORIENTATION_OSD_ENABLED:
+        osd_image = downscale_image(image.convert("L"), max_long_edge=image_settings.ORIENTATION_OSD_MAX_EDGE)
+        rotate_angle = detect_rotation(osd_image)
+        if portrait and rotate_angle != 180:
+            return image, {"tier": fallback_tier, "angle": 0, "exif_orientation": exif_orientation}
+        if rotate_angle != 0:
+            image = image.rotate(-rotate_angle, expand=True)
+        return image, {"tier": "osd", "angle": rotate_angle, "exif_orientation": exif_orientation}
 
+    return image, {"tier": fallback_tier, "angle": 0, "exif_orientation": exif_orientation}
 
-def convert_to_base64(image: Image.Image, format: str = "JPEG") -> str:
+
+def otsu_threshold(gray: np.ndarray) -> int:
+    """Wyznacza próg jasności rozdzielający dwie klasy pikseli (metoda Otsu) dla obrazu uint8"""
+    histogram = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weight_dark = np.cumsum(histogram)
+    weight_bright = weight_dark[-1] - weight_dark
+    cumulative_mean = np.cumsum(histogram * levels)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = (cumulative_mean[-1] * weight_dark - weight_dark[-1] * cumulative_mean) ** 2 / (weight_dark * weight_bright)
+    return int(np.argmax(np.nan_to_num(variance)))
+
+
+def profile_span(profile: np.ndarray, fraction: float = 0.25) -> Tuple[int, int]:
     """
-    Konwertuje obraz do formatu base64.
+    Zwraca przedział profilu rzutowania po odcięciu brzegów o wartościach poniżej `fraction` mediany.
+
+    Profil jest wygładzany średnią ruchomą. Odcinane są tylko brzegi (tło) - spadki wewnątrz
+    przedziału (odstępy między liniami, kody kreskowe, cień na papierze) nie dzielą paragonu,
+    a niski próg sprawia, że w razie wątpliwości kadr obejmuje więcej.
+
+    Returns:
+        Początek i koniec (bez końca) przedziału.
+    """
+    window = max(1, len(profile) // 50)
+    smoothed = np.convolve(profile, np.ones(window) / window, mode="same")
+    above = np.flatnonzero(smoothed >= max(fraction * np.median(smoothed), 1e-6))
+    if not len(above):
+        return 0, 0
+    return int(above[0]), int(above[-1]) + 1
+
+
+def find_receipt_box(mask: np.ndarray) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Wyznacza prostokąt paragonu na masce jasnych pikseli z profili rzutowania.
+
+    Kolumny paragonu wyznacza profil udziału jasnych pikseli w kolumnach, wiersze -
+    analogiczny profil w obrębie tych kolumn; kolumny są następnie zawężane
+    do znalezionych wierszy.
+
+    Returns:
+        Prostokąt (lewo, góra, prawo, dół) lub None, jeśli maska nie zawiera jasnego obszaru.
+    """
+    left, right = profile_span(mask.mean(axis=0))
+    if right <= left:
+        return None
+    top, bottom = profile_span(mask[:, left:right].mean(axis=1))
+    if bottom <= top:
+        return None
+    left, right = profile_span(mask[top:bottom].mean(axis=0))
+    if right <= left:
+        return None
+    return left, top, right, bottom
+
+
+def estimate_skew(mask: np.ndarray) -> Optional[float]:
+    """
+    Szacuje niewielkie pochylenie paragonu od pionu z położenia jego bocznych krawędzi.
+
+    W każdym wierszu maski (bez 10% skrajnych wierszy) wyznaczany jest pierwszy i ostatni
+    jasny piksel, a do obu krawędzi dopasowywane są proste. Krawędzie stykające się
+    z brzegiem kadru (paragon wychodzi poza zdjęcie) oraz nieregularne (pognieciony papier)
+    są pomijane.
+
+    Returns:
+        Kąt obrotu w stopniach prostujący paragon (jak w `Image.rotate` - dodatni przeciwnie
+        do ruchu wskazówek zegara) lub None, jeśli pochylenia nie da się wyznaczyć.
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) < 20:
+        return None
+    rows = rows[len(rows) // 10:len(rows) - len(rows) // 10]
+    band = mask[rows]
+    width = band.shape[1]
+
+    angles = []
+    for edge in (band.argmax(axis=1), width - 1 - band[:, ::-1].argmax(axis=1)):
+        if np.median(edge) <= 1 or np.median(edge) >= width - 2:
+            continue
+        slope, intercept = np.polyfit(rows, edge, 1)
+        if np.std(edge - (slope * rows + intercept)) > 0.02 * width:
+            continue
+        angles.append(-np.degrees(np.arctan(slope)))
+
+    if not angles or max(angles) - min(angles) > 2.0:
+        return None
+    return float(np.mean(angles))
+
+
+def estimate_text_lines(image: Image.Image, analysis_max_edge: int = 1024) -> int:
+    """
+    Szacuje liczbę linii tekstu paragonu z poziomego profilu rzutowania ciemnych pikseli.
+
+    Liczone są przedziały wierszy zawierających tekst w środkowym pasie kolumn
+    (brzegi mogą zawierać resztki tła). Wynik jest przybliżony (zwykle ±25%), ale wystarcza
+    do odróżnienia krótkiego biletu od długiego paragonu.
+
+    Args:
+        image: Obraz w formacie PIL.Image (po poprawie orientacji i kadrowaniu).
+        analysis_max_edge: Dłuższy bok kopii do analizy.
+
+    Returns:
+        Szacowana liczba linii tekstu.
+    """
+    width, height = image.size
+    scale = min(1.0, analysis_max_edge / max(width, height))
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    gray = np.asarray(image.resize(size, Image.BILINEAR, reducing_gap=2.0).convert("L"))
+
+    band = gray[:, size[0] // 5:size[0] - size[0] // 5]
+    if band.size == 0:
+        return 0
+
+    # Wiersz zawiera tekst, jeśli udział ciemnych pikseli przekracza 30% średniej (niezależnie od kontrastu zdjęcia)
+    profile = (band < otsu_threshold(band)).mean(axis=1)
+    text_rows = profile > 0.3 * profile.mean()
+    return int(np.count_nonzero(np.diff(text_rows.astype(np.int8)) == 1) + text_rows[0])
+
+
+def rotate_region(image: Image.Image, angle: float, box: Tuple[int, int, int, int]) -> Image.Image:
+    """
+    Zwraca fragment obrazu obróconego wokół środka o `angle` stopni (jak `Image.rotate`).
+
+    Obrót i kadrowanie są wykonywane jednym przekształceniem afinicznym, więc
+    interpolowane są tylko piksele kadru, a nie całe zdjęcie.
+
+    Args:
+        image: Obraz w formacie PIL.Image.
+        angle: Kąt obrotu w stopniach (dodatni przeciwnie do ruchu wskazówek zegara).
+        box: Prostokąt (lewo, góra, prawo, dół) we współrzędnych obrazu po obrocie.
+    """
+    left, top, right, bottom = box
+    if not angle:
+        return image.crop(box)
+
+    radians = -np.radians(angle)
+    cos, sin = float(np.cos(radians)), float(np.sin(radians))
+    center_x, center_y = image.width / 2, image.height / 2
+    # Współrzędne piksela kadru -> współrzędne w obrazie źródłowym
+    data = (
+        cos, sin, cos * (left - center_x) + sin * (top - center_y) + center_x,
+        -sin, cos, -sin * (left - center_x) + cos * (top - center_y) + center_y,
+    )
+    return image.transform((right - left, bottom - top), Image.AFFINE, data, resample=Image.BILINEAR, fillcolor="white")
+
+
+def crop_receipt(image: Image.Image) -> Tuple[Image.Image, Dict[str, Any]]:
+    """
+    Kadruje zdjęcie do obszaru paragonu i opcjonalnie prostuje niewielkie pochylenie.
+
+    Analiza odbywa się na zmniejszonej kopii w skali szarości: próg Otsu oddziela
+    jasny papier od tła, a profile rzutowania maski na osie wyznaczają prostokąt
+    paragonu. Pochylenie (z bocznych krawędzi papieru) jest prostowane, jeśli mieści się
+    między `DESKEW_MIN_ANGLE` a `DESKEW_MAX_ANGLE` - obroty o wielokrotność 90°
+    wykonuje wcześniej `fix_orientation`. Bez kadrowania obraz jest obracany tylko przy
+    pochyleniu co najmniej `DESKEW_FRAME_MIN_ANGLE` - sam obrót wymusza ponowne kodowanie
+    obrazu zamiast wysłania oryginalnych bajtów. Kadr jest pomijany, gdy wycina zbyt mało
+    (powyżej `CROP_MAX_AREA` obrazu), obejmuje podejrzanie mały obszar (poniżej
+    `CROP_MIN_AREA`) lub nie jest jaśniejszy od tła.
+
+    Args:
+        image: Obraz w formacie PIL.Image (po poprawie orientacji).
+
+    Returns:
+        Tuple zawierający: (obraz_po_kadrowaniu, statystyki), gdzie statystyki zawierają
+        informację o kadrowaniu (`cropped`), kąt prostowania (`deskew_angle`) i oszacowane
+        pochylenie (`skew`, także gdy obraz nie został obrócony), prostokąt
+        kadru w pikselach obrazu (`box`), rozmiary obrazu przed i po (`original_size`, `size`)
+        oraz udział zachowanych pikseli (`pixel_ratio`). Jeśli obraz nie został zmieniony,
+        zwracany jest obraz wejściowy.
+    """
+    image_settings = settings.image
+    width, height = image.size
+    stats = {
+        "cropped": False,
+        "deskew_angle": 0.0,
+        "skew": 0.0,
+        "box": [0, 0, width, height],
+        "original_size": [width, height],
+        "size": [width, height],
+        "pixel_ratio": 1.0,
+    }
+
+    # Kopia do analizy - szybkie zmniejszanie blokowe (dokładność interpolacji nie ma tu znaczenia)
+    scale = min(1.0, image_settings.CROP_ANALYSIS_MAX_EDGE / max(width, height))
+    analysis_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    analysis = image.resize(analysis_size, Image.BILINEAR, reducing_gap=2.0).convert("L")
+    gray = np.asarray(analysis)
+    threshold = otsu_threshold(gray)
+    mask = gray > threshold
+
+    box = find_receipt_box(mask)
+    if box is None:
+        return image, stats
+
+    # Pochylenie jest szacowane na kopii - obraz jest obracany dopiero razem z kadrowaniem
+    angle = 0.0
+    if image_settings.DESKEW_ENABLED:
+        left, top, right, bottom = box
+        skew = estimate_skew(mask[top:bottom, left:right])
+        stats["skew"] = round(skew, 2) if skew is not None else 0.0
+        if skew is not None and image_settings.DESKEW_MIN_ANGLE <= abs(skew) <= image_settings.DESKEW_MAX_ANGLE:
+            angle = skew
+            gray = np.asarray(analysis.rotate(angle, resample=Image.BILINEAR, fillcolor=0))
+            mask = gray > threshold
+            box = find_receipt_box(mask) or (0, 0, mask.shape[1], mask.shape[0])
+
+    # Prostokąt w pikselach pełnego obrazu z marginesem
+    scale_x, scale_y = width / gray.shape[1], height / gray.shape[0]
+    margin = image_settings.CROP_MARGIN * max(width, height)
+    left, top, right, bottom = box
+    crop_box = (
+        max(0, int(left * scale_x - margin)),
+        max(0, int(top * scale_y - margin)),
+        min(width, int(np.ceil(right * scale_x + margin))),
+        min(height, int(np.ceil(bottom * scale_y + margin))),
+    )
+
+    area = (crop_box[2] - crop_box[0]) * (crop_box[3] - crop_box[1]) / (width * height)
+    inside = np.zeros_like(mask)
+    inside[top:bottom, left:right] = True
+    brighter = bool(inside.all() or gray[inside].mean() > gray[~inside].mean())
+    cropped = image_settings.CROP_MIN_AREA <= area <= image_settings.CROP_MAX_AREA and brighter
+
+    if not cropped:
+        # Niewielkie pochylenie całego kadru nie jest warte ponownego kodowania obrazu
+        if abs(angle) < max(image_settings.DESKEW_FRAME_MIN_ANGLE, image_settings.DESKEW_MIN_ANGLE, 1e-9):
+            return image, stats
+        crop_box, area = (0, 0, width, height), 1.0
+
+    image = rotate_region(image, angle, crop_box)
+    stats.update({
+        "cropped": cropped,
+        "deskew_angle": round(angle, 2),
+        "box": list(crop_box),
+        "size": list(image.size),
+        "pixel_ratio": round(area, 4),
+    })
+    return image, stats
+
+
+IMAGE_MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+}
+
+
+def encode_image(image: Image.Image, format: str = "JPEG", quality: Optional[int] = None) -> bytes:
+    """
+    Koduje obraz do bajtów w zadanym formacie.
 
     Args:
         image: Obraz w formacie PIL.Image.
         format: Format obrazu wyjściowego (JPEG, PNG, itp.).
+        quality: Opcjonalna jakość kompresji stratnej (JPEG, WEBP).
 
     Returns:
-        Ciąg znaków base64 reprezentujący obraz.
+        Zakodowany obraz.
     """
+    if format in ("JPEG", "WEBP") and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    save_options = {}
+    if quality is not None and format in ("JPEG", "WEBP"):
+        save_options["quality"] = quality
+
     buffered = io.BytesIO()
-    image.save(buffered, format=format)
-    return base64.b64encode(buffered.getvalue()).decode("utf-8")
+    image.save(buffered, format=format, **save_options)
+    return buffered.getvalue()
 
 
-def optimize_image_for_ocr(image: Image.Image) -> Image.Image:
+def downscale_image(image: Image.Image, max_long_edge: int = 0, max_pixels: int = 0) -> Image.Image:
     """
-    Optymalizuje obraz dla OCR poprzez zastosowanie filtrów.
+    Zmniejsza obraz do limitu dłuższego boku i liczby pikseli.
 
     Args:
         image: Obraz w formacie PIL.Image.
+        max_long_edge: Maksymalna długość dłuższego boku (0 - bez limitu).
+        max_pixels: Maksymalna liczba pikseli (0 - bez limitu).
 
     Returns:
-        Zoptymalizowany obraz.
+        Zmniejszony obraz lub obraz wejściowy, jeśli mieści się w limitach.
     """
-    try:
-        # Konwersja do skali szarości
-        image_gray = image.convert('L')
+    width, height = image.size
+    scale = 1.0
 
-        # Zwiększenie kontrastu (opcjonalnie)
-        # from PIL import ImageEnhance
-        # enhancer = ImageEnhance.Contrast(image_gray)
-        # image_enhanced = enhancer.enhance(1.5)
+    if max_long_edge:
+        scale = min(scale, max_long_edge / max(width, height))
+    if max_pixels:
+        scale = min(scale, (max_pixels / (width * height)) ** 0.5)
 
-        return image_gray
-    except Exception as e:
-        logger.warning(f"Nie udało się zoptymalizować obrazu: {str(e)}. Zwracam oryginalny obraz.")
+    if scale >= 1.0:
         return image
 
+    new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return image.resize(new_size, Image.LANCZOS)
 
-def validate_image(image: Image.Image) -> Tuple[bool, Optional[str]]:
+
+def render_image_variant(source_path: str, max_long_edge: int, quality: int) -> bytes:
     """
-    Sprawdza, czy obraz jest odpowiedni do OCR.
+    Tworzy pomniejszoną wersję obrazu paragonu (miniaturę lub podgląd) w formacie JPEG.
+
+    Orientacja z EXIF jest uwzględniana, bo zakodowany wariant nie zawiera tych danych.
 
     Args:
-        image: Obraz w formacie PIL.Image.
+        source_path: Ścieżka obrazu źródłowego.
+        max_long_edge: Maksymalna długość dłuższego boku.
+        quality: Jakość kompresji JPEG.
 
     Returns:
-        Tuple zawierający: (czy_obraz_jest_valid, opcjonalny_komunikat_błędu)
+        Zakodowany obraz JPEG.
     """
-    # Sprawdź wymiary
-    width, height = image.size
-    if width < 100 or height < 100:
-        return False, "Obraz jest zbyt mały. Minimalne wymiary to 100x100 pikseli."
+    with Image.open(source_path) as image:
+        # Dekodowanie JPEG od razu w zmniejszonej skali (nie mniejszej niż docelowa)
+        image.draft("RGB", (max_long_edge, max_long_edge))
+        image = ImageOps.exif_transpose(image)
+        return encode_image(downscale_image(image, max_long_edge=max_long_edge), format="JPEG", quality=quality)
 
-    # Sprawdź format
-    if image.format not in ['JPEG', 'PNG', 'TIFF', 'BMP']:
-        return False, f"Nieobsługiwany format obrazu: {image.format}. Wspierane formaty: JPEG, PNG, TIFF, BMP."
 
-    # Sprawdź, czy obraz nie jest całkowicie pusty/czarny/biały
-    if len(image.getcolors(maxcolors=10)) <= 1:
-        return False, "Obraz wydaje się być pusty (jednokolorowy)."
+def encode_for_llm(image: Image.Image) -> Tuple[bytes, str]:
+    """
+    Przygotowuje obraz wysyłany do LLM zgodnie z konfiguracją.
 
-    return True, None
+    Obraz jest zmniejszany do `LLM_MAX_LONG_EDGE`/`LLM_MAX_PIXELS`, opcjonalnie
+    konwertowany do skali szarości i kodowany w każdym z formatów z `LLM_FORMATS`.
+    Wybierany jest najmniejszy wynik.
 
+    Args:
+        image: Obraz w formacie PIL.Image (po poprawie orientacji).
 
-def preprocess_image_for_ocr(image_data: bytes) -> Image.Image:
+    Returns:
+        Tuple zawierający: (zakodowany_obraz, format)
     """
-    Wykonuje pełne przetwarzanie obrazu przed OCR.
+    image_settings = settings.image
+    image = downscale_image(image, image_settings.LLM_MAX_LONG_EDGE, image_settings.LLM_MAX_PIXELS)
+
+    if image_settings.LLM_GRAYSCALE:
+        image = optimize_image_for_ocr(image)
+
+    formats = [f.strip().upper() for f in image_settings.LLM_FORMATS.split(",") if f.strip()] or ["JPEG"]
+    candidates = [
+        (encode_image(image, format=format, quality=image_settings.LLM_JPEG_QUALITY), format)
+        for format in formats
+    ]
+    return min(candidates, key=lambda candidate: len(candidate[0]))
+
+
+IMAGE_EXTENSIONS = {
+    "JPEG": "jpg",
+    "PNG": "png",
+    "BMP": "bmp",
+    "TIFF": "tiff",
+    "WEBP": "webp",
+}
+
+
+def can_send_original_to_llm(image: Image.Image) -> bool:
+    """
+    Sprawdza, czy oryginalne bajty obrazu można wysłać do LLM bez ponownego kodowania.
 
     Args:
-        image_data: Dane obrazu w formacie bajtów.
+        image: Obraz w formacie PIL.Image (po wykryciu orientacji, bez zmian).
 
     Returns:
-        Obraz gotowy do OCR.
+        True, jeśli obraz jest plikiem JPEG mieszczącym się w limitach rozmiaru,
+        a konfiguracja nie wymaga skali szarości ani innego formatu.
+    """
+    image_settings = settings.image
+    formats = [f.strip().upper() for f in image_settings.LLM_FORMATS.split(",") if f.strip()] or ["JPEG"]
+
+    return (
+        image.format == "JPEG"
+        and image.mode in ("RGB", "L")
+        and formats == ["JPEG"]
+        and not image_settings.LLM_GRAYSCALE
+        and downscale_image(image, image_settings.LLM_MAX_LONG_EDGE, image_settings.LLM_MAX_PIXELS) is image
+    )
+
+
+def prepare_receipt_image(image_data: Union[bytes, str], use_osd: bool = True) -> Dict[str, Any]:
+    """
+    Wykonuje etapy obróbki obrazu paragonu obciążające CPU.
+
+    Funkcja jest uruchamiana w puli procesów, dlatego przyjmuje i zwraca
+    wyłącznie bajty i typy proste zamiast obiektów PIL. Obraz jest kodowany
+    co najwyżej raz: jeśli oryginał spełnia wymagania LLM, wysyłane są jego
+    bajty, a zakodowany obraz dla LLM służy też jako obraz poprawiony.
+
+    Args:
+        image_data: Dane obrazu w formacie bajtów lub ścieżka do pliku z obrazem.
+        use_osd: Czy dopuścić wykrywanie orientacji przez Tesseract OSD.
 
-    Raises:
-        HTTPException: Jeśli obraz jest nieprawidłowy.
+    Returns:
+        Słownik z obrazem dla LLM i jego typem MIME (`llm_bytes`, `image_mime`),
+        obrazem poprawionym lub None, jeśli orientacja i kadr się nie zmieniły (`fixed_bytes`),
+        rozszerzeniem pliku oryginału (`original_extension`), opisem obrazu wysłanego
+        do LLM (`llm_image`), informacją o wykrytej orientacji (`orientation`), statystykami
+        kadrowania (`processing`),
+        skrótami percepcyjnymi i profilem wierszy tekstu obszaru paragonu (`image_hash`,
+        `image_hash_rotated`, `row_profile` - pomijane, gdy `DUPLICATE_MODE=off`), cechami obrazu do wyboru backendu LLM
+        (`features`: proporcje, szacowana liczba linii i liczba pikseli) oraz czasami etapów
+        w sekundach (`timings`).
     """
+    started = time.perf_counter()
+    image = Image.open(io.BytesIO(image_data) if isinstance(image_data, bytes) else image_data)
+    original_extension = IMAGE_EXTENSIONS.get(image.format, "jpg")
+    timings = {"open": time.perf_counter() - started}
+
+    # Popraw orientację obrazu
+    started = time.perf_counter()
     try:
-        # Wczytaj obraz
-        image = Image.open(io.BytesIO(image_data))
+        image_fixed, orientation = fix_orientation(image, use_osd=use_osd)
+    except Exception as e:
+        logger.warning(f"Nie udało się poprawić rotacji: {str(e)}. Używam oryginalnego obrazu.")
+        image_fixed, orientation = image, {"tier": "none", "angle": 0}
+    timings["orientation"] = time.perf_counter() - started
+
+    # Skróty percepcyjne do wykrywania ponownie przesłanych zdjęć tego samego paragonu
+    # (na znormalizowanym obszarze paragonu - niezależnie od kadrowania obrazu dla LLM)
+    fingerprint = {}
+    if settings.storage.DUPLICATE_MODE != "off":
+        started = time.perf_counter()
+        fingerprint = receipt_fingerprint(image_fixed)
+        timings["image_hash"] = time.perf_counter() - started
+
+    # Kadrowanie do obszaru paragonu i prostowanie niewielkiego pochylenia
+    processing = {}
+    if settings.image.CROP_ENABLED:
+        started = time.perf_counter()
+        try:
+            image_fixed, processing["crop"] = crop_receipt(image_fixed)
+        except Exception as e:
+            logger.warning(f"Nie udało się wykadrować paragonu: {str(e)}. Używam całego obrazu.")
+        timings["crop"] = time.perf_counter() - started
+
+    transformed = image_fixed is not image
+
+    # Tanie cechy obrazu do wyboru backendu LLM
+    started = time.perf_counter()
+    width, height = image_fixed.size
+    features = {
+        "aspect": round(height / width, 2),
+        "lines": estimate_text_lines(image_fixed),
+    }
+    timings["features"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+
+    # Obraz dla LLM - oryginalne bajty lub obraz zmniejszony i zakodowany zgodnie z konfiguracją
+    if not transformed and can_send_original_to_llm(image):
+        if isinstance(image_data, bytes):
+            llm_bytes = image_data
+        else:
+            with open(image_data, "rb") as f:
+                llm_bytes = f.read()
+        llm_format = "JPEG"
+        llm_size = image.size
+        llm_mode = image.mode
+        reencoded = False
+    else:
+        llm_bytes, llm_format = encode_for_llm(image_fixed)
+        llm_image = Image.open(io.BytesIO(llm_bytes))
+        llm_size = llm_image.size
+        llm_mode = llm_image.mode
+        reencoded = True
+    timings["llm_encode"] = time.perf_counter() - started
+
+    return {
+        "llm_bytes": llm_bytes,
+        "image_mime": IMAGE_MIME_TYPES[llm_format],
+        "fixed_bytes": llm_bytes if transformed else None,
+        "fixed_extension": IMAGE_EXTENSIONS[llm_format],
+        "original_extension": original_extension,
+        "llm_image": {
+            "bytes": len(llm_bytes),
+            "width": llm_size[0],
+            "height": llm_size[1],
+            "format": llm_format,
+            "grayscale": llm_mode == "L",
+            "reencoded": reencoded,
+        },
+        "orientation": orientation,
+        "processing": processing,
+        **fingerprint,
+        "features": {**features, "pixels": llm_size[0] * llm_size[1]},
+        "timings": timings,
+    }
 
-        # Walidacja obrazu
-        is_valid, error_message = validate_image(image)
-        if not is_valid:
-            raise HTTPException(
-                status_code=400,
-                detail=error_message
-            )
 
-        # Poprawienie rotacji
-        image_fixed = fix_rotation(image)
+def optimize_image_for_ocr(image: Image.Image) -> Image.Image:
+    """
+    Optymalizuje obraz dla OCR poprzez zastosowanie filtrów.
 
-        # Optymalizacja dla OCR
-        image_optimized = optimize_image_for_ocr(image_fixed)
+    Args:
+        image: Obraz w formacie PIL.Image.
+
+    Returns:
+        Zoptymalizowany obraz.
+    """
+    try:
+        # Konwersja do skali szarości
+        image_gray = image.convert('L')
 
-        return image_optimized
+        # Zwiększenie kontrastu (opcjonalnie)
+        # from PIL import ImageEnhance
+        # enhancer = ImageEnhance.Contrast(image_gray)
+        # image_enhanced = enhancer.enhance(1.5)
 
-    except HTTPException:
-        raise
+        return image_gray
     except Exception as e:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Błąd przetwarzania obrazu: {str(e)}"
-        )
+        logger.warning(f"Nie udało się zoptymalizować obrazu: {str(e)}. Zwracam oryginalny obraz.")
+        return image
+
+
+VALID_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.pdf']
+
+
+def validate_image_filename(filename: Optional[str]) -> Tuple[bool, Optional[str]]:
+    """
+    Sprawdza, czy plik ma dozwolone rozszerzenie.
+
+    Args:
+        filename: Nazwa przesłanego pliku.
+
+    Returns:
+        Tuple zawierający: (czy_plik_jest_valid, opcjonalny_komunikat_błędu)
+    """
+    if not filename or not any(filename.lower().endswith(ext) for ext in VALID_EXTENSIONS):
+        return False, f"Nieprawidłowy format pliku. Dozwolone formaty: {', '.join(VALID_EXTENSIONS)}"
+
+    return True, None
@@ -0,0 +1,263 @@
+import re
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from fastapi import HTTPException
+
+from app.models.receipt import OCRCheckResult, OCRLine
+
+# Parametry tabeli kontrolnej (OCR CHECK) i ich wartości domyślne
+CHECK_DEFAULTS = {
+    "DATE": "19000101",
+    "COMPANY": "UNKNOWN",
+    "TOTAL": "0.00",
+}
+
+# Kwota na końcu linii produktu z opcjonalną literą stawki VAT (np. "1,59D", "2,37 A", "-1,00")
+ITEM_AMOUNT_PATTERN = re.compile(r"(-?\d+[.,]\d{2})(?:\s*([A-G]))?\s*$")
+# Początek części z ilością i ceną jednostkową (np. " 1 x1,59", " 0,702 x31,99", " 1*5,00")
+ITEM_QUANTITY_PATTERN = re.compile(r"\s+(?:\d+(?:[.,]\d+)?\s*)?[x*×]\s*\d")
+# Podsumowanie stawek VAT (linie S): sprzedaż opodatkowana i podatek PTU dla danej litery stawki
+VAT_SALES_PATTERN = re.compile(r"^SPRZEDA[ZŻ]\s+OPODATKOWANA\s+([A-G])\b.*?(\d+[.,]\d{2})\s*$", re.IGNORECASE)
+VAT_TAX_PATTERN = re.compile(r"^PTU\s+([A-G])\b.*?(\d+[.,]\d{2})\s*$", re.IGNORECASE)
+
+
+def split_table_row(line: str) -> Optional[List[str]]:
+    """
+    Dzieli wiersz tabeli Markdown na komórki.
+
+    Args:
+        line: Wiersz tekstu.
+
+    Returns:
+        Lista komórek bez białych znaków lub None, jeśli wiersz nie jest wierszem tabeli.
+    """
+    line = line.strip()
+    if line.count("|") < 3:
+        return None
+
+    return [cell.strip() for cell in line.strip("|").split("|")]
+
+
+def _line_from_cells(cells: List[str]) -> Optional[OCRLine]:
+    """Tworzy linię paragonu z komórek wiersza danych tabeli RECEIPT"""
+    if len(cells) < 3 or not cells[0].isdigit():
+        return None
+
+    # Treść może zawierać znak "|", więc łączymy pozostałe komórki
+    return OCRLine(
+        line_number=int(cells[0]),
+        category=cells[1],
+        content=" | ".join(cells[2:]).strip(),
+    )
+
+
+def parse_table_line(line: str) -> Optional[OCRLine]:
+    """
+    Parsuje wiersz tabeli RECEIPT w formacie `| Line | Category | Content |`.
+
+    Args:
+        line: Wiersz tekstu.
+
+    Returns:
+        Linia paragonu lub None, jeśli wiersz nie jest wierszem danych tabeli RECEIPT.
+    """
+    cells = split_table_row(line)
+    return _line_from_cells(cells) if cells is not None else None
+
+
+def parse_receipt_text(receipt_text: str) -> Tuple[List[OCRLine], OCRCheckResult, Dict[str, str]]:
+    """
+    Parsuje tekst OCR w jednym przebiegu.
+
+    Args:
+        receipt_text: Tekst zwrócony przez LLM (tabele RECEIPT i OCR CHECK)
+            lub zapisany plik `*_ocr_{version}.txt` z dodatkowymi parametrami.
+
+    Returns:
+        Tuple zawierający: (linie_paragonu, dane_kontrolne, parametry), gdzie parametry
+        to wszystkie pary z tabel dwukolumnowych (np. `DATE`, `LLM MODEL`, `TOKENS IN`).
+        Dla powtórzonych parametrów obowiązuje pierwsze wystąpienie.
+    """
+    lines = []
+    parameters = {}
+
+    for raw_line in receipt_text.split("\n"):
+        cells = split_table_row(raw_line)
+        if cells is None:
+            continue
+
+        line = _line_from_cells(cells)
+        if line is not None:
+            lines.append(line)
+        elif len(cells) >= 2 and cells[0] and not cells[0].startswith("-"):
+            parameters.setdefault(cells[0], cells[1])
+
+    check = OCRCheckResult(
+        date=parameters.get("DATE", CHECK_DEFAULTS["DATE"]),
+        company=parameters.get("COMPANY", CHECK_DEFAULTS["COMPANY"]),
+        total=parameters.get("TOTAL", CHECK_DEFAULTS["TOTAL"]),
+    )
+
+    return lines, check, parameters
+
+
+def validate_receipt_text(receipt_text: str, check: bool = True) -> List[str]:
+    """
+    Sprawdza, czy odpowiedź LLM wygląda na poprawnie odczytany paragon.
+
+    Args:
+        receipt_text: Tekst zwrócony przez LLM (tabele RECEIPT i OCR CHECK).
+        check: Czy wymagać daty i kwoty w tabeli kontrolnej (strony dokumentu PDF
+            mogą ich nie zawierać).
+
+    Returns:
+        Lista wykrytych problemów (`no_lines`, `no_date`, `no_total`) - pusta dla poprawnego wyniku.
+    """
+    lines, receipt_check, _ = parse_receipt_text(receipt_text)
+
+    problems = []
+    if not lines:
+        problems.append("no_lines")
+    if check and receipt_check.date == CHECK_DEFAULTS["DATE"]:
+        problems.append("no_date")
+    if check and parse_amount(receipt_check.total) in (None, 0):
+        problems.append("no_total")
+    return problems
+
+
+def merge_receipt_pages(page_texts: List[str]) -> str:
+    """
+    Łączy odpowiedzi OCR kolejnych stron dokumentu w jeden tekst OCR paragonu.
+
+    Linie stron trafiają do jednej tabeli RECEIPT z ciągłą numeracją. Data i nazwa
+    sprzedawcy pochodzą z pierwszej strony, na której je odczytano, a kwota - z ostatniej
+    (suma jest zwykle na końcu dokumentu).
+
+    Args:
+        page_texts: Odpowiedzi LLM dla kolejnych stron (tabele RECEIPT i OCR CHECK).
+
+    Returns:
+        Tekst w formacie odpowiedzi LLM (tabele RECEIPT i OCR CHECK).
+    """
+    rows = ["| Line | Category | Content |", "|---|---|---|"]
+    check = {}
+
+    for page_text in page_texts:
+        lines, page_check, _ = parse_receipt_text(page_text)
+        for line in lines:
+            rows.append(f"| {len(rows) - 1} | {line.category} | {line.content} |")
+
+        for name, value in (("DATE", page_check.date), ("COMPANY", page_check.company), ("TOTAL", page_check.total)):
+            if value != CHECK_DEFAULTS[name] and (name == "TOTAL" or name not in check):
+                check[name] = value
+
+    rows += ["", "| Parameter | Value |", "|---|---|"]
+    rows += [f"| {name} | {check.get(name, default)} |" for name, default in CHECK_DEFAULTS.items()]
+    return "\n".join(rows)
+
+
+def parse_amount(value: Optional[str]) -> Optional[float]:
+    """
+    Zamienia kwotę z paragonu na liczbę.
+
+    Obsługuje przecinek dziesiętny i separatory tysięcy (np. "1 234,56", "74.86", "12,50 PLN").
+
+    Returns:
+        Kwota lub None, jeśli wartości nie da się odczytać.
+    """
+    if not value:
+        return None
+
+    text = "".join(ch for ch in value if ch.isdigit() or ch in ",.-")
+    if "," in text and "." in text:
+        # Separatorem dziesiętnym jest znak występujący jako ostatni
+        thousands = "." if text.rfind(",") > text.rfind(".") else ","
+        text = text.replace(thousands, "")
+    text = text.replace(",", ".")
+
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def normalize_receipt_date(value: Optional[str], name: str) -> Optional[str]:
+    """Zamienia datę z parametru zapytania (YYYYMMDD lub YYYY-MM-DD) na format katalogów DATA_DIR"""
+    if not value:
+        return None
+
+    for date_format in ("%Y%m%d", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, date_format).strftime("%Y%m%d")
+        except ValueError:
+            continue
+
+    raise HTTPException(
+        status_code=400,
+        detail=f"Nieprawidłowa data w parametrze {name}: {value} (oczekiwano YYYYMMDD lub YYYY-MM-DD)"
+    )
+
+
+def _line_field(line: Union[OCRLine, Dict[str, Any]], name: str) -> Any:
+    return line[name] if isinstance(line, dict) else getattr(line, name)
+
+
+def _product_name(content: str, amount_start: Optional[int]) -> str:
+    """Wyodrębnia nazwę produktu z linii P (bez ilości, ceny i litery stawki VAT)"""
+    name = content if amount_start is None else content[:amount_start]
+    quantity = ITEM_QUANTITY_PATTERN.search(name)
+    if quantity:
+        name = name[:quantity.start()]
+    name = re.sub(r"\s+[A-G]\s*$", "", name.strip())
+    return " ".join(name.split())
+
+
+def extract_receipt_facts(lines: Iterable[Union[OCRLine, Dict[str, Any]]]) -> Dict[str, List[tuple]]:
+    """
+    Wyodrębnia z linii paragonu pozycje zakupów, podsumowanie stawek VAT i treść linii do wyszukiwania.
+
+    Pozycja to linia P wraz z następującymi po niej liniami PC - kwota i litera
+    stawki VAT pochodzą z linii P, a jeśli jej brak, z pierwszej linii PC z kwotą.
+    Ujemne kwoty w kolejnych liniach PC (rabaty) pomniejszają wartość pozycji.
+
+    Returns:
+        Słownik z listami krotek:
+        `items` - (numer linii, nazwa produktu, litera stawki VAT lub None, kwota),
+        `vat` - (litera stawki VAT, sprzedaż opodatkowana lub None, podatek PTU lub None),
+        `lines` - (numer linii, kategoria, treść) do wyszukiwania pełnotekstowego.
+    """
+    items: List[list] = []
+    search_lines: List[tuple] = []
+    vat: Dict[str, List[Optional[float]]] = {}
+
+    for line in lines:
+        category = _line_field(line, "category")
+        content = _line_field(line, "content") or ""
+        match = ITEM_AMOUNT_PATTERN.search(content)
+        if content.strip():
+            search_lines.append((_line_field(line, "line_number"), category, content))
+
+        if category == "P":
+            amount = parse_amount(match.group(1)) if match else None
+            name = _product_name(content, match.start() if match else None)
+            items.append([_line_field(line, "line_number"), name, match.group(2) if match else None, amount])
+        elif category == "PC" and items and match:
+            item = items[-1]
+            amount = parse_amount(match.group(1))
+            if item[3] is None:
+                item[3] = amount
+                item[2] = item[2] or match.group(2)
+            elif amount is not None and amount < 0:
+                item[3] += amount
+        elif category == "S":
+            for pattern, index in ((VAT_SALES_PATTERN, 0), (VAT_TAX_PATTERN, 1)):
+                vat_match = pattern.match(content.strip())
+                if vat_match:
+                    vat.setdefault(vat_match.group(1).upper(), [None, None])[index] = parse_amount(vat_match.group(2))
+
+    return {
+        "items": [tuple(item) for item in items if item[1] and item[3] is not None],
+        "vat": [(vat_class, sales, tax) for vat_class, (sales, tax) in sorted(vat.items())],
+        "lines": search_lines,
+    }
@@ -0,0 +1,127 @@
+import io
+import time
+from typing import Any, Dict, Union
+
+from PIL import Image
+
+from app.core.config import settings
+from app.utils.image import IMAGE_MIME_TYPES, downscale_image, encode_for_llm, encode_image, estimate_text_lines
+
+# Obsługa PDF jest opcjonalna (pakiet pypdfium2)
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+PDF_MAGIC = b"%PDF-"
+
+
+def is_pdf(data: Union[bytes, str]) -> bool:
+    """Sprawdza po sygnaturze, czy dane (bajty lub ścieżka do pliku) są dokumentem PDF"""
+    if isinstance(data, bytes):
+        return data[:len(PDF_MAGIC)] == PDF_MAGIC
+    with open(data, "rb") as f:
+        return f.read(len(PDF_MAGIC)) == PDF_MAGIC
+
+
+def pdf_support_available() -> bool:
+    """Sprawdza, czy zainstalowano pakiet pypdfium2"""
+    return pdfium is not None
+
+
+def _open_document(data: Union[bytes, str]) -> "pdfium.PdfDocument":
+    if pdfium is None:
+        raise RuntimeError("Obsługa plików PDF wymaga pakietu pypdfium2")
+    return pdfium.PdfDocument(data)
+
+
+def inspect_pdf(data: Union[bytes, str]) -> Dict[str, Any]:
+    """
+    Odczytuje liczbę stron i osadzony tekst każdej strony dokumentu PDF.
+
+    Funkcja jest uruchamiana w puli procesów (bez renderowania stron).
+
+    Args:
+        data: Bajty dokumentu lub ścieżka do pliku.
+
+    Returns:
+        Słownik z liczbą stron (`pages`) i tekstem stron (`texts`, pusty dla stron bez warstwy tekstowej).
+    """
+    document = _open_document(data)
+    try:
+        texts = []
+        for index in range(len(document)):
+            page = document[index]
+            text_page = page.get_textpage()
+            try:
+                texts.append(text_page.get_text_bounded().strip())
+            finally:
+                text_page.close()
+                page.close()
+        return {"pages": len(texts), "texts": texts}
+    finally:
+        document.close()
+
+
+def render_pdf_page(data: Union[bytes, str], page_index: int, dpi: int) -> Image.Image:
+    """Renderuje stronę dokumentu PDF jako obraz RGB w zadanej rozdzielczości"""
+    document = _open_document(data)
+    try:
+        page = document[page_index]
+        try:
+            return page.render(scale=dpi / 72).to_pil().convert("RGB")
+        finally:
+            page.close()
+    finally:
+        document.close()
+
+
+def prepare_pdf_page(data: Union[bytes, str], page_index: int) -> Dict[str, Any]:
+    """
+    Renderuje stronę dokumentu PDF i koduje ją do wysłania do LLM.
+
+    Strony są renderowane pojedynczo, dopiero gdy są potrzebne (w puli procesów).
+
+    Returns:
+        Słownik jak z `prepare_receipt_image`: obraz dla LLM (`llm_bytes`, `image_mime`),
+        jego opis (`llm_image`), cechy strony do wyboru backendu LLM (`features`)
+        i czasy etapów (`timings`).
+    """
+    started = time.perf_counter()
+    image = render_pdf_page(data, page_index, settings.image.PDF_RENDER_DPI)
+    timings = {"pdf_render": time.perf_counter() - started}
+
+    started = time.perf_counter()
+    features = {
+        "aspect": round(image.height / image.width, 2),
+        "lines": estimate_text_lines(image),
+    }
+    timings["features"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    llm_bytes, llm_format = encode_for_llm(image)
+    timings["llm_encode"] = time.perf_counter() - started
+
+    width, height = Image.open(io.BytesIO(llm_bytes)).size
+    return {
+        "llm_bytes": llm_bytes,
+        "image_mime": IMAGE_MIME_TYPES[llm_format],
+        "llm_image": {
+            "page": page_index + 1,
+            "bytes": len(llm_bytes),
+            "width": width,
+            "height": height,
+            "format": llm_format,
+            "grayscale": settings.image.LLM_GRAYSCALE,
+            "reencoded": True,
+        },
+        "features": {**features, "pixels": width * height},
+        "timings": timings,
+    }
+
+
+def render_pdf_variant(source_path: str, max_long_edge: int, quality: int) -> bytes:
+    """Tworzy pomniejszony obraz pierwszej strony dokumentu PDF (miniatura lub podgląd) w formacie JPEG"""
+    image = render_pdf_page(source_path, 0, settings.image.PDF_RENDER_DPI)
+    return encode_image(downscale_image(image, max_long_edge=max_long_edge), format="JPEG", quality=quality)
+
@@ -0,0 +1,147 @@
+import io
+import os
+import hashlib
+import tempfile
+import logging
+from typing import Optional, Union
+
+from fastapi import UploadFile, HTTPException
+
+from app.core.config import settings
+from app.core.metrics import track_stage
+
+logger = logging.getLogger(__name__)
+
+
+class IngestedUpload:
+    """
+    Przesłany plik wczytany porcjami wraz z haszem SHA256.
+
+    Małe pliki są trzymane w pamięci, a większe od progu `UPLOAD_SPOOL_THRESHOLD`
+    w pliku tymczasowym, który jest usuwany przy zamknięciu obiektu.
+    """
+
+    def __init__(self, filename: Optional[str], file_hash: str, size: int,
+                 data: Optional[bytes] = None, path: Optional[str] = None):
+        self.filename = filename
+        self.file_hash = file_hash
+        self.size = size
+        self.data = data
+        self.path = path
+
+    @property
+    def source(self) -> Union[bytes, str]:
+        """Bajty pliku lub ścieżka do pliku tymczasowego (do przekazania do puli procesów)"""
+        return self.data if self.data is not None else self.path
+
+    def read_bytes(self) -> bytes:
+        """Zwraca całą zawartość pliku"""
+        if self.data is not None:
+            return self.data
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def close(self) -> None:
+        """Zwalnia pamięć i usuwa plik tymczasowy"""
+        self.data = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+    def __enter__(self) -> "IngestedUpload":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def spool_to_file(data: bytes) -> str:
+    """
+    Zapisuje dane do pliku tymczasowego w katalogu `UPLOAD_TMP_DIR`.
+
+    Używane, gdy te same dane trafiają do wielu zadań puli procesów - ścieżka
+    jest przekazywana zamiast serializowania bajtów dla każdego zadania.
+    Plik usuwa wywołujący.
+
+    Returns:
+        Ścieżka do pliku tymczasowego.
+    """
+    with tempfile.NamedTemporaryFile(
+            prefix="upload_", suffix=".bin", dir=settings.app.UPLOAD_TMP_DIR or None, delete=False
+    ) as spool:
+        spool.write(data)
+    return spool.name
+
+
+def upload_too_large_error() -> HTTPException:
+    """Zwraca błąd HTTP dla pliku przekraczającego dozwolony rozmiar"""
+    return HTTPException(
+        status_code=413,
+        detail=f"Plik jest zbyt duży. Maksymalny rozmiar to {settings.app.UPLOAD_MAX_BYTES} bajtów."
+    )
+
+
+async def ingest_upload(file: UploadFile) -> IngestedUpload:
+    """
+    Wczytuje przesłany plik porcjami, licząc SHA256 w trakcie odczytu.
+
+    Args:
+        file: Przesłany plik.
+
+    Returns:
+        Wczytany plik (w pamięci lub w pliku tymczasowym).
+
+    Raises:
+        HTTPException: Jeśli plik przekracza `UPLOAD_MAX_BYTES` (413).
+    """
+    app_settings = settings.app
+    max_bytes = app_settings.UPLOAD_MAX_BYTES
+
+    # Odrzuć zbyt duży plik bez odczytu, jeśli rozmiar jest znany z góry
+    if max_bytes and file.size is not None and file.size > max_bytes:
+        raise upload_too_large_error()
+
+    with track_stage("ingest"):
+        sha256_hash = hashlib.sha256()
+        buffer = io.BytesIO()
+        spool = None
+        size = 0
+
+        try:
+            while True:
+                chunk = await file.read(app_settings.UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise upload_too_large_error()
+
+                sha256_hash.update(chunk)
+
+                if spool is None and size > app_settings.UPLOAD_SPOOL_THRESHOLD:
+                    # Przenieś dotychczasowe dane na dysk i dalej pisz bezpośrednio do pliku
+                    spool = tempfile.NamedTemporaryFile(
+                        prefix="upload_", suffix=".bin", dir=app_settings.UPLOAD_TMP_DIR or None, delete=False
+                    )
+                    spool.write(buffer.getvalue())
+                    buffer = None
+
+                if spool is not None:
+                    spool.write(chunk)
+                else:
+                    buffer.write(chunk)
+        except BaseException:
+            if spool is not None:
+                spool.close()
+                os.remove(spool.name)
+            raise
+
+        if spool is not None:
+            spool.close()
+            return IngestedUpload(file.filename, sha256_hash.hexdigest(), size, path=spool.name)
+
+        return IngestedUpload(file.filename, sha256_hash.hexdigest(), size, data=buffer.getvalue())
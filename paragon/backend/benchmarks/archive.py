@@ -0,0 +1,168 @@
+"""
+Generator syntetycznego archiwum paragonów w układzie katalogów DATA_DIR.
+
+Uruchomienie:
+    python -m benchmarks.archive --size 10000 --data-dir /tmp/paragon-bench/archive-10000
+"""
+import io
+import os
+import json
+import random
+import hashlib
+import argparse
+from datetime import date, datetime, timedelta
+from typing import List
+
+from PIL import Image
+from fastapi.encoders import jsonable_encoder
+
+from app.models.receipt import OCRResult
+from app.utils.parser import parse_receipt_text
+
+from benchmarks.stub_llm import load_recordings
+
+# Plik znacznika z liczbą paragonów - archiwum o tym samym rozmiarze i ziarnie jest używane ponownie
+MARKER_FILE = ".benchmark_archive.json"
+
+COMPANIES = [
+    "Lidl sp. z o.o. sp.k.",
+    "Jeronimo Martins Polska S.A.",
+    "MARKET PUNKT 4PL Sp. z .o.o. Sp. K.",
+    "Bonito.pl Sp. z o.o.",
+    "Rossmann SDP Sp. z o.o.",
+    "Kaufland Polska Markety Sp. z o.o. sp.j.",
+]
+PROMPT_VERSIONS = ["1_0_2", "1_0_3"]
+
+
+def receipt_hashes(size: int, seed: int = 0) -> List[str]:
+    """Zwraca hasze paragonów archiwum (te same dla tego samego rozmiaru i ziarna)"""
+    return [hashlib.sha256(f"{seed}-{index}".encode()).hexdigest() for index in range(size)]
+
+
+def receipt_created_at(index: int) -> str:
+    """Zwraca datę utworzenia paragonu archiwum o danym numerze (co minutę od 2024-01-01)"""
+    return (datetime(2024, 1, 1) + timedelta(seconds=index * 60)).isoformat()
+
+
+def placeholder_image() -> bytes:
+    """Zwraca mały obraz JPEG zapisywany jako oryginał każdego paragonu"""
+    buffer = io.BytesIO()
+    Image.new("L", (64, 160), color=255).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def replace_check(text: str, receipt_date: str, company: str, total: str) -> str:
+    """Podmienia dane kontrolne (DATE, COMPANY, TOTAL) w tekście OCR"""
+    values = {"DATE": receipt_date, "COMPANY": company, "TOTAL": total}
+    lines = []
+    for line in text.split("\n"):
+        for name, value in values.items():
+            if line.startswith(f"| {name} |"):
+                line = f"| {name} | {value} |"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def generate_archive(data_dir: str, size: int, seed: int = 0) -> bool:
+    """
+    Tworzy syntetyczne archiwum paragonów w formacie zapisywanym przez aplikację.
+
+    Returns:
+        False, jeśli archiwum o tym rozmiarze i ziarnie już istnieje, True w przeciwnym razie.
+    """
+    marker_path = os.path.join(data_dir, MARKER_FILE)
+    expected = {"size": size, "seed": seed}
+    if os.path.exists(marker_path):
+        with open(marker_path, "r", encoding="utf-8") as f:
+            if json.load(f) == expected:
+                return False
+        raise ValueError(f"Katalog {data_dir} zawiera archiwum o innych parametrach")
+
+    rng = random.Random(seed)
+    recordings = load_recordings()
+    image_bytes = placeholder_image()
+    start_date = date(2023, 1, 1)
+
+    for index, file_hash in enumerate(receipt_hashes(size, seed)):
+        recording = rng.choice(recordings)
+        prompt_version = rng.choice(PROMPT_VERSIONS)
+        receipt_date = (start_date + timedelta(days=rng.randrange(730))).strftime("%Y%m%d")
+        company = rng.choice(COMPANIES)
+        total = f"{rng.uniform(1, 500):.2f}".replace(".", ",")
+        created_at = receipt_created_at(index)
+
+        output_dir = os.path.join(data_dir, receipt_date, file_hash)
+        os.makedirs(output_dir, exist_ok=True)
+
+        ocr_text = replace_check(recording["content"], receipt_date, company, total)
+        ocr_text += (
+            f"\n| LLM MODEL | gpt-4o |\n| TOKENS IN | {recording['prompt_tokens']} |"
+            f"\n| TOKENS OUT | {recording['completion_tokens']} |"
+            f"\n| HASH | {file_hash} |\n| OCR PROMPT VERSION | {prompt_version} |"
+        )
+        lines, check, _ = parse_receipt_text(ocr_text)
+        parsed = OCRResult(
+            file_hash=file_hash,
+            check=check,
+            lines=lines,
+            llm_model="gpt-4o",
+            tokens_in=recording["prompt_tokens"],
+            tokens_out=recording["completion_tokens"],
+            ocr_prompt_version=prompt_version,
+        )
+
+        original_path = os.path.join(output_dir, f"{file_hash}.jpg")
+        ocr_path = os.path.join(output_dir, f"{file_hash}_ocr_{prompt_version}.txt")
+        parsed_path = os.path.join(output_dir, f"{file_hash}_ocr_{prompt_version}.json")
+
+        with open(original_path, "wb") as f:
+            f.write(image_bytes)
+        with open(ocr_path, "w", encoding="utf-8") as f:
+            f.write(ocr_text)
+        with open(parsed_path, "w", encoding="utf-8") as f:
+            json.dump(jsonable_encoder(parsed), f, ensure_ascii=False)
+
+        metadata = {
+            "file_hash": file_hash,
+            "receipt_date": receipt_date,
+            "prompt_version": prompt_version,
+            "prompt_fingerprint": None,
+            "created_at": created_at,
+            "check_company": company,
+            "check_total": total,
+            "llm": {
+                "model": "gpt-4o",
+                "tokens_in": recording["prompt_tokens"],
+                "tokens_out": recording["completion_tokens"],
+            },
+            "processing": None,
+            "file_paths": {
+                "original": original_path,
+                "fixed": None,
+                "ocr": ocr_path,
+                "parsed": parsed_path,
+            },
+        }
+        with open(os.path.join(output_dir, f"{file_hash}_metadata.json"), "w", encoding="utf-8") as f:
+            json.dump(metadata, f, indent=2)
+
+    with open(marker_path, "w", encoding="utf-8") as f:
+        json.dump(expected, f)
+
+    return True
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generowanie syntetycznego archiwum paragonów")
+    parser.add_argument("--size", type=int, required=True, help="liczba paragonów")
+    parser.add_argument("--data-dir", required=True, help="katalog archiwum (DATA_DIR aplikacji)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    created = generate_archive(args.data_dir, args.size, args.seed)
+    print(f"{'Utworzono' if created else 'Użyto istniejącego'} archiwum {args.data_dir} ({args.size} paragonów)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+"""
+Testy wydajności API na lokalnym serwerze LLM i syntetycznych archiwach paragonów.
+
+Dla każdego rozmiaru archiwum uruchamiany jest serwer testowy LLM i aplikacja
+(osobne procesy uvicorn), a następnie scenariusze żądań z zadaną współbieżnością.
+Wynik (opóźnienia p50/p95/p99, liczba żądań na sekundę, szczytowe RSS) jest
+zapisywany w formacie JSON, który można porównywać między wersjami.
+
+Uruchomienie:
+    python -m benchmarks.run --sizes 1000,10000 --concurrency 1,8,32 --output wyniki.json
+"""
+import os
+import sys
+import glob
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from app.services.index import encode_cursor
+from benchmarks.archive import COMPANIES, generate_archive, receipt_created_at, receipt_hashes
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("ocr", "ocr_cached", "history", "history_cursor", "detail")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Percentyl metodą najbliższej rangi (wartości muszą być posortowane)"""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def read_status_kb(pid: int, field: str) -> int:
+    """Odczytuje pole (np. VmHWM) z /proc/{pid}/status w kB"""
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1])
+    except (FileNotFoundError, ProcessLookupError):
+        pass
+    return 0
+
+
+def child_pids(pid: int) -> List[int]:
+    """Zwraca identyfikatory procesów potomnych (np. puli procesów obrazów)"""
+    children = []
+    for path in glob.glob(f"/proc/{pid}/task/*/children"):
+        try:
+            with open(path, "r") as f:
+                children.extend(int(child) for child in f.read().split())
+        except FileNotFoundError:
+            continue
+    return children
+
+
+def peak_rss(pid: int) -> Dict[str, float]:
+    """Szczytowe RSS procesu aplikacji i suma szczytowych RSS jego procesów potomnych (MB)"""
+    return {
+        "app_mb": round(read_status_kb(pid, "VmHWM") / 1024, 1),
+        "children_mb": round(sum(read_status_kb(child, "VmHWM") for child in child_pids(pid)) / 1024, 1),
+    }
+
+
+def wait_for_http(url: str, process: subprocess.Popen, timeout: float) -> float:
+    """Czeka, aż serwer zacznie odpowiadać, i zwraca czas oczekiwania w sekundach"""
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"Proces serwera zakończył się z kodem {process.returncode}")
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return time.perf_counter() - start
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError(f"Serwer {url} nie odpowiada po {timeout} s")
+
+
+def start_process(args: List[str], env: Dict[str, str]) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, *args],
+        cwd=BACKEND_DIR,
+        env={**os.environ, **env},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def stop_process(process: subprocess.Popen) -> None:
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def load_images() -> List[bytes]:
+    """Obrazy paragonów wysyłane w scenariuszach OCR"""
+    paths = [
+        path for path in sorted(glob.glob(os.path.join(BACKEND_DIR, "data-test", "*", "*.jpg")))
+        if "_fixed" not in path
+    ]
+    images = []
+    for path in paths:
+        with open(path, "rb") as f:
+            images.append(f.read())
+    return images
+
+
+async def run_scenario(
+        base_url: str,
+        name: str,
+        concurrency: int,
+        requests: int,
+        hashes: List[str],
+        images: List[bytes],
+        seed: int,
+) -> Dict[str, Any]:
+    """Wykonuje `requests` żądań scenariusza z zadaną współbieżnością"""
+    rng = random.Random(f"{seed}-{name}-{concurrency}")
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    def build_request(index: int) -> Dict[str, Any]:
+        if name in ("ocr", "ocr_cached"):
+            return {
+                "method": "POST",
+                "url": "/ocr-receipt",
+                "files": {"file": ("receipt.jpg", images[index % len(images)], "image/jpeg")},
+                "data": {"refresh_cache": "true" if name == "ocr" else "false"},
+            }
+        if name == "history":
+            offset = rng.randrange(max(1, len(hashes) - 10))
+            return {"method": "GET", "url": "/receipts", "params": {"limit": 10, "offset": offset}}
+        if name == "history_cursor":
+            # Strona na losowej głębokości (kursor) z filtrem sprzedawcy
+            position = rng.randrange(len(hashes))
+            cursor = encode_cursor("created_at", True, (receipt_created_at(position), hashes[position]))
+            params = {"limit": 10, "cursor": cursor, "company": rng.choice(COMPANIES).split()[0]}
+            return {"method": "GET", "url": "/receipts", "params": params}
+        return {"method": "GET", "url": f"/receipts/{rng.choice(hashes)}"}
+
+    async def worker(client: httpx.AsyncClient) -> None:
+        nonlocal errors
+        for index in counter:
+            request = build_request(index)
+            start = time.perf_counter()
+            try:
+                response = await client.request(**request)
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=300.0, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "scenario": name,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "duration_s": round(elapsed, 3),
+        "rps": round(requests / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99": round(percentile(latencies, 0.99) * 1000, 2),
+            "mean": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+            "max": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        },
+    }
+
+
+def run_archive(size: int, args: argparse.Namespace, stub_url: str) -> Dict[str, Any]:
+    """Uruchamia aplikację na archiwum o danym rozmiarze i wykonuje wszystkie scenariusze"""
+    data_dir = os.path.join(args.work_dir, f"archive-{size}")
+    generate_start = time.perf_counter()
+    generated = generate_archive(data_dir, size, args.seed)
+    generate_seconds = time.perf_counter() - generate_start
+
+    # Indeks jest budowany od zera przy każdym przebiegu, więc czas startu jest porównywalny
+    for suffix in ("", "-wal", "-shm"):
+        index_path = os.path.join(data_dir, f"receipts.sqlite3{suffix}")
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+    port = free_port()
+    app_process = start_process(
+        ["-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        {
+            "DATA_DIR": data_dir,
+            "OPENAI_API_KEY": "benchmark",
+            "OPENAI_BASE_URL": stub_url,
+            "JOBS_DIR": os.path.join(args.work_dir, f"jobs-{size}"),
+            **dict(item.split("=", 1) for item in args.app_env),
+        },
+    )
+
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        startup_seconds = wait_for_http(f"{base_url}/health", app_process, timeout=args.startup_timeout)
+        hashes = receipt_hashes(size, args.seed)
+        images = load_images()
+
+        results = []
+        for name in args.scenarios:
+            for concurrency in args.concurrency:
+                requests = args.ocr_requests if name.startswith("ocr") else args.requests
+                result = asyncio.run(run_scenario(base_url, name, concurrency, requests, hashes, images, args.seed))
+                results.append(result)
+                print(
+                    f"[{size}] {name} c={concurrency}: {result['rps']} req/s, "
+                    f"p50={result['latency_ms']['p50']} ms, p99={result['latency_ms']['p99']} ms, "
+                    f"błędy={result['errors']}",
+                    file=sys.stderr,
+                )
+
+        rss = peak_rss(app_process.pid)
+    finally:
+        stop_process(app_process)
+
+    return {
+        "archive_size": size,
+        "archive_generated": generated,
+        "archive_generate_s": round(generate_seconds, 3),
+        "startup_s": round(startup_seconds, 3),
+        "peak_rss": rss,
+        "scenarios": results,
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_list(value: str, item_type=str) -> list:
+    return [item_type(item) for item in value.split(",") if item]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Testy wydajności API paragonów")
+    parser.add_argument("--sizes", type=lambda v: parse_list(v, int), default=[1000],
+                        help="rozmiary archiwów, np. 1000,10000,100000")
+    parser.add_argument("--concurrency", type=lambda v: parse_list(v, int), default=[1, 8, 32],
+                        help="poziomy współbieżności, np. 1,8,32")
+    parser.add_argument("--scenarios", type=parse_list, default=list(SCENARIOS),
+                        help=f"scenariusze: {','.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=500, help="liczba żądań scenariuszy odczytu")
+    parser.add_argument("--ocr-requests", type=int, default=50, help="liczba żądań scenariuszy OCR")
+    parser.add_argument("--llm-latency", type=float, default=2.0, help="średni czas odpowiedzi serwera LLM (s)")
+    parser.add_argument("--llm-jitter", type=float, default=0.5, help="odchylenie czasu odpowiedzi serwera LLM (s)")
+    parser.add_argument("--llm-rate-limit-rpm", type=int, default=0,
+                        help="limit zapytań na minutę serwera LLM (odpowiedzi 429), 0 oznacza brak")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="odsetek odpowiedzi 500 serwera LLM")
+    parser.add_argument("--work-dir", default="/tmp/paragon-bench", help="katalog archiwów i kolejki zadań")
+    parser.add_argument("--app-env", action="append", default=[],
+                        help="dodatkowa zmienna środowiskowa aplikacji NAZWA=wartość (można powtarzać)")
+    parser.add_argument("--startup-timeout", type=float, default=600.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="plik wyniku JSON (domyślnie standardowe wyjście)")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Nieznane scenariusze: {', '.join(sorted(unknown))}")
+
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    stub_port = free_port()
+    stub_process = start_process(
+        ["-m", "benchmarks.stub_llm", "--port", str(stub_port), "--latency", str(args.llm_latency),
+         "--jitter", str(args.llm_jitter), "--seed", str(args.seed),
+         "--rate-limit-rpm", str(args.llm_rate_limit_rpm), "--error-rate", str(args.llm_error_rate)],
+        {},
+    )
+
+    try:
+        wait_for_http(f"http://127.0.0.1:{stub_port}/stats", stub_process, timeout=30)
+        stub_url = f"http://127.0.0.1:{stub_port}/v1"
+        runs = [run_archive(size, args, stub_url) for size in args.sizes]
+    finally:
+        stop_process(stub_process)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "parameters": {
+                key: value for key, value in vars(args).items() if key not in ("output", "work_dir")
+            },
+        },
+        "runs": runs,
+    }
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
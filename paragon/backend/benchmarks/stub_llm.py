@@ -0,0 +1,234 @@
+"""
+Lokalny serwer zgodny z API OpenAI (`/v1/chat/completions`) do testów wydajności.
+
+Serwer odtwarza zapisane odpowiedzi OCR (pliki `data-test/*/*_ocr_*.txt`)
+z konfigurowalnym opóźnieniem, obsługując odpowiedzi zwykłe i strumieniowe.
+
+Uruchomienie:
+    python -m benchmarks.stub_llm --port 8100 --latency 2.0 --jitter 0.5
+"""
+import os
+import glob
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import itertools
+from typing import Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from app.utils.parser import parse_receipt_text
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_RECORDINGS = os.path.join(BACKEND_DIR, "data-test", "*", "*_ocr_*.txt")
+
+# Wiersze dopisywane przez aplikację po odpowiedzi LLM - nie są częścią odpowiedzi modelu
+APPENDED_PARAMETERS = ("LLM MODEL", "TOKENS IN", "TOKENS OUT", "HASH", "OCR PROMPT VERSION")
+
+
+def load_recordings(pattern: str = DEFAULT_RECORDINGS) -> List[Dict[str, object]]:
+    """
+    Wczytuje zapisane odpowiedzi OCR.
+
+    Returns:
+        Lista słowników z treścią odpowiedzi modelu (`content`) i liczbą tokenów
+        (`prompt_tokens`, `completion_tokens`) odczytaną z zapisanych parametrów.
+    """
+    recordings = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+
+        _, _, parameters = parse_receipt_text(text)
+        content = "\n".join(
+            line for line in text.split("\n")
+            if not any(line.startswith(f"| {name} |") for name in APPENDED_PARAMETERS)
+        ).rstrip()
+
+        recordings.append({
+            "content": content,
+            "prompt_tokens": int(parameters.get("TOKENS IN", 1000)),
+            "completion_tokens": int(parameters.get("TOKENS OUT", 500)),
+        })
+
+    if not recordings:
+        raise FileNotFoundError(f"Brak zapisanych odpowiedzi OCR: {pattern}")
+
+    return recordings
+
+
+def create_app(
+        recordings: List[Dict[str, object]],
+        latency: float = 2.0,
+        jitter: float = 0.0,
+        first_token_latency: Optional[float] = None,
+        seed: int = 0,
+        rate_limit_rpm: int = 0,
+        error_rate: float = 0.0,
+) -> FastAPI:
+    """
+    Tworzy aplikację serwera testowego.
+
+    Args:
+        recordings: Odpowiedzi odtwarzane kolejno (po kolei, w pętli).
+        latency: Średni czas całej odpowiedzi w sekundach.
+        jitter: Maksymalne odchylenie czasu odpowiedzi (rozkład jednostajny ±jitter).
+        first_token_latency: Czas do pierwszego fragmentu odpowiedzi strumieniowej
+            (domyślnie 20% czasu odpowiedzi).
+        seed: Ziarno generatora opóźnień (powtarzalne przebiegi).
+        rate_limit_rpm: Limit zapytań na minutę (okno przesuwne) - po jego przekroczeniu
+            serwer odpowiada 429 z nagłówkiem `Retry-After` (0 oznacza brak limitu).
+        error_rate: Odsetek zapytań kończonych błędem 500 (błędy przejściowe).
+    """
+    app = FastAPI(title="Stub LLM")
+    cycle = itertools.cycle(recordings)
+    rng = random.Random(seed)
+    stats = {"requests": 0, "in_flight": 0, "max_in_flight": 0, "throttled": 0, "errors": 0}
+    accepted: List[float] = []
+
+    def next_latency() -> float:
+        return max(0.0, latency + rng.uniform(-jitter, jitter))
+
+    def completion_id() -> str:
+        return f"chatcmpl-{uuid.uuid4().hex[:24]}"
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    def throttle_delay() -> Optional[float]:
+        """Zwraca czas do zwolnienia miejsca w oknie minutowym lub None, jeśli zapytanie mieści się w limicie"""
+        if rate_limit_rpm <= 0:
+            return None
+        now = time.monotonic()
+        while accepted and accepted[0] <= now - 60:
+            accepted.pop(0)
+        if len(accepted) < rate_limit_rpm:
+            accepted.append(now)
+            return None
+        return accepted[0] + 60 - now
+
+    def error_response(status_code: int, message: str, headers: Optional[Dict[str, str]] = None) -> JSONResponse:
+        return JSONResponse(
+            status_code=status_code,
+            content={"error": {"message": message, "type": "stub_error", "code": str(status_code)}},
+            headers=headers,
+        )
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+
+        retry_after = throttle_delay()
+        if retry_after is not None:
+            stats["throttled"] += 1
+            return error_response(429, "Rate limit reached", {"retry-after": f"{retry_after:.3f}"})
+        if error_rate and rng.random() < error_rate:
+            stats["errors"] += 1
+            return error_response(500, "Internal server error")
+
+        recording = next(cycle)
+        model = body.get("model", "stub")
+        delay = next_latency()
+        usage = {
+            "prompt_tokens": recording["prompt_tokens"],
+            "completion_tokens": recording["completion_tokens"],
+            "total_tokens": recording["prompt_tokens"] + recording["completion_tokens"],
+        }
+
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+
+        if not body.get("stream"):
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                stats["in_flight"] -= 1
+
+            return JSONResponse({
+                "id": completion_id(),
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": recording["content"]},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+        async def event_stream():
+            chunk_id = completion_id()
+            lines = recording["content"].split("\n")
+            first_delay = first_token_latency if first_token_latency is not None else delay * 0.2
+            line_delay = max(0.0, delay - first_delay) / max(1, len(lines))
+
+            def chunk(choices: list, chunk_usage: Optional[dict] = None) -> str:
+                data = {
+                    "id": chunk_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": choices,
+                }
+                if chunk_usage is not None:
+                    data["usage"] = chunk_usage
+                return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+            try:
+                await asyncio.sleep(first_delay)
+                for index, line in enumerate(lines):
+                    content = line if index == len(lines) - 1 else line + "\n"
+                    yield chunk([{"index": 0, "delta": {"content": content}, "finish_reason": None}])
+                    await asyncio.sleep(line_delay)
+
+                yield chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+                if include_usage:
+                    yield chunk([], usage)
+                yield "data: [DONE]\n\n"
+            finally:
+                stats["in_flight"] -= 1
+
+        return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+    return app
+
+
+def main() -> None:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serwer testowy zgodny z API OpenAI odtwarzający zapisane odpowiedzi OCR")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=2.0, help="średni czas odpowiedzi w sekundach")
+    parser.add_argument("--jitter", type=float, default=0.0, help="odchylenie czasu odpowiedzi w sekundach")
+    parser.add_argument("--first-token-latency", type=float, default=None,
+                        help="czas do pierwszego fragmentu odpowiedzi strumieniowej")
+    parser.add_argument("--recordings", default=DEFAULT_RECORDINGS, help="wzorzec plików z zapisanymi odpowiedziami")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rate-limit-rpm", type=int, default=0, help="limit zapytań na minutę (odpowiedź 429)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="odsetek odpowiedzi 500")
+    args = parser.parse_args()
+
+    app = create_app(
+        load_recordings(args.recordings),
+        latency=args.latency,
+        jitter=args.jitter,
+        first_token_latency=args.first_token_latency,
+        seed=args.seed,
+        rate_limit_rpm=args.rate_limit_rpm,
+        error_rate=args.error_rate,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
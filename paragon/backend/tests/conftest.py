@@ -0,0 +1,8 @@
+import os
+import tempfile
+
+# Ustawienia są wczytywane przy imporcie aplikacji - testy zapisują dane w katalogu tymczasowym,
+# obrazy obrabiają w puli wątków i nie wymagają zainstalowanego Tesseract OCR
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="paragon-tests-")
+os.environ.setdefault("IMAGE_PROCESS_POOL_ENABLED", "false")
+os.environ.setdefault("ORIENTATION_OSD_ENABLED", "false")
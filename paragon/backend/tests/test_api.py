@@ -0,0 +1,318 @@
+import glob
+import io
+import json
+import os
+import time
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from openai import AsyncOpenAI
+from PIL import Image
+
+from app.api.endpoints.receipt import etag_matches
+from app.core import metrics
+from app.core.config import settings
+from app.main import app
+from app.services.llm import get_llm_backends
+from benchmarks.stub_llm import create_app, load_recordings
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RECEIPT_DIR = glob.glob(os.path.join(BACKEND_DIR, "data-test", "0b0780a4*"))[0]
+
+
+def read_receipt_image(name: str = "1.jpg") -> bytes:
+    with open(os.path.join(RECEIPT_DIR, name), "rb") as f:
+        return f.read()
+
+
+@pytest.fixture(scope="module")
+def stub_llm():
+    """Serwer zgodny z API OpenAI odtwarzający zapisaną odpowiedź OCR paragonu"""
+    return create_app(load_recordings(os.path.join(RECEIPT_DIR, "*_ocr_*.txt")), latency=0)
+
+
+@pytest.fixture(scope="module")
+def client(stub_llm):
+    """Klient aplikacji z backendami LLM skierowanymi do serwera testowego"""
+    with TestClient(app) as client:
+        for backend in get_llm_backends():
+            backend.client = AsyncOpenAI(
+                api_key="test",
+                base_url="http://stub-llm/v1",
+                http_client=httpx.AsyncClient(transport=httpx.ASGITransport(app=stub_llm)),
+                max_retries=0,
+            )
+        yield client
+
+
+def llm_requests(stub_llm) -> int:
+    return TestClient(stub_llm).get("/stats").json()["requests"]
+
+
+def test_ocr_receipt_uses_cached_result(client, stub_llm):
+    """Ponowne przesłanie tego samego pliku zwraca zapisany wynik bez wywołania LLM"""
+    image = read_receipt_image()
+
+    first = client.post("/ocr-receipt", files={"file": ("1.jpg", image, "image/jpeg")})
+    assert first.status_code == 200
+    result = first.json()
+    assert result["cached"] is False
+    assert result["check_date"] == "20231027"
+    assert result["check_total"] == "14,65"
+    requests = llm_requests(stub_llm)
+
+    second = client.post("/ocr-receipt", files={"file": ("copy.jpg", image, "image/jpeg")})
+    assert second.status_code == 200
+    assert second.json()["cached"] is True
+    assert second.json()["file_hash"] == result["file_hash"]
+    assert llm_requests(stub_llm) == requests
+
+    refreshed = client.post(
+        "/ocr-receipt", files={"file": ("1.jpg", image, "image/jpeg")}, data={"refresh_cache": "true"}
+    )
+    assert refreshed.json()["cached"] is False
+    assert llm_requests(stub_llm) == requests + 1
+
+
+def test_background_ocr_job(client):
+    """Zadanie w tle zwraca 202 z identyfikatorem, a wynik jest dostępny przez /jobs/{job_id}"""
+    image = read_receipt_image()
+    response = client.post(
+        "/ocr-receipt", files={"file": ("1.jpg", image, "image/jpeg")}, data={"background": "true"}
+    )
+    assert response.status_code == 202
+    job = response.json()
+    assert job["status"] in ("queued", "running", "completed")
+
+    deadline = time.monotonic() + 10
+    while job["status"] in ("queued", "running") and time.monotonic() < deadline:
+        time.sleep(0.05)
+        job = client.get(f"/jobs/{job['job_id']}").json()
+
+    assert job["status"] == "completed"
+    assert job["result"]["check_total"] == "14,65"
+    assert client.get(f"/jobs/{'0' * 32}").status_code == 404
+
+
+def test_ocr_receipts_batch(client, stub_llm):
+    """Identyczne pliki są przetwarzane raz, a błąd jednego pliku nie przerywa przetwarzania pozostałych"""
+    path = glob.glob(os.path.join(BACKEND_DIR, "data-test", "2f07eac3*", "*_fixed.jpg"))[0]
+    with open(path, "rb") as f:
+        image = f.read()
+    requests = llm_requests(stub_llm)
+
+    response = client.post("/ocr-receipts", files=[
+        ("files", ("first.jpg", image, "image/jpeg")),
+        ("files", ("notes.txt", b"text", "text/plain")),
+        ("files", ("second.jpg", image, "image/jpeg")),
+        ("files", ("broken.jpg", b"not an image", "image/jpeg")),
+    ])
+
+    assert response.status_code == 200
+    batch = response.json()
+    assert (batch["processed"], batch["failed"]) == (2, 2)
+    items = batch["items"]
+    assert [item["filename"] for item in items] == ["first.jpg", "notes.txt", "second.jpg", "broken.jpg"]
+    assert [item["duplicate"] for item in items] == [False, False, True, False]
+    assert items[0]["result"] == items[2]["result"]
+    assert items[0]["result"]["check_total"] == "14,65"
+    assert items[1]["error"] and items[3]["error"]
+    assert items[1]["file_hash"] is None and items[3]["result"] is None
+    assert llm_requests(stub_llm) == requests + 1
+
+
+def test_original_upload_is_stored_as_is(client):
+    """Oryginał jest zapisywany bez ponownego kodowania, a bez zmiany orientacji nie powstaje obraz poprawiony"""
+    image = io.BytesIO()
+    Image.new("RGB", (600, 1000), (220, 220, 220)).save(image, "PNG")
+
+    file_hash = client.post(
+        "/ocr-receipt", files={"file": ("receipt.png", image.getvalue(), "image/png")}
+    ).json()["file_hash"]
+
+    file_paths = client.get(f"/receipts/{file_hash}").json()["file_paths"]
+    assert file_paths["original"].endswith(f"{file_hash}.png")
+    assert file_paths["fixed"] is None
+    for fixed in ("true", "false"):
+        response = client.get(f"/receipts/{file_hash}/image", params={"fixed": fixed})
+        assert response.content == image.getvalue()
+
+
+def test_receipt_lines(client):
+    """Ustrukturyzowany wynik OCR jest dostępny pod /receipts/{file_hash}/lines"""
+    file_hash = client.post(
+        "/ocr-receipt", files={"file": ("1.jpg", read_receipt_image(), "image/jpeg")}
+    ).json()["file_hash"]
+
+    result = client.get(f"/receipts/{file_hash}/lines").json()
+
+    assert result["file_hash"] == file_hash
+    assert (result["check"]["date"], result["check"]["total"]) == ("20231027", "14,65")
+    assert [line["line_number"] for line in result["lines"]] == list(range(1, len(result["lines"]) + 1))
+    assert client.get(f"/receipts/{'0' * 64}/lines").status_code == 404
+
+
+def read_events(response) -> list:
+    """Dzieli odpowiedź Server-Sent Events na pary (zdarzenie, dane)"""
+    events = []
+    for block in response.text.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+def test_stream_ocr_receipt(client):
+    """Strumień zwraca kolejne linie paragonu, a na końcu wynik - także z zapisanego wyniku"""
+    image = read_receipt_image(f"{os.path.basename(RECEIPT_DIR)}_fixed.jpg")
+
+    for cached in (False, True):
+        response = client.post("/ocr-receipt/stream", files={"file": ("fixed.jpg", image, "image/jpeg")})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+
+        events = read_events(response)
+        assert [event for event, _ in events] == ["line"] * (len(events) - 1) + ["result"]
+        assert [data["line_number"] for _, data in events[:-1]] == list(range(1, len(events)))
+        assert events[-1][1]["cached"] is cached
+        assert events[-1][1]["check_total"] == "14,65"
+
+
+def test_stream_ocr_receipt_rejects_invalid_file(client):
+    """Błędy wykryte przed rozpoczęciem strumienia są zwykłą odpowiedzią HTTP"""
+    response = client.post("/ocr-receipt/stream", files={"file": ("receipt.txt", b"text", "text/plain")})
+    assert response.status_code == 400
+
+
+def test_metrics_endpoint(client):
+    """Metryki zawierają czasy żądań HTTP (po szablonie ścieżki), etapów OCR i zużycie tokenów"""
+    client.post("/ocr-receipt", files={"file": ("1.jpg", read_receipt_image(), "image/jpeg")})
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    body = response.text
+    assert 'paragon_http_request_duration_seconds_count{method="POST",route="/ocr-receipt",status="200"}' in body
+    assert 'paragon_ocr_stage_duration_seconds_bucket{stage="total",le="+Inf"}' in body
+    assert 'paragon_ocr_cache_hits_total{prompt_version="1_0_3",model="gpt-4o"}' in body
+    assert 'direction="in"} ' in body
+
+
+def test_metrics_disabled_records_nothing(client, monkeypatch):
+    """Przy wyłączonych metrykach middleware i pomocnicze funkcje OCR nie zapisują żadnych pomiarów"""
+    monkeypatch.setattr(settings.app, "METRICS_ENABLED", False)
+    before = metrics.registry.render()
+
+    response = client.post("/ocr-receipt", files={"file": ("1.jpg", read_receipt_image(), "image/jpeg")})
+    assert response.status_code == 200 and "X-Process-Time" in response.headers
+    client.post("/ocr-receipt", files={"file": ("1.jpg", read_receipt_image(), "image/jpeg")})
+
+    assert metrics.registry.render() == before
+    assert client.get("/metrics").status_code == 404
+
+
+@pytest.mark.parametrize("header, matches", [
+    (None, False),
+    ("", False),
+    ("*", True),
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"xyz", "abc"', True),
+    ('"abcd"', False),
+    ("abc", False),
+])
+def test_etag_matches(header, matches):
+    assert etag_matches(header, '"abc"') is matches
+
+
+def test_receipt_image_conditional_get(client):
+    """Oryginał ma ETag z hasza pliku i jest niezmienny, pozostałe obrazy wymagają walidacji ETagiem"""
+    file_hash = client.post(
+        "/ocr-receipt", files={"file": ("1.jpg", read_receipt_image(), "image/jpeg")}
+    ).json()["file_hash"]
+
+    original = client.get(f"/receipts/{file_hash}/image", params={"fixed": "false"})
+    assert original.status_code == 200
+    assert original.headers["etag"] == f'"{file_hash}"'
+    assert "immutable" in original.headers["cache-control"]
+    assert original.content == read_receipt_image()
+
+    for variant in ("full", "preview", "thumbnail"):
+        response = client.get(f"/receipts/{file_hash}/image", params={"variant": variant})
+        assert response.status_code == 200
+        assert response.headers["cache-control"] == "public, no-cache"
+        etag = response.headers["etag"]
+
+        revalidated = client.get(
+            f"/receipts/{file_hash}/image", params={"variant": variant}, headers={"If-None-Match": etag}
+        )
+        assert revalidated.status_code == 304
+        assert revalidated.headers["etag"] == etag
+        assert not revalidated.content
+
+    thumbnail = client.get(f"/receipts/{file_hash}/image", params={"variant": "thumbnail"})
+    assert max(Image.open(io.BytesIO(thumbnail.content)).size) <= settings.image.THUMBNAIL_MAX_EDGE
+
+    assert client.get(f"/receipts/{'0' * 64}/image").status_code == 404
+
+
+def test_ocr_pdf_receipt(client, stub_llm):
+    """Strony dokumentu PDF są przetwarzane osobno i łączone w jeden paragon"""
+    pytest.importorskip("pypdfium2")
+    page = Image.open(io.BytesIO(read_receipt_image())).convert("RGB")
+    page.thumbnail((1000, 1000))
+    document = io.BytesIO()
+    page.save(document, "PDF", save_all=True, append_images=[page.rotate(180)], resolution=100)
+    requests = llm_requests(stub_llm)
+
+    response = client.post("/ocr-receipt", files={"file": ("receipt.pdf", document.getvalue(), "application/pdf")})
+
+    assert response.status_code == 200
+    assert llm_requests(stub_llm) == requests + 2
+    file_hash = response.json()["file_hash"]
+    lines = client.get(f"/receipts/{file_hash}/lines").json()["lines"]
+    assert [line["line_number"] for line in lines] == list(range(1, 51))
+    metadata = client.get(f"/receipts/{file_hash}").json()
+    assert metadata["processing"]["pdf"] == {
+        "pages": 2, "text_pages": 0, "image_pages": 2, "dpi": settings.image.PDF_RENDER_DPI,
+    }
+
+    thumbnail = client.get(f"/receipts/{file_hash}/image", params={"variant": "thumbnail"})
+    assert thumbnail.headers["content-type"] == "image/jpeg"
+
+    broken = client.post("/ocr-receipt", files={"file": ("broken.pdf", b"%PDF-1.4 broken", "application/pdf")})
+    assert broken.status_code == 400
+
+
+def test_near_duplicate_photo(client, stub_llm, monkeypatch):
+    """Ponowne zdjęcie paragonu jest oznaczane, a w trybie reuse - po potwierdzeniu - dostaje zapisany wynik"""
+    path = glob.glob(os.path.join(BACKEND_DIR, "data-test", "8cd36e5f*", "8cd36e5f*_fixed.jpg"))[0]
+    photo = Image.open(path)
+    copies = []
+    for quality in (70, 60):
+        copy = io.BytesIO()
+        photo.resize((photo.width * 3 // 4, photo.height * 3 // 4)).rotate(180).save(copy, "JPEG", quality=quality)
+        copies.append(copy.getvalue())
+
+    with open(path, "rb") as f:
+        original = client.post("/ocr-receipt", files={"file": ("photo.jpg", f.read(), "image/jpeg")}).json()
+    assert original["near_duplicate"] is None
+    requests = llm_requests(stub_llm)
+
+    flagged = client.post("/ocr-receipt", files={"file": ("copy.jpg", copies[0], "image/jpeg")}).json()
+    assert flagged["cached"] is False
+    assert flagged["near_duplicate"]["file_hash"] == original["file_hash"]
+    assert llm_requests(stub_llm) == requests + 1
+
+    monkeypatch.setattr(settings.storage, "DUPLICATE_MODE", "reuse")
+    reused = client.post("/ocr-receipt", files={"file": ("copy.jpg", copies[1], "image/jpeg")}).json()
+    assert reused["cached"] is True
+    assert reused["near_duplicate"]["similarity"] >= settings.storage.DUPLICATE_MIN_SIMILARITY
+    assert llm_requests(stub_llm) == requests + 1
+
+    # Bez zgodnego układu linii tekstu wynik nie jest używany ponownie
+    monkeypatch.setattr(settings.storage, "DUPLICATE_MIN_SIMILARITY", 1.01)
+    unconfirmed = client.post("/ocr-receipt", files={"file": ("copy.jpg", copies[1] + b"\0", "image/jpeg")}).json()
+    assert unconfirmed["cached"] is False
+    assert unconfirmed["near_duplicate"]["file_hash"] in (original["file_hash"], flagged["file_hash"])
+    assert llm_requests(stub_llm) == requests + 2
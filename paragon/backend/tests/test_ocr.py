@@ -0,0 +1,1023 @@
+import asyncio
+import base64
+import glob
+import hashlib
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import httpx
+import numpy as np
+import pytest
+from fastapi import HTTPException, UploadFile
+from openai import AsyncOpenAI, RateLimitError
+from PIL import Image, ImageDraw
+
+from app.core.config import settings
+from app.core.metrics import Counter, Histogram
+from app.services import analytics, llm, storage
+from app.services.duplicates import BKTree, hamming_distance
+from app.services.index import ReceiptIndex, decode_cursor, encode_cursor
+from app.services.jobs import JOB_COMPLETED, JOB_FAILED, JOB_QUEUED, JOB_RUNNING, JobQueue
+from app.services.llm import LLMBackend, LLMScheduler, TokenBucket
+from app.services.ocr import check_ocr_response, request_routed_ocr, select_backends
+from app.services.prompts import PromptRegistry
+from app.utils import image as image_utils
+from app.utils.image import (
+    crop_receipt,
+    downscale_image,
+    encode_for_llm,
+    fix_orientation,
+    init_image_executor,
+    prepare_receipt_image,
+    profile_similarity,
+    receipt_fingerprint,
+    run_image_task,
+    shutdown_image_executor,
+)
+from app.utils.parser import (
+    CHECK_DEFAULTS,
+    extract_receipt_facts,
+    merge_receipt_pages,
+    normalize_receipt_date,
+    parse_receipt_text,
+    validate_receipt_text,
+)
+from app.utils.upload import ingest_upload
+from benchmarks.archive import COMPANIES, generate_archive
+from benchmarks.stub_llm import create_app
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OCR_RECORDINGS = sorted(glob.glob(os.path.join(BACKEND_DIR, "data-test", "*", "*_ocr_*.txt")))
+
+
+def read_receipt_photo(prefix: str = "0b0780a4") -> bytes:
+    path = glob.glob(os.path.join(BACKEND_DIR, "data-test", f"{prefix}*", f"{prefix}*_fixed.jpg"))[0]
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def read_text(path: str) -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def test_llm_client_is_shared(monkeypatch):
+    """Wywołania korzystają z jednego klienta OpenAI i harmonogramu, a ponowienia obsługuje harmonogram"""
+    monkeypatch.setattr(settings.openai, "MAX_CONCURRENCY", 2)
+
+    async def scenario():
+        client = llm.init_llm_client()
+        assert llm.get_llm_client() is client
+        assert client.max_retries == 0
+        assert llm.get_llm_scheduler().max_concurrency == 2
+
+        await llm.close_llm_client()
+        assert llm.get_llm_client() is not client
+        await llm.close_llm_client()
+
+    asyncio.run(scenario())
+
+
+def test_run_image_task_in_process_pool(monkeypatch):
+    """Obróbka obrazu w puli procesów daje ten sam wynik co w puli wątków pętli zdarzeń"""
+    image_data = read_receipt_photo()
+    monkeypatch.setattr(settings.image, "PROCESS_POOL_WORKERS", 1)
+
+    monkeypatch.setattr(settings.image, "PROCESS_POOL_ENABLED", True)
+    try:
+        assert isinstance(init_image_executor(), ProcessPoolExecutor)
+        in_process = asyncio.run(run_image_task(prepare_receipt_image, image_data))
+    finally:
+        shutdown_image_executor()
+
+    monkeypatch.setattr(settings.image, "PROCESS_POOL_ENABLED", False)
+    assert init_image_executor() is None
+    in_thread = asyncio.run(run_image_task(prepare_receipt_image, image_data))
+
+    # Czasy etapów obróbki różnią się między wywołaniami
+    in_process.pop("timings")
+    in_thread.pop("timings")
+    assert in_process == in_thread
+    assert in_thread["llm_bytes"].startswith(b"\xff\xd8")
+
+
+def write_metadata(data_dir, file_hash: str, created_at: str) -> str:
+    directory = data_dir / "20231027" / file_hash
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{file_hash}_metadata.json"
+    path.write_text(json.dumps({"file_hash": file_hash, "receipt_date": "20231027", "created_at": created_at}))
+    return str(path)
+
+
+def test_reconcile_receipt_index(tmp_path, monkeypatch):
+    """Uzgadnianie wczytuje nowe i zmienione pliki metadanych oraz usuwa z indeksu paragony bez plików"""
+    data_dir = tmp_path / "data"
+    index = ReceiptIndex(str(data_dir / "receipts.sqlite3"))
+    monkeypatch.setattr(settings.storage, "DATA_DIR", str(data_dir))
+    monkeypatch.setattr(storage, "receipt_index", index)
+    first, second, third = (f"{number:064x}" for number in range(3))
+    for number, file_hash in enumerate((first, second, third)):
+        write_metadata(data_dir, file_hash, f"2023-10-2{number}T12:00:00")
+
+    assert storage.reconcile_receipt_index(full=True) == {"updated": 3, "deleted": 0, "skipped": 0}
+    assert [metadata["file_hash"] for metadata in index.history(limit=2)[0]] == [third, second]
+    assert [metadata["file_hash"] for metadata in index.history(limit=2, offset=2)[0]] == [first]
+
+    # Niezmienione pliki są pomijane bez odczytu
+    assert storage.reconcile_receipt_index() == {"updated": 0, "deleted": 0, "skipped": 0}
+
+    path = write_metadata(data_dir, first, "2023-10-29T12:00:00")
+    os.utime(path, (0, 0))
+    shutil.rmtree(data_dir / "20231027" / second)
+    assert storage.reconcile_receipt_index() == {"updated": 1, "deleted": 1, "skipped": 0}
+    assert index.get(second) is None
+    assert index.get(first)["created_at"] == "2023-10-29T12:00:00"
+    assert index.count() == 2
+    index.close()
+
+
+def test_atomic_write_and_copy(tmp_path, monkeypatch):
+    """Zapis atomowy podmienia plik w całości, a przerwany zapis zostawia poprzednią treść bez plików tymczasowych"""
+    path = str(tmp_path / "receipt.json")
+    storage.atomic_write(path, "stara treść")
+    storage.atomic_write(path, b"nowa")
+    with open(path, "rb") as f:
+        assert f.read() == b"nowa"
+
+    copy_path = str(tmp_path / "copy.json")
+    storage.atomic_copy(path, copy_path)
+    with open(copy_path, "rb") as f:
+        assert f.read() == b"nowa"
+
+    def failing_fsync(fd):
+        raise OSError("dysk pełny")
+
+    monkeypatch.setattr(storage.os, "fsync", failing_fsync)
+    with pytest.raises(OSError):
+        storage.atomic_write(path, b"przerwany zapis")
+    with pytest.raises(OSError):
+        storage.atomic_copy(path, copy_path)
+
+    with open(path, "rb") as f:
+        assert f.read() == b"nowa"
+    assert sorted(os.listdir(tmp_path)) == ["copy.json", "receipt.json"]
+
+
+def test_benchmark_archive_is_indexed(tmp_path, monkeypatch):
+    """Syntetyczne archiwum ma układ zapisywany przez aplikację i jest tworzone tylko raz"""
+    data_dir = tmp_path / "archive"
+    index = ReceiptIndex(str(data_dir / "receipts.sqlite3"))
+    monkeypatch.setattr(settings.storage, "DATA_DIR", str(data_dir))
+    monkeypatch.setattr(storage, "receipt_index", index)
+
+    assert generate_archive(str(data_dir), 5) is True
+    assert generate_archive(str(data_dir), 5) is False
+    with pytest.raises(ValueError):
+        generate_archive(str(data_dir), 6)
+
+    assert storage.reconcile_receipt_index(full=True)["updated"] == 5
+    assert index.count() == 5
+    assert all(receipt["check_company"] in COMPANIES for receipt in index.history(limit=5)[0])
+    index.close()
+
+
+def rate_limit_error(retry_after: str = "0") -> RateLimitError:
+    request = httpx.Request("POST", "http://llm/v1/chat/completions")
+    response = httpx.Response(429, headers={"retry-after": retry_after}, request=request)
+    return RateLimitError("Rate limit reached", response=response, body=None)
+
+
+def test_job_queue_claim_retry_and_complete(tmp_path):
+    """Zadanie pobrane z kolejki ma dzierżawę, wraca do kolejki po opóźnieniu, a po zakończeniu kopia obrazu jest usuwana"""
+    queue = JobQueue(str(tmp_path / "jobs"), lease_seconds=30)
+    job = queue.enqueue(b"image", "a" * 64, filename="1.jpg", options={"use_osd": False})
+    assert job["status"] == JOB_QUEUED and os.path.exists(job["payload_path"])
+
+    claimed = queue.claim()
+    assert (claimed["id"], claimed["status"], claimed["attempts"]) == (job["id"], JOB_RUNNING, 1)
+    assert claimed["lease_expires_at"] > time.time() + 20
+    assert claimed["options"] == {"use_osd": False}
+    assert queue.claim() is None
+
+    queue.retry(job["id"], "503", delay=60)
+    assert queue.get(job["id"])["status"] == JOB_QUEUED
+    assert queue.claim() is None
+
+    queue.retry(job["id"], "503", delay=0)
+    assert queue.claim()["attempts"] == 2
+
+    queue.complete(job["id"], {"file_hash": "a" * 64})
+    completed = queue.get(job["id"])
+    assert completed["status"] == JOB_COMPLETED and completed["result"] == {"file_hash": "a" * 64}
+    assert not os.path.exists(job["payload_path"])
+    queue.close()
+
+
+def test_job_queue_enqueue_writes_payload_atomically(tmp_path):
+    """Obraz zadania (z bajtów lub skopiowany z pliku) jest zapisywany bez pozostawiania plików tymczasowych"""
+    queue = JobQueue(str(tmp_path / "jobs"), lease_seconds=30)
+    source = tmp_path / "receipt.jpg"
+    source.write_bytes(b"from-file")
+
+    from_bytes = queue.enqueue(b"from-bytes", "a" * 64)
+    from_file = queue.enqueue(str(source), "b" * 64)
+
+    with open(from_bytes["payload_path"], "rb") as f:
+        assert f.read() == b"from-bytes"
+    with open(from_file["payload_path"], "rb") as f:
+        assert f.read() == b"from-file"
+    assert not [name for name in os.listdir(queue.directory) if name.endswith(".tmp")]
+    queue.close()
+
+
+def test_job_queue_recover_expired_leases(tmp_path):
+    """Odzyskiwane są tylko zadania z wygasłą dzierżawą, a po limicie prób zadanie kończy się błędem"""
+    queue = JobQueue(str(tmp_path / "jobs"), lease_seconds=30)
+    running, expired, exhausted = (queue.enqueue(b"image", f"{number:064x}") for number in range(3))
+    for _ in range(3):
+        queue.claim()
+    queue.lease_seconds = -1
+    queue.renew(expired["id"])
+    queue.renew(exhausted["id"])
+    connection = queue._connect()
+    connection.execute("UPDATE jobs SET attempts = 3 WHERE id = ?", (exhausted["id"],))
+    connection.commit()
+
+    assert queue.recover(max_attempts=3) == [expired["id"]]
+
+    assert queue.get(running["id"])["status"] == JOB_RUNNING
+    assert queue.get(expired["id"])["status"] == JOB_QUEUED
+    failed = queue.get(exhausted["id"])
+    assert failed["status"] == JOB_FAILED and failed["error"]
+    assert not os.path.exists(exhausted["payload_path"])
+    queue.close()
+
+
+def test_job_queue_claim_reclaims_expired_lease(tmp_path):
+    """Zadanie, którego dzierżawa wygasła w trakcie działania aplikacji, jest pobierane ponownie aż do limitu prób"""
+    queue = JobQueue(str(tmp_path / "jobs"), lease_seconds=0.05, max_attempts=2)
+    job = queue.enqueue(b"image", "b" * 64)
+
+    assert queue.claim()["attempts"] == 1
+    assert queue.claim() is None
+
+    time.sleep(0.1)
+    reclaimed = queue.claim()
+    assert (reclaimed["id"], reclaimed["status"], reclaimed["attempts"]) == (job["id"], JOB_RUNNING, 2)
+
+    time.sleep(0.1)
+    assert queue.claim() is None
+    failed = queue.get(job["id"])
+    assert failed["status"] == JOB_FAILED and failed["error"]
+    assert not os.path.exists(job["payload_path"])
+    queue.close()
+
+
+def test_downscale_image():
+    """Obraz jest zmniejszany do ostrzejszego z limitów z zachowaniem proporcji, a mniejszy - pozostawiany"""
+    image = Image.new("RGB", (1000, 4000))
+
+    assert downscale_image(image, max_long_edge=2000).size == (500, 2000)
+    assert downscale_image(image, max_long_edge=2000, max_pixels=250_000).size == (250, 1000)
+    assert downscale_image(image, max_long_edge=5000) is image
+    assert downscale_image(image) is image
+
+
+def test_encode_for_llm_budget(monkeypatch):
+    """Obraz dla LLM mieści się w limicie, jest w skali szarości i w najmniejszym z formatów"""
+    image = Image.open(io.BytesIO(read_receipt_photo()))
+    monkeypatch.setattr(settings.image, "LLM_MAX_LONG_EDGE", 512)
+    monkeypatch.setattr(settings.image, "LLM_GRAYSCALE", True)
+    monkeypatch.setattr(settings.image, "LLM_FORMATS", "PNG, jpeg")
+
+    data, format = encode_for_llm(image)
+
+    encoded = Image.open(io.BytesIO(data))
+    assert format == "JPEG" == encoded.format
+    assert max(encoded.size) == 512
+    assert encoded.mode == "L"
+
+    monkeypatch.setattr(settings.image, "LLM_FORMATS", "PNG")
+    png, format = encode_for_llm(image)
+    assert format == "PNG" and len(png) > len(data)
+
+
+def test_fix_orientation_tiers(monkeypatch):
+    """Orientacja jest poprawiana według znacznika EXIF, obraz pionowy jest uznawany za poprawny, a OSD dostaje zmniejszoną kopię"""
+    osd_sizes = []
+
+    def detect_rotation(image):
+        osd_sizes.append((image.mode, image.size))
+        return 90
+
+    monkeypatch.setattr(image_utils, "detect_rotation", detect_rotation)
+    monkeypatch.setattr(settings.image, "ORIENTATION_OSD_ENABLED", True)
+    monkeypatch.setattr(settings.image, "ORIENTATION_OSD_MAX_EDGE", 400)
+
+    photo = Image.new("RGB", (1200, 800))
+    tagged = io.BytesIO()
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    photo.save(tagged, "JPEG", exif=exif)
+    image, orientation = fix_orientation(Image.open(tagged))
+    assert image.size == (800, 1200)
+    assert (orientation["tier"], orientation["exif_orientation"]) == ("exif", 6)
+
+    image, orientation = fix_orientation(Image.new("RGB", (800, 1200)))
+    assert orientation["tier"] == "aspect" and image.size == (800, 1200)
+    osd_sizes.clear()
+
+    image, orientation = fix_orientation(photo)
+    assert (orientation["tier"], orientation["angle"]) == ("osd", 90)
+    assert image.size == (800, 1200)
+    assert osd_sizes == [("L", (400, 267))]
+
+    image, orientation = fix_orientation(photo, use_osd=False)
+    assert orientation["tier"] == "none" and image is photo
+    assert len(osd_sizes) == 1
+
+
+def test_fix_orientation_turns_upside_down_portrait_receipt(monkeypatch):
+    """Odwrócony pionowy paragon jest obracany o 180° przez OSD, a obrót o 90° jest dla niego odrzucany"""
+    receipt = Image.new("L", (300, 900), 255)
+    draw = ImageDraw.Draw(receipt)
+    for top in range(40, 300, 30):
+        draw.rectangle((20, top, 280, top + 12), fill=0)
+    upside_down = receipt.rotate(180)
+    detected = []
+
+    def detect_rotation(image):
+        # Zastępstwo Tesseract OSD: tekst w dolnej części obrazu oznacza paragon do góry nogami
+        pixels = np.asarray(image)
+        detected.append(image.size)
+        return 180 if pixels[image.height // 2:].mean() < pixels[:image.height // 2].mean() else 0
+
+    monkeypatch.setattr(image_utils, "detect_rotation", detect_rotation)
+    monkeypatch.setattr(settings.image, "ORIENTATION_OSD_ENABLED", True)
+
+    image, orientation = fix_orientation(upside_down)
+    assert (orientation["tier"], orientation["angle"]) == ("osd", 180)
+    assert np.array_equal(np.asarray(image), np.asarray(receipt))
+
+    image, orientation = fix_orientation(receipt)
+    assert (orientation["tier"], orientation["angle"]) == ("aspect", 0) and image is receipt
+    assert len(detected) == 2
+
+    monkeypatch.setattr(image_utils, "detect_rotation", lambda image: 90)
+    image, orientation = fix_orientation(receipt)
+    assert (orientation["tier"], orientation["angle"]) == ("aspect", 0) and image is receipt
+
+
+def test_ingest_upload_spools_large_files(tmp_path, monkeypatch):
+    """Plik jest haszowany porcjami - mały zostaje w pamięci, duży trafia do pliku tymczasowego usuwanego po zamknięciu"""
+    monkeypatch.setattr(settings.app, "UPLOAD_CHUNK_SIZE", 1000)
+    monkeypatch.setattr(settings.app, "UPLOAD_SPOOL_THRESHOLD", 2500)
+    monkeypatch.setattr(settings.app, "UPLOAD_TMP_DIR", str(tmp_path))
+    data = os.urandom(6000)
+
+    def ingest(content: bytes):
+        return asyncio.run(ingest_upload(UploadFile(io.BytesIO(content), filename="1.jpg")))
+
+    with ingest(data[:2000]) as upload:
+        assert upload.source == data[:2000]
+        assert upload.file_hash == hashlib.sha256(data[:2000]).hexdigest()
+
+    with ingest(data) as upload:
+        assert upload.source == upload.path and os.path.dirname(upload.path) == str(tmp_path)
+        assert upload.read_bytes() == data
+        assert (upload.size, upload.file_hash) == (6000, hashlib.sha256(data).hexdigest())
+    assert os.listdir(tmp_path) == []
+
+    monkeypatch.setattr(settings.app, "UPLOAD_MAX_BYTES", 5000)
+    with pytest.raises(HTTPException) as error:
+        ingest(data)
+    assert error.value.status_code == 413
+    assert os.listdir(tmp_path) == []
+
+
+def encode_test_image(image: Image.Image, format: str = "JPEG", **options) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format, **options)
+    return buffer.getvalue()
+
+
+def test_prepare_receipt_image_encodes_at_most_once():
+    """JPEG w limitach trafia do LLM bez ponownego kodowania, a obraz poprawiony powstaje tylko po zmianie orientacji"""
+    receipt = Image.new("RGB", (600, 1000), (220, 220, 220))
+
+    jpeg = encode_test_image(receipt)
+    prepared = prepare_receipt_image(jpeg, use_osd=False)
+    assert prepared["llm_bytes"] is jpeg
+    assert prepared["fixed_bytes"] is None
+    assert prepared["original_extension"] == "jpg"
+    assert prepared["llm_image"]["reencoded"] is False
+
+    prepared = prepare_receipt_image(encode_test_image(receipt, "PNG"), use_osd=False)
+    assert prepared["original_extension"] == "png"
+    assert (prepared["llm_image"]["format"], prepared["image_mime"]) == ("JPEG", "image/jpeg")
+    assert prepared["llm_image"]["reencoded"] is True
+    assert prepared["fixed_bytes"] is None
+
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    prepared = prepare_receipt_image(encode_test_image(receipt.rotate(90, expand=True), exif=exif), use_osd=False)
+    assert prepared["fixed_bytes"] is prepared["llm_bytes"]
+    assert Image.open(io.BytesIO(prepared["fixed_bytes"])).size == (600, 1000)
+
+
+def test_prepare_receipt_image_skips_fingerprint_when_duplicates_off(monkeypatch):
+    """Skróty percepcyjne są obliczane tylko wtedy, gdy wykrywanie podobnych paragonów jest włączone"""
+    jpeg = encode_test_image(Image.new("RGB", (600, 1000), (220, 220, 220)))
+
+    prepared = prepare_receipt_image(jpeg, use_osd=False)
+    assert prepared["image_hash"] and "image_hash" in prepared["timings"]
+
+    monkeypatch.setattr(settings.storage, "DUPLICATE_MODE", "off")
+    prepared = prepare_receipt_image(jpeg, use_osd=False)
+    assert not {"image_hash", "image_hash_rotated", "row_profile"} & prepared.keys()
+    assert "image_hash" not in prepared["timings"]
+
+
+@pytest.mark.parametrize("path", OCR_RECORDINGS, ids=os.path.basename)
+def test_parse_receipt_text_recordings(path):
+    """Zapisane wyniki OCR dają kolejne linie, dane kontrolne i parametry zapisu"""
+    lines, check, parameters = parse_receipt_text(read_text(path))
+
+    assert [line.line_number for line in lines] == list(range(1, len(lines) + 1))
+    assert all(line.category and line.content for line in lines)
+    assert check.date != CHECK_DEFAULTS["DATE"] and len(check.date) == 8 and check.date.isdigit()
+    assert check.company != CHECK_DEFAULTS["COMPANY"]
+    assert check.total != CHECK_DEFAULTS["TOTAL"]
+    assert parameters["HASH"] == os.path.basename(os.path.dirname(path))
+    assert path.endswith(f"_ocr_{parameters['OCR PROMPT VERSION']}.txt")
+
+
+def test_normalize_receipt_date():
+    """Daty z parametrów zapytania w obu formatach są zamieniane na YYYYMMDD, a nieprawidłowe dają błąd 400"""
+    assert normalize_receipt_date("2024-03-01", "date_from") == "20240301"
+    assert normalize_receipt_date("20240301", "date_from") == "20240301"
+    assert normalize_receipt_date(None, "date_from") is None
+    with pytest.raises(HTTPException) as error:
+        normalize_receipt_date("01.03.2024", "date_to")
+    assert error.value.status_code == 400 and "date_to" in error.value.detail
+
+
+def test_parse_receipt_text_edge_cases():
+    """Treść z "|" jest łączona, powtórzony parametr nie nadpisuje pierwszego, brak tabeli kontrolnej daje wartości domyślne"""
+    text = "\n".join([
+        "| Line | Category | Content |",
+        "|---|---|---|",
+        "| 1 | P | MLEKO | 2% 3,49 C |",
+        "tekst poza tabelą",
+        "| 2 | S | SUMA PLN 3,49 |",
+        "",
+        "| Parameter | Value |",
+        "|---|---|",
+        "| COMPANY | Sklep |",
+        "| COMPANY | Inny |",
+    ])
+
+    lines, check, parameters = parse_receipt_text(text)
+
+    assert [(line.line_number, line.category, line.content) for line in lines] == [
+        (1, "P", "MLEKO | 2% 3,49 C"),
+        (2, "S", "SUMA PLN 3,49"),
+    ]
+    assert check.company == "Sklep"
+    assert check.date == CHECK_DEFAULTS["DATE"]
+    assert check.total == CHECK_DEFAULTS["TOTAL"]
+    assert parameters["COMPANY"] == "Sklep"
+
+
+def test_prompt_registry_hot_reload(tmp_path):
+    """Zmienione, nowe i usunięte pliki promptów są widoczne bez restartu, a zmiana treści zmienia odcisk"""
+    (tmp_path / "ocr_v1.txt").write_text("Prompt 1", encoding="utf-8")
+    registry = PromptRegistry(str(tmp_path), reload_interval=0.01)
+
+    first = registry.get("1")
+    assert (first["text"], registry.versions()) == ("Prompt 1", ["1"])
+
+    (tmp_path / "ocr_v1.txt").write_text("Prompt 1 - poprawiony", encoding="utf-8")
+    os.utime(tmp_path / "ocr_v1.txt", (first["mtime"] + 10, first["mtime"] + 10))
+    time.sleep(0.02)
+    changed = registry.get("1")
+    assert changed["text"] == "Prompt 1 - poprawiony"
+    assert changed["fingerprint"] != first["fingerprint"]
+
+    # Nowy plik jest wczytywany od razu, bez czekania na kolejne sprawdzenie
+    registry.reload_interval = 3600
+    (tmp_path / "ocr_v2.txt").write_text("Prompt 2", encoding="utf-8")
+    assert registry.get("2")["text"] == "Prompt 2"
+
+    (tmp_path / "ocr_v1.txt").unlink()
+    assert registry.reload() == {"loaded": [], "removed": ["1"]}
+    assert [prompt["version"] for prompt in registry.describe()] == ["2"]
+    with pytest.raises(FileNotFoundError):
+        registry.get("1")
+
+
+def test_metrics_render_prometheus_format():
+    """Histogram ma skumulowane przedziały, sumę i liczbę obserwacji, a etykiety są escapowane"""
+    histogram = Histogram("test_seconds", "Czas testu", ["stage"], buckets=(0.1, 1.0))
+    histogram.observe(0.05, stage="a")
+    histogram.observe(0.5, stage="a")
+    histogram.observe(5.0, stage="a")
+
+    assert histogram.samples() == [
+        'test_seconds_bucket{stage="a",le="0.1"} 1',
+        'test_seconds_bucket{stage="a",le="1"} 2',
+        'test_seconds_bucket{stage="a",le="+Inf"} 3',
+        'test_seconds_sum{stage="a"} 5.55',
+        'test_seconds_count{stage="a"} 3',
+    ]
+
+    counter = Counter("test_total", "Licznik testu", ["error"])
+    counter.inc(error='bad "value"')
+    counter.inc(2, error='bad "value"')
+    assert counter.render().splitlines()[-1] == 'test_total{error="bad \\"value\\""} 3'
+
+
+def test_token_bucket_delay(monkeypatch):
+    """Opóźnienie wynika z brakującego budżetu i tempa odnawiania, a żądanie ponad budżet czeka na pełne odnowienie"""
+    now = [1000.0]
+    monkeypatch.setattr(llm.time, "monotonic", lambda: now[0])
+    bucket = TokenBucket(per_minute=60)
+
+    assert bucket.delay(60) == 0.0
+    bucket.consume(60)
+    assert bucket.delay(1) == pytest.approx(1.0)
+    assert bucket.delay(500) == pytest.approx(60.0)
+
+    now[0] += 30
+    assert bucket.delay(30) == 0.0
+    assert bucket.delay(40) == pytest.approx(10.0)
+
+    # Zużycie większe od szacowanego zadłuża budżet, a zwrot nie przekracza pojemności
+    bucket.consume(50)
+    assert bucket.level == pytest.approx(-20.0)
+    bucket.refund(1000)
+    assert bucket.level == 60.0
+
+    assert TokenBucket(per_minute=0).delay(10 ** 6) == 0.0
+
+
+def test_scheduler_aimd_limit():
+    """Odpowiedź 429 zmniejsza limit o połowę (raz na okno), a udane wywołanie go zwiększa i wpuszcza czekających"""
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrency=4, base_delay=0.01)
+        scheduler._on_throttle(None)
+        scheduler._on_throttle(None)
+        assert scheduler.limit == 2.0
+
+        scheduler.limit = 1.0
+        async with scheduler.slot(estimated_tokens=10):
+            waiter = asyncio.create_task(scheduler._acquire_slot())
+            await asyncio.sleep(0.01)
+            assert not waiter.done()
+
+            await scheduler._on_success()
+            assert scheduler.limit == 2.0
+            await asyncio.wait_for(waiter, timeout=1)
+            assert scheduler.in_flight == 2
+
+        await scheduler._release_slot()
+        assert scheduler.in_flight == 0
+        for _ in range(20):
+            await scheduler._on_success()
+        assert scheduler.limit == 4.0
+
+    asyncio.run(scenario())
+
+
+def test_scheduler_retries_rate_limited_calls():
+    """Wywołanie jest ponawiane po 429, a po wyczerpaniu prób zgłaszany jest błąd 503 z Retry-After"""
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrency=2, max_retries=2, base_delay=0.01, max_delay=0.01)
+        attempts = []
+
+        async def flaky():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise rate_limit_error()
+            # Seria odpowiedzi 429 z tej samej chwili zmniejsza limit tylko raz
+            assert scheduler.limit == 1.0
+            return "ok"
+
+        async with scheduler.slot(estimated_tokens=10) as call:
+            assert await call.send(flaky) == "ok"
+        assert len(attempts) == 3
+
+        async def throttled():
+            raise rate_limit_error("2")
+
+        scheduler.max_retries = 0
+        with pytest.raises(HTTPException) as error:
+            async with scheduler.slot(estimated_tokens=10) as call:
+                await call.send(throttled)
+        assert error.value.status_code == 503
+        assert error.value.headers["Retry-After"] == "2"
+
+    asyncio.run(scenario())
+
+
+def test_cursor_round_trip():
+    """Kursor odtwarza klucz ostatniego paragonu tylko dla tego samego sortowania"""
+    key = ("20231027", "0b0780a4")
+    cursor = encode_cursor("receipt_date", True, key)
+
+    assert "=" not in cursor
+    assert decode_cursor(cursor, "receipt_date", True) == key
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, "receipt_date", False)
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, "created_at", True)
+
+
+@pytest.mark.parametrize("cursor", [
+    "",
+    "not a cursor",
+    encode_cursor("receipt_date", True, ("20231027", "0b0780a4"))[:-3],
+    base64.urlsafe_b64encode(b'{"sort":"receipt_date","desc":true,"key":[1,2]}').decode(),
+    base64.urlsafe_b64encode(b'{"sort":"receipt_date","desc":true,"key":["x"]}').decode(),
+])
+def test_decode_cursor_rejects_tampered_cursor(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, "receipt_date", True)
+
+
+def test_history_cursor_pagination(tmp_path):
+    """Strony kolejnych kursorów obejmują każdy paragon dokładnie raz - także przy równych datach"""
+    index = ReceiptIndex(str(tmp_path / "receipts.sqlite3"))
+    for number in range(7):
+        index.upsert({
+            "file_hash": f"{number:064x}",
+            "receipt_date": f"2023100{number % 3}",
+            "created_at": f"2023-10-0{number}T12:00:00",
+            "check_company": "Sklep",
+            "check_total": f"{number},00",
+        })
+
+    pages, after = [], None
+    while True:
+        page, after = index.history(limit=3, sort="receipt_date", after=after)
+        pages.append([metadata["file_hash"] for metadata in page])
+        if after is None:
+            break
+        after = decode_cursor(encode_cursor("receipt_date", True, after), "receipt_date", True)
+    index.close()
+
+    assert [len(page) for page in pages] == [3, 3, 1]
+    seen = [file_hash for page in pages for file_hash in page]
+    assert sorted(seen) == [f"{number:064x}" for number in range(7)]
+    dates = [f"2023100{int(file_hash, 16) % 3}" for file_hash in seen]
+    assert dates == sorted(dates, reverse=True)
+
+
+def test_history_company_filter_pagination(tmp_path):
+    """Filtr sprzedawcy dopasowuje początek nazwy przez indeks i działa z paginacją kursorem"""
+    index = ReceiptIndex(str(tmp_path / "receipts.sqlite3"))
+    companies = ["Lidl sp. z o.o.", "LIDL", "Biedronka", "Żabka", "Sklep Lidl"]
+    for number in range(10):
+        index.upsert({
+            "file_hash": f"{number:064x}",
+            "receipt_date": "20231001",
+            "created_at": f"2023-10-01T12:00:0{number}",
+            "check_company": companies[number % len(companies)],
+            "check_total": "1,00",
+        })
+
+    pages, after = [], None
+    while True:
+        page, after = index.history(limit=3, company=" lidl", after=after)
+        pages.append([metadata["file_hash"] for metadata in page])
+        if after is None:
+            break
+
+    assert [len(page) for page in pages] == [3, 1]
+    assert [file_hash for page in pages for file_hash in page] == [
+        f"{number:064x}" for number in (6, 5, 1, 0)
+    ]
+    assert [metadata["check_company"] for metadata in index.history(company="żab")[0]] == ["Żabka", "Żabka"]
+
+    plan = index._connect().execute(
+        "EXPLAIN QUERY PLAN SELECT file_hash FROM receipts WHERE company_key >= ? AND company_key < ?",
+        ("lidl", "lidl\U0010ffff"),
+    ).fetchall()
+    assert "idx_receipts_company_key" in " ".join(row[-1] for row in plan)
+    index.close()
+
+
+def test_extract_receipt_facts_recording():
+    """Pozycje i podsumowanie VAT zapisanego paragonu"""
+    path = next(path for path in OCR_RECORDINGS if os.path.basename(path).startswith("0b0780a4"))
+    lines, _, _ = parse_receipt_text(read_text(path))
+
+    facts = extract_receipt_facts(lines)
+
+    assert [(line, vat_class, amount) for line, _, vat_class, amount in facts["items"]] == [
+        (10, "D", 1.59), (11, "B", 3.59), (12, "B", 3.69), (13, "D", 2.99), (14, "D", 2.79),
+    ]
+    assert [name for _, name, _, _ in facts["items"][:3]] == ["BATON ŻURAW YD", "ANIA BATON GRU-B", "ANIA BATON GRU-B"]
+    assert round(sum(amount for *_, amount in facts["items"]), 2) == 14.65
+    assert facts["vat"] == [("B", 7.28, 0.54)]
+    assert len(facts["lines"]) == len(lines)
+
+
+def test_analytics_store_compacts_invalidated_rows(tmp_path, monkeypatch):
+    """Ponownie zapisane paragony unieważniają poprzednie wiersze, które są usuwane po przekroczeniu progu"""
+    monkeypatch.setattr(analytics, "receipt_index", ReceiptIndex(str(tmp_path / "receipts.sqlite3")))
+    monkeypatch.setattr(analytics, "COMPACT_MIN_INVALID", 3)
+    monkeypatch.setattr(analytics, "COMPACT_INVALID_RATIO", 0.5)
+    store = analytics.AnalyticsStore()
+    store.load()
+
+    def save(file_hash, company, amounts):
+        facts = {
+            "items": [(number, f"PRODUKT {number}", "A", amount) for number, amount in enumerate(amounts)],
+            "vat": [("A", sum(amounts), 0.23 * sum(amounts))],
+        }
+        store.add_receipt({"file_hash": file_hash, "receipt_date": "20240301", "check_company": company}, sum(amounts), facts)
+
+    save("a", "Lidl", [1.0, 2.0])
+    save("b", "Żabka", [5.0])
+    save("a", "Lidl", [1.5, 2.0])
+    save("a", "Lidl", [1.5, 2.5])
+    assert (store.receipts.size, store.items.size) == (4, 7)
+
+    save("b", "Żabka", [4.0])
+    assert (store.receipts.size, store.items.size, store.vat.size) == (2, 3, 2)
+
+    spend = store.query("spend", ["company"])
+    assert [(row["group"]["company"], row["amount"], row["receipts"]) for row in spend["rows"]] == [
+        ("Lidl", 4.0, 1), ("Żabka", 4.0, 1),
+    ]
+    products = store.query("spend", ["product"], company="lidl")
+    assert [(row["group"]["product"], row["amount"]) for row in products["rows"]] == [
+        ("PRODUKT 0", 1.5), ("PRODUKT 1", 2.5),
+    ]
+    assert store.query("vat", ["vat_class"])["rows"][0]["sales"] == 8.0
+
+    save("b", "Żabka", [3.0])
+    assert store.receipts.size == 3
+    assert store.query("spend", [])["rows"][0]["amount"] == 7.0
+
+
+def test_extract_receipt_facts_item_continuations():
+    """Kwota pozycji z linii PC, rabaty pomniejszające pozycję i linie jako słowniki"""
+    lines = [
+        {"line_number": 1, "category": "P", "content": "SER GOUDA PLASTRY"},
+        {"line_number": 2, "category": "PC", "content": "0,702 x31,99 22,46 C"},
+        {"line_number": 3, "category": "PC", "content": "RABAT -2,46"},
+        {"line_number": 4, "category": "P", "content": "WODA 1 x1,99 1,99A"},
+        {"line_number": 5, "category": "P", "content": "TORBA"},
+        {"line_number": 6, "category": "S", "content": "SPRZEDAŻ OPODATKOWANA A 1,99"},
+        {"line_number": 7, "category": "S", "content": "PTU A 23,00 % 0,37"},
+        {"line_number": 8, "category": "S", "content": "SPRZEDAŻ OPODATKOWANA C 20,00"},
+        {"line_number": 9, "category": "O", "content": "   "},
+    ]
+
+    facts = extract_receipt_facts(lines)
+
+    assert facts["items"] == [(1, "SER GOUDA PLASTRY", "C", 20.0), (4, "WODA", "A", 1.99)]
+    assert facts["vat"] == [("A", 1.99, 0.37), ("C", 20.0, None)]
+    assert [line for line, _, _ in facts["lines"]] == list(range(1, 9))
+
+
+def test_search_lines(tmp_path):
+    """Wyszukiwanie ignoruje znaki diakrytyczne i zwraca pasujące linie w kolejności paragonu"""
+    index = ReceiptIndex(str(tmp_path / "receipts.sqlite3"))
+    receipts = {
+        "a" * 64: [(1, "A", "Sklep Żabka"), (2, "P", "MASŁO EXTRA 1 x7,99 7,99C"), (3, "P", "MLEKO 3,49C")],
+        # Powtórzony numer linii z kategorią NULL (odpowiedź LLM bez kategorii)
+        "b" * 64: [(4, "P", "masło osełkowe 8,49C"), (4, None, "MASLO GRATIS"), (2, "P", "CHLEB 4,99C")],
+        "c" * 64: [(1, "P", "CHLEB 4,99C")],
+    }
+    for file_hash, lines in receipts.items():
+        index.upsert({"file_hash": file_hash, "receipt_date": "20231027"}, facts={"lines": lines})
+
+    results, total = index.search("maslo")
+
+    assert total == 2
+    assert {result["file_hash"] for result in results} == {"a" * 64, "b" * 64}
+    lines = {result["file_hash"]: [line["line_number"] for line in result["lines"]] for result in results}
+    assert lines == {"a" * 64: [2], "b" * 64: [4, 4]}
+    assert all(result["metadata"]["receipt_date"] == "20231027" for result in results)
+
+    results, total = index.search("chle", limit=1)
+    assert total == 2 and len(results) == 1
+    assert index.search("osełkowe")[0][0]["file_hash"] == "b" * 64
+
+    with pytest.raises(ValueError):
+        index.search(" ,. ")
+    index.close()
+
+
+def receipt_text(lines: list, **check: str) -> str:
+    rows = ["| Line | Category | Content |", "|---|---|---|"]
+    rows += [f"| {number} | {category} | {content} |" for number, category, content in lines]
+    rows += ["", "| Parameter | Value |", "|---|---|"]
+    rows += [f"| {name} | {value} |" for name, value in check.items()]
+    return "\n".join(rows)
+
+
+def test_merge_receipt_pages():
+    """Linie stron mają ciągłą numerację, data i sprzedawca pochodzą z pierwszej strony, a suma z ostatniej"""
+    pages = [
+        receipt_text([(1, "A", "Sklep"), (2, "P", "MLEKO 3,49C")], DATE="20231027", COMPANY="Sklep", TOTAL="3,49"),
+        receipt_text([(1, "P", "CHLEB 4,99C")], DATE="20231028", COMPANY="UNKNOWN", TOTAL="0.00"),
+        receipt_text([(5, "S", "SUMA PLN 8,48")], TOTAL="8,48"),
+        "Brak tabeli",
+    ]
+
+    lines, check, _ = parse_receipt_text(merge_receipt_pages(pages))
+
+    assert [(line.line_number, line.category, line.content) for line in lines] == [
+        (1, "A", "Sklep"), (2, "P", "MLEKO 3,49C"), (3, "P", "CHLEB 4,99C"), (4, "S", "SUMA PLN 8,48"),
+    ]
+    assert (check.date, check.company, check.total) == ("20231027", "Sklep", "8,48")
+
+    _, empty_check, _ = parse_receipt_text(merge_receipt_pages(["", ""]))
+    assert (empty_check.date, empty_check.company, empty_check.total) == tuple(CHECK_DEFAULTS.values())
+
+
+def test_bk_tree_find_matches_brute_force():
+    """Wyszukiwanie w drzewie BK zwraca te same skróty co porównanie ze wszystkimi"""
+    rng = random.Random(0)
+    base = rng.getrandbits(64)
+    values = [(rng.getrandbits(64), f"random-{number}") for number in range(2000)]
+    values += [(base ^ (1 << rng.randrange(64)) ^ (1 << rng.randrange(64)), f"near-{number}") for number in range(20)]
+    values += [(base, "same-1"), (base, "same-2")]
+    tree = BKTree()
+    for value, file_hash in values:
+        tree.add(value, file_hash)
+
+    for max_distance in (0, 2, 6, 12):
+        expected = sorted(
+            (hamming_distance(base, value), file_hash, value)
+            for value, file_hash in values if hamming_distance(base, value) <= max_distance
+        )
+        assert tree.find(base, max_distance) == expected
+    assert tree.size == len(values)
+    assert BKTree().find(base, 64) == []
+
+
+def test_receipt_fingerprint_separates_receipts():
+    """Zdjęcia tego samego paragonu (także obrócone) mają bliskie skróty i zgodne profile, a różne paragony - nie"""
+    def fingerprint(path):
+        image, _ = fix_orientation(Image.open(path), use_osd=False)
+        return receipt_fingerprint(image)
+
+    def distance(a, b):
+        value = int(b["image_hash"], 16)
+        return min(hamming_distance(int(a[name], 16), value) for name in ("image_hash", "image_hash_rotated"))
+
+    receipts = sorted(glob.glob(os.path.join(BACKEND_DIR, "data-test", "*", "*_fixed.jpg")))
+    photos = [(fingerprint(path.replace("_fixed.jpg", ".jpg")), fingerprint(path)) for path in receipts]
+
+    for original, fixed in photos:
+        assert distance(fixed, original) <= settings.storage.DUPLICATE_MAX_DISTANCE
+        assert profile_similarity(fixed["row_profile"], original["row_profile"]) >= settings.storage.DUPLICATE_MIN_SIMILARITY
+
+    for (first, _), (second, _) in itertools.combinations(photos, 2):
+        assert distance(first, second) > settings.storage.DUPLICATE_MAX_DISTANCE
+        assert profile_similarity(first["row_profile"], second["row_profile"]) < settings.storage.DUPLICATE_MIN_SIMILARITY
+
+
+def synthetic_receipt(angle: float = 0.0, background: int = 50) -> Image.Image:
+    """Jasny paragon 400x1000 z liniami tekstu w punkcie (400, 300) na ciemnym tle 1200x1600, obrócony o `angle`"""
+    paper = Image.new("L", (400, 1000), 235)
+    draw = ImageDraw.Draw(paper)
+    for top in range(40, 960, 30):
+        draw.rectangle((30, top, 30 + (top * 7) % 300 + 40, top + 10), fill=20)
+    mask = Image.new("L", paper.size, 255)
+    if angle:
+        paper = paper.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=235)
+        mask = mask.rotate(angle, expand=True)
+
+    image = Image.new("L", (1200, 1600), background)
+    image.paste(paper, (600 - paper.width // 2, 800 - paper.height // 2), mask)
+    return image.convert("RGB")
+
+
+def test_crop_receipt_to_paper():
+    """Kadr obejmuje paragon z marginesem"""
+    image, stats = crop_receipt(synthetic_receipt())
+
+    margin = settings.image.CROP_MARGIN * 1600
+    expected = (400 - margin, 300 - margin, 800 + margin, 1300 + margin)
+    assert stats["cropped"] is True
+    assert stats["deskew_angle"] == 0.0
+    # Kadr jest wyznaczany na zmniejszonej kopii - dokładność do 1% dłuższego boku
+    assert all(abs(actual - bound) <= 16 for actual, bound in zip(stats["box"], expected))
+    assert list(image.size) == stats["size"]
+    assert stats["pixel_ratio"] == pytest.approx(image.width * image.height / (1200 * 1600), abs=1e-3)
+
+
+def test_crop_receipt_straightens_skew():
+    """Pochylony paragon jest prostowany razem z kadrowaniem"""
+    image, stats = crop_receipt(synthetic_receipt(angle=5))
+
+    assert stats["cropped"] is True
+    assert stats["deskew_angle"] == pytest.approx(-5, abs=1)
+    # Po wyprostowaniu kadr jest wąski jak paragon, a nie jak jego obrócony obrys
+    assert image.width < 400 + 2 * settings.image.CROP_MARGIN * 1600 + 30
+
+
+def test_crop_receipt_keeps_whole_frame():
+    """Zdjęcie wypełnione paragonem i zdjęcie bez jaśniejszego obszaru nie są zmieniane"""
+    paper = synthetic_receipt().crop((400, 300, 800, 1300))
+    image, stats = crop_receipt(paper)
+    assert image is paper
+    assert stats["cropped"] is False
+
+    flat = Image.new("RGB", (600, 800), (128, 128, 128))
+    image, stats = crop_receipt(flat)
+    assert image is flat
+    assert stats["cropped"] is False
+
+
+@pytest.mark.parametrize("path", OCR_RECORDINGS, ids=os.path.basename)
+def test_validate_receipt_text_recordings(path):
+    assert validate_receipt_text(read_text(path)) == []
+
+
+def test_validate_receipt_text_escalation_triggers():
+    """Brak linii, daty lub kwoty oraz odpowiedź obcięta limitem tokenów są powodem ponowienia"""
+    lines = [(1, "P", "MLEKO 3,49C")]
+    complete = receipt_text(lines, DATE="20231027", COMPANY="Sklep", TOTAL="3,49")
+
+    assert check_ocr_response(complete, "stop") == []
+    assert check_ocr_response(complete, "length") == ["truncated"]
+    assert validate_receipt_text("Nie widzę paragonu na zdjęciu.") == ["no_lines", "no_date", "no_total"]
+    assert validate_receipt_text(receipt_text(lines, TOTAL="3,49")) == ["no_date"]
+    assert validate_receipt_text(receipt_text(lines, DATE="20231027", TOTAL="0,00")) == ["no_total"]
+    assert validate_receipt_text(receipt_text(lines, DATE="20231027", TOTAL="brak")) == ["no_total"]
+    # Strony dokumentu PDF nie muszą zawierać daty ani kwoty
+    assert validate_receipt_text(receipt_text(lines), check=False) == []
+    assert validate_receipt_text(receipt_text([]), check=False) == ["no_lines"]
+
+
+def stub_backend(name: str, content: str, **limits) -> LLMBackend:
+    """Backend LLM odpowiadający zawsze tą samą treścią (serwer testowy w procesie)"""
+    stub = create_app([{"content": content, "prompt_tokens": 100, "completion_tokens": 10}], latency=0)
+    client = AsyncOpenAI(
+        api_key="test",
+        base_url="http://stub-llm/v1",
+        http_client=httpx.AsyncClient(transport=httpx.ASGITransport(app=stub)),
+        max_retries=0,
+    )
+    return LLMBackend(name, f"{name}-model", client, LLMScheduler(max_concurrency=2, name=name), 1000, **limits)
+
+
+def test_select_backends(monkeypatch):
+    """Router pomija backendy, których limity nie obejmują cech paragonu"""
+    backends = [
+        stub_backend("mini", "", max_lines=30, max_aspect=4.0),
+        stub_backend("large", "", max_pixels=2_000_000),
+        stub_backend("default", ""),
+    ]
+    monkeypatch.setattr("app.services.ocr.get_llm_backends", lambda: backends)
+
+    def names(features):
+        return [backend.name for backend in select_backends(features)]
+
+    assert names({"lines": 20, "aspect": 2.0, "pixels": 1_000_000}) == ["mini", "large", "default"]
+    assert names({"lines": 45, "aspect": 2.0, "pixels": 1_000_000}) == ["large", "default"]
+    assert names({"lines": 20, "aspect": 5.0, "pixels": 3_000_000}) == ["default"]
+    assert names(None) == ["mini", "large", "default"]
+
+    monkeypatch.setattr(settings.routing, "ESCALATION_ENABLED", False)
+    assert names({"lines": 45}) == ["large"]
+
+
+def test_request_routed_ocr_escalates_invalid_result():
+    """Wynik tańszego backendu, który nie przeszedł walidacji, jest ponawiany silniejszym backendem"""
+    recording = next(path for path in OCR_RECORDINGS if os.path.basename(path).startswith("0b0780a4"))
+    backends = [
+        stub_backend("mini", "| Line | Category | Content |\n|---|---|---|\n| 1 | P | MLEKO 3,49C |"),
+        stub_backend("default", read_text(recording)),
+    ]
+    prompt = {"version": "test", "text": "OCR"}
+    request = {}
+
+    routed = asyncio.run(request_routed_ocr(prompt, [], backends, lambda max_tokens: 100, request=request))
+
+    assert routed["text"] == read_text(recording)
+    assert routed["routing"]["backend"] == "default"
+    assert [(attempt["name"], attempt["problems"]) for attempt in routed["routing"]["attempts"]] == [
+        ("mini", ["no_date", "no_total"]),
+        ("default", []),
+    ]
+    assert (routed["tokens_in"], routed["tokens_out"]) == (200, 20)
+    assert request["model"] == "default-model"
+
+    # Ostatni backend zwraca wynik także wtedy, gdy nie przeszedł walidacji
+    routed = asyncio.run(request_routed_ocr(prompt, [], backends[:1], lambda max_tokens: 100))
+    assert routed["routing"]["backend"] == "mini"
+    assert routed["routing"]["attempts"][0]["problems"] == ["no_date", "no_total"]